@@ -1,6 +1,8 @@
 from app.core.settings import settings
 from app.utils.logging import log
+from app.core import database
 from app.core.database import init_db
+from app.utils.jobs import ingestion_queue
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
@@ -12,10 +14,13 @@ async def startup():
     except Exception as ex:
         log.exception(f"failed to preparedb {ex}")
 
+    ingestion_queue.start()
+
 
 async def shutdown():
     log.info("shutting down")
-    pass
+    ingestion_queue.stop(timeout=5)
+    await database.async_engine.dispose()
 
 
 def create_app() -> FastAPI:
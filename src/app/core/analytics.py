@@ -0,0 +1,617 @@
+"""Расчет метрик производителя по подготовленным продажам
+
+ManufacturerAnalytics один раз готовит продажи пользователя: компактная
+таблица с номером дня продажи и регионом торговой точки. По ней при первом
+обращении строятся накопленные по дням суммы (PrefixSums) по регионам, товарам
+и парам (регион, товар), поэтому метрика за любое окно дат и с любой
+детализацией (день, неделя, месяц, квартал) считается разностями накопленных
+сумм, без повторного просмотра продаж. Подготовленные продажи кэшируются по
+пользователю и версии его данных (analytics_cache). Без параметров окна
+результаты совпадают с функциями app.core.ml, те остаются эталоном.
+
+compute_metrics выбирает способ расчета по settings.ML_BACKEND: запросами к
+дневным витринам (app.core.sql_metrics) или ManufacturerAnalytics.
+"""
+from datetime import date
+from functools import cached_property
+from time import perf_counter
+from typing import Any, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+from anyio import from_thread
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import async_crud, database, ml, models, sql_metrics
+from app.core.models import OperationType
+from app.core.settings import settings
+from app.utils.cache import TTLCache
+from app.utils.logging import log
+
+# метрики в порядке app.core.ml
+METRICS = (
+    "shops_manufacturer",
+    "volumes_manufacturer_region",
+    "volumes_manufacturer",
+    "popular_offline_gtin_manufacturer_region",
+    "popular_offline_gtin_manufacturer",
+    "popular_online_gtin_manufacturer",
+    "shops_manufacturer_count_region",
+    "shops_manufacturer_count",
+)
+# метрики по регионам возвращают описания регионов, в ответе - их список
+REGION_METRICS = {
+    "shops_manufacturer",
+    "volumes_manufacturer_region",
+    "popular_offline_gtin_manufacturer_region",
+    "shops_manufacturer_count_region",
+}
+
+SINCE = sql_metrics.SINCE
+REGION_VOLUMES_SINCE = sql_metrics.REGION_VOLUMES_SINCE
+# периоды pandas для granularity, см. sql_metrics.GRANULARITIES
+PERIODS = {"day": "D", "week": "W", "month": "M", "quarter": "Q"}
+
+
+class PrefixSums:
+    """Накопленные по дням суммы показателей для каждого ключа
+
+    Суммы ключа за дни [start, end) - разность накопленных сумм на границах
+    окна, границы находятся двоичным поиском, поэтому время запроса не зависит
+    от количества продаж в окне.
+
+    Args:
+        keys (np.ndarray): код ключа строки, от 0 до size - 1
+        days (np.ndarray): номер дня строки, от 0 до days_count - 1
+        values (dict[str, np.ndarray]): показатели строк
+        size (int): количество ключей
+        days_count (int): количество дней
+    """
+
+    def __init__(
+        self,
+        keys: np.ndarray,
+        days: np.ndarray,
+        values: dict[str, np.ndarray],
+        size: int,
+        days_count: int,
+    ):
+        self.size = size
+        self.stride = days_count + 1
+        cells = keys.astype("int64") * self.stride + days
+        order = np.argsort(cells, kind="stable")
+        cells = cells[order]
+        # строки одного ключа за один день складываются
+        first = np.flatnonzero(np.diff(cells, prepend=-1))
+        self.cells = cells[first]
+        self.sums = {}
+        for name, value in values.items():
+            daily = (
+                np.add.reduceat(value[order].astype("int64"), first)
+                if len(first)
+                else np.zeros(0, dtype="int64")
+            )
+            self.sums[name] = np.concatenate(([0], np.cumsum(daily)))
+
+    def totals(self, start: Any, end: Any) -> dict[str, np.ndarray]:
+        """Суммы показателей каждого ключа за дни [start, end)
+
+        start и end - номера дней или массивы границ нескольких окон, тогда
+        суммы - массивы (окно, ключ).
+        """
+        base = np.arange(self.size, dtype="int64") * self.stride
+        lo = np.searchsorted(self.cells, base + np.asarray(start)[..., None])
+        hi = np.searchsorted(self.cells, base + np.asarray(end)[..., None])
+        return {name: sums[hi] - sums[lo] for name, sums in self.sums.items()}
+
+
+class ManufacturerAnalytics:
+    """Подготовленные продажи одного производителя
+
+    Продажи хранятся одной таблицей компактных типов: ключи справочников
+    int32/int16, cnt - int32, region_code - категория (int8 коды, без float и
+    NaN после объединения с торговыми точками), day - номер дня от первого дня
+    продаж. Продажи без региона и типы операций выбираются масками, без копий
+    таблицы.
+
+    Метрики принимают окно date_from - date_to (date_to не включается, по
+    умолчанию - с дат app.core.ml до последней продажи) и granularity для
+    метрик по периодам: без нее периоды - номера месяцев, как в app.core.ml,
+    иначе - day, week, month или quarter с датой начала периода.
+
+    Args:
+        sold (pd.DataFrame): dt, id_sp_, gtin, type_operation, price, cnt,
+            ключи справочников, см. async_crud.get_sold_goods_for_metrics
+        points (pd.DataFrame): id_sp_, region_code
+        decode_gtin (ml.Decode): значения gtin для ключей
+        decode_sale_point (ml.Decode): значения id_sp_ для ключей
+    """
+
+    def __init__(
+        self,
+        sold: pd.DataFrame,
+        points: pd.DataFrame,
+        decode_gtin: ml.Decode,
+        decode_sale_point: ml.Decode,
+    ):
+        start = perf_counter()
+        self.decode_gtin = decode_gtin
+        self.decode_sale_point = decode_sale_point
+        dt = pd.to_datetime(sold["dt"])
+        known = dt.notna().to_numpy()
+        days = dt.to_numpy()[known].astype("datetime64[D]")
+        self.first_day = days.min() if len(days) else np.datetime64(SINCE, "D")
+        days = (days - self.first_day).astype("int32")
+        self.days_count = int(days.max()) + 1 if len(days) else 0
+        self.calendar = pd.date_range(
+            pd.Timestamp(self.first_day), periods=self.days_count, freq="D"
+        )
+        # колонки фильтруются по отдельности, без копии всей таблицы продаж
+        column = {name: sold[name].to_numpy()[known] for name in sold if name != "dt"}
+        frame = pd.DataFrame(
+            {
+                "id_sp_": column["id_sp_"],
+                "gtin": column["gtin"],
+                "type_operation": column["type_operation"],
+                "cnt": column["cnt"],
+                "sum_price": column["price"].astype("int64") * column["cnt"],
+                "day": days,
+            }
+        )
+        # в app.core.ml онлайн продажи не объединяются с торговыми точками
+        self.online = frame.loc[
+            frame["type_operation"] == OperationType.ONLINE_SALE,
+            ["gtin", "cnt", "day"],
+        ]
+        region_code = pd.CategoricalDtype(np.sort(points["region_code"].unique()))
+        # как pd.merge(..., how="left") в app.core.ml: у продаж точек без
+        # региона region_code пустой
+        if points["id_sp_"].is_unique:
+            # код региона по ключу точки из массива, без объединения таблиц
+            sale_points, keys = points["id_sp_"].to_numpy(), frame["id_sp_"].to_numpy()
+            codes = np.full(
+                max(sale_points.max(initial=0), keys.max(initial=0)) + 1,
+                -1,
+                dtype="int16",
+            )
+            codes[sale_points] = region_code.categories.get_indexer(
+                points["region_code"]
+            )
+            frame["region_code"] = pd.Categorical.from_codes(
+                codes[keys], dtype=region_code
+            )
+            self.frame = frame
+        else:
+            self.frame = frame.merge(
+                points[["id_sp_", "region_code"]].astype({"region_code": region_code}),
+                on="id_sp_",
+                how="left",
+            )
+        log.info(
+            f"prepared {len(self.frame)} sales for metrics "
+            f"in {perf_counter() - start:.2f} seconds"
+        )
+
+    def compute(self, metrics: Iterable[str], **params: Any) -> dict[str, Any]:
+        """Результаты метрик metrics в формате функций app.core.ml
+
+        Args:
+            params: date_from, date_to, granularity, см. ManufacturerAnalytics
+        """
+        return {metric: getattr(self, metric)(**params) for metric in metrics}
+
+    @property
+    def nbytes(self) -> int:
+        """Примерный размер в памяти, накопленные суммы - не больше размера
+        продаж"""
+        return 2 * int(
+            self.frame.memory_usage().sum() + self.online.memory_usage().sum()
+        )
+
+    # region helpers
+
+    def _type(self, type_operation: int) -> pd.DataFrame:
+        return self.frame[self.frame["type_operation"].to_numpy() == type_operation]
+
+    def _days(
+        self, date_from: Optional[date], date_to: Optional[date], since: date = SINCE
+    ) -> tuple[int, int]:
+        """Номера дней [start, end) окна date_from - date_to, по умолчанию с since"""
+
+        def day(value: date) -> int:
+            return int((np.datetime64(value, "D") - self.first_day).astype("int64"))
+
+        start = min(max(day(date_from or since), 0), self.days_count)
+        end = self.days_count if date_to is None else day(date_to)
+        return start, min(max(end, start), self.days_count)
+
+    def _periods(
+        self, start: int, end: int, granularity: Optional[str]
+    ) -> tuple[np.ndarray, list]:
+        """Номер периода каждого дня [start, end) и подписи периодов"""
+        calendar = self.calendar[start:end]
+        if granularity is None:
+            labels, periods = np.unique(calendar.month.to_numpy(), return_inverse=True)
+            return periods, labels.tolist()
+        periods, labels = pd.factorize(calendar.to_period(PERIODS[granularity]))
+        return periods, [label.start_time.date().isoformat() for label in labels]
+
+    def _sums(
+        self, frame: pd.DataFrame, keys: np.ndarray
+    ) -> tuple[np.ndarray, PrefixSums]:
+        """Накопленные суммы rows и cnt строк frame по ключам keys
+
+        Returns:
+            tuple[np.ndarray, PrefixSums]: значения ключей по кодам и суммы
+        """
+        codes, uniques = pd.factorize(keys)
+        return uniques, PrefixSums(
+            codes,
+            frame["day"].to_numpy(),
+            {"rows": np.ones(len(frame), dtype="int8"), "cnt": frame["cnt"].to_numpy()},
+            len(uniques),
+            self.days_count,
+        )
+
+    def _region_sums(
+        self, frame: pd.DataFrame, key: str
+    ) -> tuple[pd.DataFrame, PrefixSums]:
+        """Накопленные суммы по парам (region_code, key) продаж frame с регионом
+
+        Returns:
+            tuple[pd.DataFrame, PrefixSums]: пары по кодам и суммы
+        """
+        frame = frame[frame["region_code"].notna().to_numpy()]
+        regions = frame["region_code"].cat
+        keys = frame[key].to_numpy().astype("int64")
+        width = int(keys.max(initial=0)) + 1
+        pairs, sums = self._sums(
+            frame, regions.codes.to_numpy().astype("int64") * width + keys
+        )
+        return (
+            pd.DataFrame(
+                {
+                    "region_code": regions.categories.to_numpy()[pairs // width].astype(
+                        "int64"
+                    ),
+                    key: pairs % width,
+                }
+            ),
+            sums,
+        )
+
+    @staticmethod
+    def _window(
+        table: pd.DataFrame, sums: PrefixSums, start: int, end: int, value: str
+    ) -> pd.DataFrame:
+        """Ключи table с продажами в окне [start, end) и их суммы value (total)"""
+        totals = sums.totals(start, end)
+        present = totals["rows"] > 0
+        return table[present].assign(total=totals[value][present])
+
+    @staticmethod
+    def _top_by_region(
+        totals: pd.DataFrame, key: str, limit: int, decode: ml.Decode, name: str
+    ) -> dict[int, dict[str, list]]:
+        """Первые limit ключей key по убыванию total в каждом регионе, при равных
+        значениях - по возрастанию ключа: {регион: {name: значения, "count": total}}
+        """
+        top = ml.top_k_by_group(totals, "region_code", "total", key, limit)
+        names = decode(top[key].unique())
+        return ml.group_lists(
+            top.assign(name=top[key].map(names)),
+            "region_code",
+            {name: "name", "count": "total"},
+        )
+
+    def _popular_gtin(self, totals: pd.DataFrame, limit: int) -> dict:
+        top = totals.sort_values(["total", "gtin"], ascending=[False, True])
+        top = top.head(limit)
+        names = self.decode_gtin(top["gtin"])
+        return {
+            "gtin": [names[i] for i in top["gtin"]],  # gtin товара
+            "count": list(map(int, top["total"])),
+        }
+
+    @cached_property
+    def _regions(self) -> PrefixSums:
+        """rows, cnt и sum_price по регионам, последний ключ - точки без региона"""
+        region_code = self.frame["region_code"].cat
+        codes = region_code.codes.to_numpy().astype("int64")
+        codes[codes < 0] = len(region_code.categories)
+        return PrefixSums(
+            codes,
+            self.frame["day"].to_numpy(),
+            {
+                "rows": np.ones(len(self.frame), dtype="int8"),
+                "cnt": self.frame["cnt"].to_numpy(),
+                "sum_price": self.frame["sum_price"].to_numpy(),
+            },
+            len(region_code.categories) + 1,
+            self.days_count,
+        )
+
+    @cached_property
+    def _sale_points_other(self) -> tuple[pd.DataFrame, PrefixSums]:
+        return self._region_sums(self._type(OperationType.OTHER), "id_sp_")
+
+    @cached_property
+    def _offline_region_gtin(self) -> tuple[pd.DataFrame, PrefixSums]:
+        return self._region_sums(self._type(OperationType.OFFLINE_SALE), "gtin")
+
+    @cached_property
+    def _offline_gtin(self) -> tuple[pd.DataFrame, PrefixSums]:
+        frame = self._type(OperationType.OFFLINE_SALE)
+        gtin, sums = self._sums(frame, frame["gtin"].to_numpy())
+        return pd.DataFrame({"gtin": gtin}), sums
+
+    @cached_property
+    def _online_gtin(self) -> tuple[pd.DataFrame, PrefixSums]:
+        gtin, sums = self._sums(self.online, self.online["gtin"].to_numpy())
+        return pd.DataFrame({"gtin": gtin}), sums
+
+    @cached_property
+    def _sale_point_days(self) -> pd.DataFrame:
+        """Уникальные (day, id_sp_, region_code): количество различных точек
+        нельзя получить из накопленных сумм, оно считается по ним"""
+        return self.frame[["day", "id_sp_", "region_code"]].drop_duplicates()
+
+    def _sale_points_by_period(
+        self, start: int, end: int, granularity: Optional[str]
+    ) -> tuple[pd.DataFrame, list]:
+        """Уникальные (period, id_sp_, region_code) дней [start, end) и подписи
+        периодов"""
+        periods, labels = self._periods(start, end, granularity)
+        days = self._sale_point_days
+        days = days[((days["day"] >= start) & (days["day"] < end)).to_numpy()]
+        days = days.assign(period=periods[days["day"].to_numpy() - start])
+        return days[["period", "id_sp_", "region_code"]].drop_duplicates(), labels
+
+    # endregion helpers
+
+    def shops_manufacturer(
+        self,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        granularity: Optional[str] = None,
+    ) -> dict:
+        totals = self._window(
+            *self._sale_points_other, *self._days(date_from, date_to), "rows"
+        )
+        top = self._top_by_region(
+            totals, "id_sp_", 5, self.decode_sale_point, "id"  # id магазина (object)
+        )
+        regions = ml.region_codes()
+        for code, data in top.items():
+            regions[code]["shops_manufacturer"] = data
+        return regions
+
+    def volumes_manufacturer_region(
+        self,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        granularity: Optional[str] = None,
+    ) -> dict:
+        totals = self._regions.totals(
+            *self._days(date_from, date_to, REGION_VOLUMES_SINCE)
+        )
+        # последний ключ - точки без региона
+        present = np.flatnonzero(totals["rows"][:-1] > 0)
+        categories = self.frame["region_code"].cat.categories.to_numpy()
+        return ml.set_region_volumes(
+            pd.DataFrame(
+                {
+                    "region_code": categories[present].astype("int64"),
+                    "cnt": totals["cnt"][present],
+                    "sum_price": totals["sum_price"][present],
+                }
+            )
+        )
+
+    def volumes_manufacturer(
+        self,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        granularity: Optional[str] = None,
+    ) -> dict:
+        start, end = self._days(date_from, date_to)
+        periods, labels = self._periods(start, end, granularity)
+        sums = {
+            name: np.zeros(len(labels), dtype="int64")
+            for name in ("rows", "cnt", "sum_price")
+        }
+        if len(periods):
+            # окно делится на отрезки дней одного периода, суммы отрезков -
+            # разности накопленных сумм; без granularity месяцы разных лет
+            # складываются, как в app.core.ml
+            cuts = np.flatnonzero(np.diff(periods)) + 1
+            starts = np.concatenate(([0], cuts))
+            ends = np.concatenate((cuts, [len(periods)]))
+            totals = self._regions.totals(start + starts, start + ends)
+            for name, total in sums.items():
+                # последний ключ - точки без региона
+                np.add.at(total, periods[starts], totals[name][:, :-1].sum(axis=1))
+        present = np.flatnonzero(sums["rows"] > 0)
+        return {
+            sql_metrics._period_name(granularity): [
+                labels[i] for i in present
+            ],  # месяц или начало периода
+            "count": sums["cnt"][present].tolist(),  # кол-во выведенного из оборота товара
+            "sum_price": sums["sum_price"][present].tolist(),
+        }  # суммарная цена товаров
+
+    def popular_offline_gtin_manufacturer_region(
+        self,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        granularity: Optional[str] = None,
+    ) -> dict:
+        totals = self._window(
+            *self._offline_region_gtin, *self._days(date_from, date_to), "cnt"
+        )
+        top = self._top_by_region(
+            totals, "gtin", 5, self.decode_gtin, "gtin"  # gtin товара
+        )
+        regions = ml.region_codes()
+        for code, data in top.items():
+            # кол-во товара проданного оффлайн
+            regions[code]["popular_offline_gtin_manufacturer_region"] = data
+        return regions
+
+    def popular_offline_gtin_manufacturer(
+        self,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        granularity: Optional[str] = None,
+    ) -> dict:
+        totals = self._window(
+            *self._offline_gtin, *self._days(date_from, date_to), "cnt"
+        )
+        return self._popular_gtin(totals, 5)
+
+    def popular_online_gtin_manufacturer(
+        self,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        granularity: Optional[str] = None,
+    ) -> dict:
+        totals = self._window(
+            *self._online_gtin, *self._days(date_from, date_to), "cnt"
+        )
+        return self._popular_gtin(totals, 10)
+
+    def shops_manufacturer_count_region(
+        self,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        granularity: Optional[str] = None,
+    ) -> dict:
+        sale_points, labels = self._sale_points_by_period(
+            *self._days(date_from, date_to), granularity
+        )
+        counts = (
+            sale_points.groupby(["region_code", "period"], observed=True)
+            .size()
+            .rename("count")
+            .reset_index()
+            .astype({"region_code": "int64"})
+        )
+        counts["label"] = np.array(labels, dtype=object)[counts["period"].to_numpy()]
+        regions = ml.region_codes()
+        for code, data in ml.group_lists(
+            counts,
+            "region_code",
+            {sql_metrics._period_name(granularity): "label", "count": "count"},
+        ).items():
+            regions[code]["shops_manufacturer_count_region"] = {
+                "region_code": code,
+                **data,
+            }  # месяц или начало периода  # кол-во магазинов
+        return regions
+
+    def shops_manufacturer_count(
+        self,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        granularity: Optional[str] = None,
+    ) -> dict:
+        sale_points, labels = self._sale_points_by_period(
+            *self._days(date_from, date_to), granularity
+        )
+        counts = (
+            sale_points.drop_duplicates(["period", "id_sp_"]).groupby("period").size()
+        )
+        return {
+            sql_metrics._period_name(granularity): [
+                labels[i] for i in counts.index
+            ],  # месяц или начало периода
+            "count": list(map(int, counts)),  # кол-во магазинов
+        }
+
+
+# region endpoints
+# расчет для async эндпоинтов /ml и /map: выборка через AsyncSession, расчеты
+# pandas - в пуле потоков (run_in_threadpool)
+
+analytics_cache = TTLCache(
+    settings.ANALYTICS_CACHE_SIZE,
+    settings.METRIC_CACHE_TTL,
+    maxbytes=settings.ANALYTICS_CACHE_MAX_BYTES,
+    sizeof=lambda analytics: analytics.nbytes,
+)
+
+
+def _decoder(model: Any) -> ml.Decode:
+    """decode для ManufacturerAnalytics: вызывается из потока пула, запрос
+    выполняется в event loop в отдельной сессии, потому что подготовленные
+    продажи живут в analytics_cache дольше сессии запроса"""
+
+    async def values(ids: list[int]) -> dict[int, str]:
+        async with database.AsyncSessionLocal() as db:
+            return await async_crud.get_dimension_values(db, model, ids)
+
+    def decode(ids: Iterable[int]) -> dict[int, str]:
+        return from_thread.run(values, list(ids))
+
+    return decode
+
+
+async def get_analytics(db: AsyncSession, user: models.User) -> ManufacturerAnalytics:
+    """Подготовленные продажи пользователя из analytics_cache или из базы"""
+    key = (user.id, await async_crud.get_data_version(db, user))
+    analytics = analytics_cache.get(key)
+    if analytics is None:
+        start = perf_counter()
+        sold = await async_crud.get_sold_goods_for_metrics(db, user)
+        points = await async_crud.get_points_for_mlcomputation(db)
+        log.info(f"prepared data in {perf_counter() - start}")
+        analytics = await run_in_threadpool(
+            ManufacturerAnalytics,
+            sold,
+            points,
+            _decoder(models.Gtin),
+            _decoder(models.SalePoint),
+        )
+        analytics_cache.set(key, analytics)
+    return analytics
+
+
+def invalidate_analytics(user_id: Optional[int] = None) -> int:
+    """Удаляет подготовленные продажи пользователя user_id, без user_id - всех
+
+    Returns:
+        int: количество удаленных записей
+    """
+    return analytics_cache.pop_where(
+        lambda key, value: user_id is None or key[0] == user_id
+    )
+
+
+async def compute_metrics(
+    db: AsyncSession, user: models.User, metrics: list[str], **params: Any
+) -> dict[str, Any]:
+    """Ответы эндпоинтов метрик metrics для пользователя user
+
+    Метрики по регионам возвращаются списком описаний регионов.
+
+    Args:
+        params: date_from, date_to, granularity, см. ManufacturerAnalytics
+    """
+    start = perf_counter()
+    if settings.ML_BACKEND == "sql":
+        results = {
+            metric: await getattr(sql_metrics, metric)(db, user, **params)
+            for metric in metrics
+        }
+    else:
+        analytics = await get_analytics(db, user)
+        results = await run_in_threadpool(analytics.compute, metrics, **params)
+    log.info(f"calculated {', '.join(metrics)} in {perf_counter() - start}")
+    return {
+        metric: list(result.values()) if metric in REGION_METRICS else result
+        for metric, result in results.items()
+    }
+
+
+# endregion endpoints
@@ -0,0 +1,203 @@
+"""Асинхронные варианты функций app.core.crud для async эндпоинтов
+
+Запросы те же, что в app.core.crud, но выполняются через AsyncSession
+(asyncpg) и не блокируют event loop. Выборки для расчетов возвращают DataFrame,
+см. app.core.fetch.
+"""
+from datetime import datetime
+from typing import Any, Iterable, Optional, Union
+
+import pandas as pd
+from sqlalchemy import func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import models
+from app.core.fetch import fetch_frame_async
+from app.utils.pagination import goods_page, goods_page_query
+
+# region user
+
+
+async def save_user(
+    db: AsyncSession,
+    username: str,
+    hashed_password: str,
+    email: str,
+    fullname: Optional[str] = None,
+) -> models.User:
+    db_user = models.User(
+        username=username,
+        password=hashed_password,
+        email=email,
+    )
+    if fullname:
+        db_user.fullname = fullname
+    db.add(db_user)
+    await db.commit()
+    return db_user
+
+
+async def get_user_by_username(
+    db: AsyncSession, username: str
+) -> Union[models.User, None]:
+    return (
+        await db.execute(select(models.User).where(models.User.username == username))
+    ).scalar_one_or_none()
+
+
+# endregion user
+
+# region produced goods
+
+
+async def get_produced_goods(
+    db: AsyncSession,
+    user: models.User,
+    count: int = 100,
+    cursor: Optional[str] = None,
+    offset: Optional[int] = None,
+    dt_from: Optional[datetime] = None,
+    dt_to: Optional[datetime] = None,
+    gtin: Optional[str] = None,
+) -> tuple[list[models.ProducedGoods], Optional[str]]:
+    statement = goods_page_query(
+        models.ProducedGoods, user.id, count, cursor, offset, dt_from, dt_to, gtin
+    )
+    return goods_page(list((await db.execute(statement)).scalars()), count)
+
+
+# endregion produced goods
+
+# region sold goods
+
+
+async def get_sold_goods(
+    db: AsyncSession,
+    user: models.User,
+    count: int = 100,
+    cursor: Optional[str] = None,
+    offset: Optional[int] = None,
+    dt_from: Optional[datetime] = None,
+    dt_to: Optional[datetime] = None,
+    gtin: Optional[str] = None,
+) -> tuple[list[models.SoldGoods], Optional[str]]:
+    statement = goods_page_query(
+        models.SoldGoods, user.id, count, cursor, offset, dt_from, dt_to, gtin
+    )
+    return goods_page(list((await db.execute(statement)).scalars()), count)
+
+
+# колонки для app.core.ml: ключи справочников под исходными именами колонок
+_SOLD_COLUMNS = {
+    "dt": (models.SoldGoods.dt, "datetime64[ns]"),
+    "inn": (models.SoldGoods.inn_id, "int32"),
+    "id_sp_": (models.SoldGoods.sale_point_id, "int32"),
+    "gtin": (models.SoldGoods.gtin_id, "int32"),
+    "type_operation": (models.SoldGoods.type_operation_id, "int16"),
+    "price": (models.SoldGoods.price, "int32"),
+    "cnt": (models.SoldGoods.cnt, "int32"),
+}
+
+
+async def _sold_goods_frame(
+    db: AsyncSession, user: models.User, *names: str
+) -> pd.DataFrame:
+    statement = select(
+        *(_SOLD_COLUMNS[name][0].label(name) for name in names)
+    ).where(models.SoldGoods.user_id == user.id)
+    return await fetch_frame_async(
+        db, statement, {name: _SOLD_COLUMNS[name][1] for name in names}
+    )
+
+
+async def get_sold_goods_for_metrics(
+    db: AsyncSession, user: models.User
+) -> pd.DataFrame:
+    """Продажи пользователя для app.core.analytics.ManufacturerAnalytics"""
+    return await _sold_goods_frame(
+        db, user, "dt", "id_sp_", "gtin", "type_operation", "price", "cnt"
+    )
+
+
+# endregion sold goods
+
+# region agg data
+
+
+async def get_agg_sold(db: AsyncSession, user: models.User):
+    return (
+        await db.execute(
+            select(
+                models.AgrSold.dt, models.AgrSold.region_code, models.AgrSold.sum_price
+            ).where(models.AgrSold.user_id == user.id)
+        )
+    ).all()
+
+
+# endregion agg data
+
+# region ingestion jobs
+
+
+async def get_job(
+    db: AsyncSession, user: models.User, job_id: int
+) -> Union[models.IngestionJob, None]:
+    return (
+        await db.execute(
+            select(models.IngestionJob).where(
+                models.IngestionJob.id == job_id,
+                models.IngestionJob.user_id == user.id,
+            )
+        )
+    ).scalar_one_or_none()
+
+
+async def get_data_version(db: AsyncSession, user: models.User) -> Optional[datetime]:
+    """Время последней завершенной загрузки файла пользователя или торговых
+    точек, меняется вместе с данными метрик"""
+    return (
+        await db.execute(
+            select(func.max(models.UserFile.loaded_at)).where(
+                or_(
+                    models.UserFile.user_id == user.id,
+                    models.UserFile.format == "sale_points",
+                )
+            )
+        )
+    ).scalar_one()
+
+
+# endregion ingestion jobs
+
+# region additional data
+
+
+async def get_points_for_mlcomputation(db: AsyncSession) -> pd.DataFrame:
+    return await fetch_frame_async(
+        db,
+        select(
+            models.AddSoldGoods.sale_point_id.label("id_sp_"),
+            models.AddSoldGoods.region_code,
+        ),
+        {"id_sp_": "int32", "region_code": "int32"},
+    )
+
+
+# endregion additional data
+
+# region dimensions
+
+
+async def get_dimension_values(
+    db: AsyncSession, model: Any, ids: Iterable[int]
+) -> dict[int, str]:
+    """Значения справочника model по ключам ids, см. crud.get_dimension_values"""
+    ids = [int(id) for id in ids]
+    if not ids:
+        return {}
+    return dict(
+        (await db.execute(select(model.id, model.value).where(model.id.in_(ids)))).all()
+    )
+
+
+# endregion dimensions
@@ -1,18 +1,23 @@
 from datetime import timedelta, datetime
+from time import time
 from typing import Optional, Union
 
 
 from fastapi import HTTPException, Depends, status
 
-from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 
-from app.core import crud
+from app.core import crud, async_crud
 from app.core.settings import settings
 from app.core.schemas import Token, TokenData
 from app.core.models import User
+from app.utils.cache import TTLCache
 from app.utils.logging import log
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 
@@ -51,6 +56,20 @@ def authenticate_user(db: Session, username: str, password: str) -> Union[User,
     return user
 
 
+async def authenticate_user_async(
+    db: AsyncSession, username: str, password: str
+) -> Union[User, bool]:
+    """Асинхронный вариант authenticate_user
+
+    Проверка bcrypt хэша выполняется в пуле потоков, чтобы не блокировать event loop.
+    """
+    user = await async_crud.get_user_by_username(db, username)
+
+    if user and not await run_in_threadpool(verify_password, password, user.password):
+        return False
+    return user
+
+
 def sign_user(db: Session, username: str, password: str) -> User:
     return User()
 
@@ -83,24 +102,91 @@ def create_access_token(
     return encoded_jwt
 
 
-def get_current_user(db: Session, token: str = Depends(oauth2_scheme)) -> User:
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"},
+)
 
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+
+def decode_token(token: str) -> TokenData:
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=settings.ALGORITHM)
         username: Optional[str] = payload.get("sub")
         if username is None:
             raise credentials_exception
-        token_data = TokenData(username=username)
+        return TokenData(username=username, exp=payload.get("exp"))
     except JWTError:
         raise credentials_exception
 
+
+# region user cache
+# токен -> колонки пользователя. При попадании в кэш токен не декодируется и
+# пользователь не выбирается из базы: объект User собирается из колонок и
+# добавляется в сессию через merge(load=False), без запроса. Хранятся только
+# колонки, нужные обработке запросов (CACHED_COLUMNS), без хэша пароля;
+# остальные колонки загружаются при обращении (в AsyncSession - через
+# db.refresh). Записи удаляются при изменении или удалении пользователя в этом
+# процессе, в других процессах - по истечении AUTH_CACHE_TTL
+
+user_cache = TTLCache(settings.AUTH_CACHE_SIZE, settings.AUTH_CACHE_TTL)
+CACHED_COLUMNS = ("id", "username")
+
+
+def _cached_user(token: str) -> Optional[User]:
+    columns = user_cache.get(token)
+    if columns is None:
+        return None
+    user = User(**columns)
+    make_transient_to_detached(user)
+    return user
+
+
+def _cache_user(token: str, token_data: TokenData, user: User):
+    ttl = token_data.exp - time() if token_data.exp is not None else None
+    user_cache.set(
+        token,
+        {column: getattr(user, column) for column in CACHED_COLUMNS},
+        ttl,
+    )
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_user(mapper, connection, target: User):
+    user_cache.pop_where(lambda token, columns: columns["id"] == target.id)
+
+
+# endregion user cache
+
+
+def get_current_user(db: Session, token: str = Depends(oauth2_scheme)) -> User:
+    cached = _cached_user(token)
+    if cached is not None:
+        return db.merge(cached, load=False)
+
+    token_data = decode_token(token)
+
     user = crud.get_user_by_username(db, token_data.username)  # type: ignore
 
     if user is None:
         raise credentials_exception
+    _cache_user(token, token_data, user)
+    return user
+
+
+async def get_current_user_async(
+    db: AsyncSession, token: str = Depends(oauth2_scheme)
+) -> User:
+    cached = _cached_user(token)
+    if cached is not None:
+        return await db.merge(cached, load=False)
+
+    token_data = decode_token(token)
+
+    user = await async_crud.get_user_by_username(db, token_data.username)  # type: ignore
+
+    if user is None:
+        raise credentials_exception
+    _cache_user(token, token_data, user)
     return user
@@ -1,11 +1,14 @@
-from typing import Optional, Union
+from typing import Any, Iterable, Optional, Union
+from datetime import datetime
 from time import perf_counter
 
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
 
 from app.core import models
 from app.core import schemas
 from app.utils.logging import log
+from app.utils.pagination import goods_page, goods_page_query
 
 # region user
 def save_user(
@@ -52,9 +55,21 @@ def get_users_items(db: Session, user: models.User) -> Union[list[models.Item],
 
 # region produced goods
 def get_produced_goods(
-    db: Session, offset: int = 0, count: int = 100
-) -> list[models.ProducedGoods]:
-    return db.query(models.ProducedGoods).offset(offset).limit(count).all()
+    db: Session,
+    user: models.User,
+    count: int = 100,
+    cursor: Optional[str] = None,
+    offset: Optional[int] = None,
+    dt_from: Optional[datetime] = None,
+    dt_to: Optional[datetime] = None,
+    gtin: Optional[str] = None,
+) -> tuple[list[models.ProducedGoods], Optional[str]]:
+    """Страница произведенных товаров пользователя и курсор следующей страницы,
+    см. app.utils.pagination"""
+    statement = goods_page_query(
+        models.ProducedGoods, user.id, count, cursor, offset, dt_from, dt_to, gtin
+    )
+    return goods_page(list(db.execute(statement).scalars()), count)
 
 
 # endregion produced goods
@@ -62,9 +77,21 @@ def get_produced_goods(
 
 # region sold goods
 def get_sold_goods(
-    db: Session, offset: int = 0, count: int = 100
-) -> list[models.SoldGoods]:
-    return db.query(models.SoldGoods).offset(offset).limit(count).all()
+    db: Session,
+    user: models.User,
+    count: int = 100,
+    cursor: Optional[str] = None,
+    offset: Optional[int] = None,
+    dt_from: Optional[datetime] = None,
+    dt_to: Optional[datetime] = None,
+    gtin: Optional[str] = None,
+) -> tuple[list[models.SoldGoods], Optional[str]]:
+    """Страница проданных товаров пользователя и курсор следующей страницы,
+    см. app.utils.pagination"""
+    statement = goods_page_query(
+        models.SoldGoods, user.id, count, cursor, offset, dt_from, dt_to, gtin
+    )
+    return goods_page(list(db.execute(statement).scalars()), count)
 
 
 def get_sold_goods_for_computation(db: Session, user: models.User):
@@ -75,9 +102,9 @@ def get_sold_goods_for_computation(db: Session, user: models.User):
         db.query(models.SoldGoods)
         .with_entities(
             models.SoldGoods.dt,
-            models.SoldGoods.inn,
-            models.SoldGoods.id_sp_,
-            models.SoldGoods.type_operation,
+            models.SoldGoods.inn_id,
+            models.SoldGoods.sale_point_id,
+            models.SoldGoods.type_operation_id,
         )
         .filter(models.SoldGoods.user_id == user.id)
         .all()
@@ -94,7 +121,7 @@ def get_sold_goods_volume_metrics_by_region(db: Session, user: models.User):
         db.query(models.SoldGoods)
         .with_entities(
             models.SoldGoods.dt,
-            models.SoldGoods.id_sp_,
+            models.SoldGoods.sale_point_id,
             models.SoldGoods.price,
             models.SoldGoods.cnt,
         )
@@ -105,14 +132,14 @@ def get_sold_goods_volume_metrics_by_region(db: Session, user: models.User):
 
 
 def get_sold_goods_for_offline_metrics(db: Session, user: models.User):
-    # "dt", "id_sp_", "gtin", "cnt", "price", "type_operation"
+    # "dt", "id_sp_", "gtin", "cnt", "price", "type_operation" - ключи справочников
     result = (
         db.query(models.SoldGoods)
         .with_entities(
             models.SoldGoods.dt,
-            models.SoldGoods.id_sp_,
-            models.SoldGoods.gtin,
-            models.SoldGoods.type_operation,
+            models.SoldGoods.sale_point_id,
+            models.SoldGoods.gtin_id,
+            models.SoldGoods.type_operation_id,
             models.SoldGoods.price,
             models.SoldGoods.cnt,
         )
@@ -127,8 +154,8 @@ def get_sold_goods_for_online_metrics(db: Session, user: models.User):
         db.query(models.SoldGoods)
         .with_entities(
             models.SoldGoods.dt,
-            models.SoldGoods.gtin,
-            models.SoldGoods.type_operation,
+            models.SoldGoods.gtin_id,
+            models.SoldGoods.type_operation_id,
             models.SoldGoods.cnt,
         )
         .filter(models.SoldGoods.user_id == user.id)
@@ -142,7 +169,7 @@ def get_sold_goods_for_manufacturer_count_by_region(db: Session, user: models.Us
         db.query(models.SoldGoods)
         .with_entities(
             models.SoldGoods.dt,
-            models.SoldGoods.id_sp_,
+            models.SoldGoods.sale_point_id,
             models.SoldGoods.cnt,
         )
         .filter(models.SoldGoods.user_id == user.id)
@@ -170,11 +197,16 @@ def get_agg_sold(db: Session, user: models.User):
 
 # region user files
 def save_file(
-    db: Session, user: models.User, filename: str, filepath
+    db: Session,
+    user: models.User,
+    filename: str,
+    filepath,
+    sha256: Optional[str] = None,
 ) -> models.UserFile:
     db_file = models.UserFile(
         filename=filename,
         path=filepath,
+        sha256=sha256,
         user=user,
     )
     db.add(db_file)
@@ -182,8 +214,120 @@ def save_file(
     return db_file
 
 
+def get_file_by_hash(
+    db: Session, user: models.User, sha256: str
+) -> Union[models.UserFile, None]:
+    return (
+        db.query(models.UserFile)
+        .filter(
+            models.UserFile.user_id == user.id,
+            models.UserFile.sha256 == sha256,
+        )
+        .order_by(models.UserFile.id)
+        .first()
+    )
+
+
+def get_loaded_ranges(
+    db: Session, file: models.UserFile
+) -> list[tuple[datetime, datetime]]:
+    """Диапазоны дат уже загруженных файлов пользователя того же формата"""
+    return [
+        (dt_min, dt_max)
+        for dt_min, dt_max in db.query(models.UserFile)
+        .with_entities(models.UserFile.dt_min, models.UserFile.dt_max)
+        .filter(
+            models.UserFile.user_id == file.user_id,
+            models.UserFile.format == file.format,
+            models.UserFile.id != file.id,
+            models.UserFile.loaded_at.is_not(None),
+            models.UserFile.dt_min.is_not(None),
+        )
+        .all()
+    ]
+
+
+def delete_overlapping_rows(db: Session, model: Any, file: models.UserFile) -> int:
+    """Удаляет строки других файлов пользователя в диапазоне дат файла file"""
+    return (
+        db.query(model)
+        .filter(
+            model.user_id == file.user_id,
+            model.dt.between(file.dt_min, file.dt_max),
+            or_(model.file_id != file.id, model.file_id.is_(None)),
+        )
+        .delete(synchronize_session=False)
+    )
+
+
 # endregion user files
 
+# region ingestion jobs
+
+
+def create_job(
+    db: Session, file: models.UserFile, priority: int = 0, bytes_total: int = 0
+) -> models.IngestionJob:
+    db_job = models.IngestionJob(
+        file=file,
+        user_id=file.user_id,
+        priority=priority,
+        bytes_total=bytes_total,
+    )
+    db.add(db_job)
+    db.commit()
+    return db_job
+
+
+def get_job(
+    db: Session, user: models.User, job_id: int
+) -> Union[models.IngestionJob, None]:
+    return (
+        db.query(models.IngestionJob)
+        .filter(
+            models.IngestionJob.id == job_id,
+            models.IngestionJob.user_id == user.id,
+        )
+        .one_or_none()
+    )
+
+
+def get_file_job(
+    db: Session, file: models.UserFile
+) -> Union[models.IngestionJob, None]:
+    return (
+        db.query(models.IngestionJob)
+        .filter(models.IngestionJob.file_id == file.id)
+        .order_by(models.IngestionJob.id.desc())
+        .first()
+    )
+
+
+def get_unfinished_jobs(db: Session) -> list[models.IngestionJob]:
+    """Задачи, которые не были завершены, например из-за перезапуска сервиса"""
+    return (
+        db.query(models.IngestionJob)
+        .filter(
+            models.IngestionJob.status.in_(
+                [models.JobStatus.queued, models.JobStatus.running]
+            )
+        )
+        .all()
+    )
+
+
+def update_job_progress(db: Session, job_id: int, rows_done: int, bytes_done: int):
+    db.query(models.IngestionJob).filter(models.IngestionJob.id == job_id).update(
+        {
+            models.IngestionJob.rows_done: rows_done,
+            models.IngestionJob.bytes_done: bytes_done,
+        }
+    )
+    db.commit()
+
+
+# endregion ingestion jobs
+
 # region additional data
 
 
@@ -205,7 +349,7 @@ def get_points_for_computation(
     result = (
         db.query(models.AddSoldGoods)
         .with_entities(
-            models.AddSoldGoods.id_sp_,
+            models.AddSoldGoods.sale_point_id,
             models.AddSoldGoods.region_code,
             models.AddSoldGoods.city_with_type,
             models.AddSoldGoods.postal_code,
@@ -223,7 +367,7 @@ def get_points_for_mlcomputation(
     result = (
         db.query(models.AddSoldGoods)
         .with_entities(
-            models.AddSoldGoods.id_sp_,
+            models.AddSoldGoods.sale_point_id,
             models.AddSoldGoods.region_code,
         )
         .all()
@@ -233,3 +377,30 @@ def get_points_for_mlcomputation(
 
 
 # endregion additional data
+
+# region dimensions
+
+
+def get_dimension_values(db: Session, model: Any, ids: Iterable[int]) -> dict[int, str]:
+    """Значения справочника model по ключам ids
+
+    Args:
+        db (Session): сессия sqlalchemy.orm
+        model (type): модель справочника, например models.Gtin
+        ids (Iterable[int]): ключи значений
+
+    Returns:
+        dict[int, str]: ключ -> значение
+    """
+    ids = [int(id) for id in ids]
+    if not ids:
+        return {}
+    return dict(
+        db.query(model)
+        .with_entities(model.id, model.value)
+        .filter(model.id.in_(ids))
+        .all()
+    )
+
+
+# endregion dimensions
@@ -1,17 +1,24 @@
 import time
 from typing import Any
 
-from sqlalchemy import create_engine, Engine
+from sqlalchemy import create_engine, inspect, make_url, Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.exc import OperationalError as sqlalchemyOpError
 from psycopg2 import OperationalError as psycopg2OpError
 
 from app.utils.logging import log
 from app.core.settings import settings
+from app.core import migrations, partitions
+from app.core.pool import InstrumentedAsyncPool, InstrumentedQueuePool
 
 
 engine: Engine
 SessionLocal: Any
+# асинхронный движок (asyncpg) для async эндпоинтов, синхронный остается для
+# загрузки файлов и миграций
+async_engine: AsyncEngine
+AsyncSessionLocal: Any
 
 Base = declarative_base()
 
@@ -19,17 +26,58 @@ Base = declarative_base()
 def connect_db():
     global engine
     global SessionLocal
+    global async_engine
+    global AsyncSessionLocal
+    pool_options = dict(
+        pool_pre_ping=True,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+    )
     engine = create_engine(
         str(settings.DATABASE_URI),
-        pool_pre_ping=True,
+        poolclass=InstrumentedQueuePool,
+        **pool_options,
     )
     Base.metadata.bind = engine
     SessionLocal = sessionmaker(bind=engine)
 
+    async_engine = create_async_engine(
+        make_url(str(settings.DATABASE_URI)).set(
+            drivername="postgresql+asyncpg",
+            query={
+                "prepared_statement_cache_size": str(
+                    settings.DB_PREPARED_STATEMENT_CACHE_SIZE
+                )
+            },
+        ),
+        poolclass=InstrumentedAsyncPool,
+        connect_args={
+            "statement_cache_size": settings.DB_PREPARED_STATEMENT_CACHE_SIZE,
+            "server_settings": {
+                "statement_timeout": str(settings.DB_STATEMENT_TIMEOUT)
+            },
+        },
+        **pool_options,
+    )
+    AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
 
 def update_db():
     global Base
+    fresh = not inspect(engine).has_table("user")
     Base.metadata.create_all(engine)
+    migrations.upgrade(engine, fresh)
+    partitions.create_upcoming_partitions(
+        engine,
+        [
+            table.name
+            for table in Base.metadata.sorted_tables
+            if partitions.is_partitioned(table)
+        ],
+        settings.PARTITION_MONTHS_AHEAD,
+    )
 
 
 def init_db():
@@ -1,4 +1,9 @@
-from app.core.database import SessionLocal
+from datetime import date
+from typing import Literal, Optional
+
+from fastapi import HTTPException, status
+
+from app.core.database import SessionLocal, AsyncSessionLocal
 
 
 # region db
@@ -10,4 +15,33 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# endregion
+
+
+# region metrics
+
+
+def metric_window(
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    granularity: Optional[Literal["day", "week", "month", "quarter"]] = None,
+) -> dict:
+    """Окно дат и детализация метрик /ml и /map
+
+    date_to не включается. Без granularity метрики по периодам возвращают
+    номера месяцев (month), как раньше, иначе - даты начала периодов (period).
+    """
+    if date_from is not None and date_to is not None and date_from >= date_to:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="date_from must be earlier than date_to",
+        )
+    return {"date_from": date_from, "date_to": date_to, "granularity": granularity}
+
+
 # endregion
@@ -0,0 +1,81 @@
+"""Кэш результатов метрик /ml и /map
+
+Ключ записи - (пользователь, метрика, параметры, версия данных). Версия
+данных - время последней загрузки файла пользователя или файла торговых
+точек (async_crud.get_data_version), поэтому после загрузки в любом процессе
+старые результаты больше не читаются. Очередь загрузок этого процесса, кроме
+того, сразу удаляет записи пользователя (invalidate_user), чтобы они не
+занимали память до вытеснения.
+"""
+import json
+from typing import Any, Awaitable, Callable, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import async_crud
+from app.core.models import User
+from app.core.settings import settings
+from app.utils.cache import TTLCache
+from app.utils.logging import log
+
+_MISSING = object()
+
+
+def _json_size(value: Any) -> int:
+    """Размер результата в байтах, примерно равен размеру ответа"""
+    return len(json.dumps(value, default=str))
+
+
+metric_cache = TTLCache(
+    settings.METRIC_CACHE_SIZE,
+    settings.METRIC_CACHE_TTL,
+    maxbytes=settings.METRIC_CACHE_MAX_BYTES,
+    sizeof=_json_size,
+)
+
+
+async def cached_metrics(
+    db: AsyncSession,
+    user: User,
+    metrics: list[str],
+    compute: Callable[[list[str]], Awaitable[dict[str, Any]]],
+    **params: Any,
+) -> dict[str, Any]:
+    """Результаты метрик metrics из кэша, отсутствующие считаются одним вызовом
+    compute
+
+    Args:
+        metrics (list[str]): имена метрик
+        compute (Callable[[list[str]], Awaitable[dict[str, Any]]]): расчет
+            метрик для user, возвращает результат по имени метрики
+        params: параметры расчета, входят в ключ
+    """
+    version = await async_crud.get_data_version(db, user)
+    params_key = tuple(sorted(params.items()))
+    results = {}
+    missing = []
+    for metric in metrics:
+        result = metric_cache.get((user.id, metric, params_key, version), _MISSING)
+        if result is _MISSING:
+            missing.append(metric)
+        else:
+            results[metric] = result
+    if missing:
+        computed = await compute(missing)
+        for metric in missing:
+            metric_cache.set((user.id, metric, params_key, version), computed[metric])
+        results.update(computed)
+    return {metric: results[metric] for metric in metrics}
+
+
+def invalidate_user(user_id: Optional[int] = None) -> int:
+    """Удаляет результаты пользователя user_id, без user_id - всех пользователей
+
+    Returns:
+        int: количество удаленных записей
+    """
+    removed = metric_cache.pop_where(
+        lambda key, value: user_id is None or key[0] == user_id
+    )
+    log.info(f"invalidated {removed} cached metrics of user {user_id or 'all'}")
+    return removed
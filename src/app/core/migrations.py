@@ -0,0 +1,257 @@
+from typing import Callable
+
+from sqlalchemy import Connection, Engine, text
+
+from app.core import partitions
+from app.utils.logging import log
+
+
+# region migrations
+# Base.metadata.create_all создает только отсутствующие таблицы, изменения
+# существующих таблиц описываются здесь и применяются один раз по порядку
+
+
+def _user_files_checkpoint(conn: Connection):
+    conn.execute(
+        text(
+            "ALTER TABLE user_files "
+            "ADD COLUMN IF NOT EXISTS bytes_loaded BIGINT NOT NULL DEFAULT 0, "
+            "ADD COLUMN IF NOT EXISTS rows_loaded BIGINT NOT NULL DEFAULT 0"
+        )
+    )
+
+
+def _file_deduplication(conn: Connection):
+    conn.execute(
+        text(
+            "ALTER TABLE user_files "
+            "ADD COLUMN IF NOT EXISTS sha256 VARCHAR(64), "
+            "ADD COLUMN IF NOT EXISTS format VARCHAR(32), "
+            "ADD COLUMN IF NOT EXISTS dt_min TIMESTAMP, "
+            "ADD COLUMN IF NOT EXISTS dt_max TIMESTAMP, "
+            "ADD COLUMN IF NOT EXISTS loaded_at TIMESTAMP"
+        )
+    )
+    conn.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_user_files_sha256 ON user_files (sha256)")
+    )
+    for table in (
+        "produced_goods",
+        "sold_goods",
+        "transported_goods",
+        "agg_produced_goods",
+        "agg_sold_goods",
+    ):
+        conn.execute(
+            text(
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS "
+                "file_id INTEGER REFERENCES user_files (id)"
+            )
+        )
+
+
+# таблица -> (строковая колонка, справочник, колонка с ключом)
+_DIMENSIONS = {
+    "produced_goods": [
+        ("inn", "dim_inn", "inn_id"),
+        ("gtin", "dim_gtin", "gtin_id"),
+        ("prid", "dim_prid", "prid_id"),
+        ("operation_type", "dim_operation_type", "operation_type_id"),
+    ],
+    "sold_goods": [
+        ("gtin", "dim_gtin", "gtin_id"),
+        ("prid", "dim_prid", "prid_id"),
+        ("inn", "dim_inn", "inn_id"),
+        ("id_sp_", "dim_sale_point", "sale_point_id"),
+        ("type_operation", "dim_operation_type", "type_operation_id"),
+    ],
+    "transported_goods": [
+        ("gtin", "dim_gtin", "gtin_id"),
+        ("prid", "dim_prid", "prid_id"),
+        ("sender_inn", "dim_inn", "sender_inn_id"),
+        ("receiver_inn", "dim_inn", "receiver_inn_id"),
+    ],
+    "add_sold_goods": [
+        ("id_sp_", "dim_sale_point", "sale_point_id"),
+    ],
+}
+
+
+def _dimension_tables(conn: Connection):
+    # таблицы справочников уже созданы create_all, типы операций для
+    # app.core.ml добавлены при создании dim_operation_type
+    for table, columns in _DIMENSIONS.items():
+        for column, dimension, key in columns:
+            conn.execute(
+                text(
+                    f"INSERT INTO {dimension} (value) "
+                    f"SELECT DISTINCT {column} FROM {table} "
+                    f"WHERE {column} IS NOT NULL "
+                    "ON CONFLICT (value) DO NOTHING"
+                )
+            )
+        conn.execute(
+            text(
+                f"ALTER TABLE {table} "
+                + ", ".join(
+                    f"ADD COLUMN {key} INTEGER REFERENCES {dimension} (id)"
+                    for _, dimension, key in columns
+                )
+            )
+        )
+        # одно обновление на таблицу, а не на колонку
+        aliases = [f"d{i}" for i in range(len(columns))]
+        conn.execute(
+            text(
+                f"UPDATE {table} SET "
+                + ", ".join(
+                    f"{key} = {alias}.id"
+                    for (_, _, key), alias in zip(columns, aliases)
+                )
+                + " FROM "
+                + ", ".join(
+                    f"{dimension} {alias}"
+                    for (_, dimension, _), alias in zip(columns, aliases)
+                )
+                + " WHERE "
+                + " AND ".join(
+                    f"{alias}.value = {table}.{column}"
+                    for (column, _, _), alias in zip(columns, aliases)
+                )
+            )
+        )
+        conn.execute(
+            text(
+                f"ALTER TABLE {table} "
+                + ", ".join(
+                    f"ALTER COLUMN {key} SET NOT NULL, DROP COLUMN {column}"
+                    for column, _, key in columns
+                )
+            )
+        )
+
+
+# имя индекса, таблица, колонки - индексы из __table_args__ моделей
+_INDEXES = [
+    ("ix_produced_goods_user_id_dt", "produced_goods", "user_id, dt"),
+    ("ix_produced_goods_user_id_gtin_id", "produced_goods", "user_id, gtin_id"),
+    ("ix_sold_goods_user_id_dt", "sold_goods", "user_id, dt"),
+    ("ix_sold_goods_user_id_gtin_id", "sold_goods", "user_id, gtin_id"),
+    ("ix_transported_goods_user_id_dt", "transported_goods", "user_id, dt"),
+    ("ix_agg_produced_goods_user_id_dt", "agg_produced_goods", "user_id, dt"),
+    ("ix_agg_sold_goods_user_id_dt", "agg_sold_goods", "user_id, dt"),
+    ("ix_add_sold_goods_sale_point_id", "add_sold_goods", "sale_point_id"),
+    ("ix_organization_region_inn", "organization_region", "inn"),
+]
+
+
+def _indexes_and_partitions(conn: Connection):
+    for table in ("sold_goods", "produced_goods"):
+        partitioned = conn.execute(
+            text(
+                "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+                "WHERE partrelid = CAST(:table AS regclass))"
+            ),
+            {"table": table},
+        ).scalar_one()
+        if not partitioned:
+            partitions.partition_table(conn, table)
+    # индексы на секционированной таблице создаются и на всех ее секциях
+    for name, table, columns in _INDEXES:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+
+
+def _rollups(conn: Connection):
+    # app.core.rollups использует модели, а модели импортируют app.core.database
+    from app.core import rollups
+
+    rollups.rebuild(conn)
+
+
+def _unique_username(conn: Connection):
+    duplicates = conn.execute(
+        text('SELECT username FROM "user" GROUP BY username HAVING count(*) > 1')
+    ).scalars().all()
+    if duplicates:
+        # существующие дубликаты нужно разрешить вручную, пока индекс не уникальный
+        log.warning(f"duplicate usernames {duplicates}, ix_user_username is not unique")
+        conn.execute(
+            text('CREATE INDEX IF NOT EXISTS ix_user_username ON "user" (username)')
+        )
+        return
+    conn.execute(
+        text('CREATE UNIQUE INDEX IF NOT EXISTS ix_user_username ON "user" (username)')
+    )
+
+
+def _unique_file_hash(conn: Connection):
+    duplicates = conn.execute(
+        text(
+            "SELECT user_id, sha256 FROM user_files WHERE sha256 IS NOT NULL "
+            "GROUP BY user_id, sha256 HAVING count(*) > 1"
+        )
+    ).all()
+    if duplicates:
+        # существующие дубликаты нужно разрешить вручную, пока индекс не уникальный
+        log.warning(
+            f"duplicate user files {duplicates}, "
+            "ix_user_files_user_id_sha256 is not unique"
+        )
+        conn.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_user_files_user_id_sha256 "
+                "ON user_files (user_id, sha256)"
+            )
+        )
+    else:
+        conn.execute(
+            text(
+                "CREATE UNIQUE INDEX IF NOT EXISTS ix_user_files_user_id_sha256 "
+                "ON user_files (user_id, sha256)"
+            )
+        )
+    conn.execute(text("DROP INDEX IF EXISTS ix_user_files_sha256"))
+
+
+MIGRATIONS: list[tuple[str, Callable[[Connection], None]]] = [
+    ("0001_user_files_checkpoint", _user_files_checkpoint),
+    ("0002_file_deduplication", _file_deduplication),
+    ("0003_dimension_tables", _dimension_tables),
+    ("0004_indexes_and_partitions", _indexes_and_partitions),
+    ("0005_rollups", _rollups),
+    ("0006_unique_username", _unique_username),
+    ("0007_unique_file_hash", _unique_file_hash),
+]
+
+# endregion migrations
+
+
+def upgrade(engine: Engine, fresh: bool = False):
+    """Применяет миграции, которые еще не были применены
+
+    Args:
+        engine (Engine): движок sqlalchemy
+        fresh (bool, optional): схема только что создана create_all и уже
+            актуальна, миграции только отмечаются как примененные
+    """
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                "name VARCHAR(128) PRIMARY KEY, "
+                "applied_at TIMESTAMP NOT NULL DEFAULT now())"
+            )
+        )
+        applied = set(
+            conn.execute(text("SELECT name FROM schema_migrations")).scalars()
+        )
+        for name, migrate in MIGRATIONS:
+            if name in applied:
+                continue
+            if not fresh:
+                log.info(f"applying migration {name}")
+                migrate(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (name) VALUES (:name)"),
+                {"name": name},
+            )
@@ -1,3 +1,7 @@
+import copy
+from typing import Callable, Iterable
+
+import numpy as np
 import pandas as pd
 import json
 
@@ -7,9 +11,13 @@ import json
 
 # from etna.transforms import TimeSeriesImputerTransform
 
+from app.core.models import OperationType
 from app.core.settings import settings
 from app.utils.logging import log
 
+# gtin, id_sp_ и type_operation передаются ключами справочников (app.core.models),
+# decode возвращает исходные значения для ключей, попавших в результат
+Decode = Callable[[Iterable[int]], dict[int, str]]
 # # region Yarik
 
 # PIPELINE_PATH = r"src/models"
@@ -204,13 +212,86 @@ from app.utils.logging import log
 
 
 # # endregion Yarik
+# описание регионов, не изменяется. Метрики по регионам дополняют копию,
+# см. region_codes, результаты кэшируются в app.core.metric_cache
 REGION_CODES = {i["geoname_code"]: i for i in json.load(open("regions.json", "r"))}
-COMPUTED_METHODS = {}
+
+
+def region_codes() -> dict:
+    """Копия REGION_CODES для результата одного расчета"""
+    return copy.deepcopy(REGION_CODES)
+
+
+# region helpers
+# метрики по регионам строятся одной сортировкой и срезами по группам, без
+# фильтрации всей таблицы для каждого региона
+
+
+def top_k_by_group(
+    frame: pd.DataFrame, group: str, value: str, key: str, k: int
+) -> pd.DataFrame:
+    """Первые k строк каждой группы group по убыванию value, при равных value -
+    по возрастанию key. Строки результата упорядочены по group
+
+    В каждой группе np.partition находит k-е по величине значение, полностью
+    сортируются только строки не меньше него, а не вся таблица.
+    """
+    frame = frame.sort_values(group, kind="stable")
+    values = frame[value].to_numpy()
+    _, starts = np.unique(frame[group].to_numpy(), return_index=True)
+    ends = np.append(starts[1:], len(frame)).astype(starts.dtype)
+    thresholds = np.array(
+        [
+            np.partition(values[start:end], max(end - start - k, 0))[
+                max(end - start - k, 0)
+            ]
+            for start, end in zip(starts, ends)
+        ],
+        dtype=values.dtype,
+    )
+    frame = frame[values >= np.repeat(thresholds, ends - starts)]
+    frame = frame.sort_values([group, value, key], ascending=[True, False, True])
+    return frame.groupby(group, sort=False).head(k)
+
+
+def group_lists(
+    frame: pd.DataFrame, group: str, columns: dict[str, str]
+) -> dict[int, dict[str, list]]:
+    """Значения колонок каждой группы group списками
+
+    Args:
+        frame (pd.DataFrame): строки, упорядоченные по group
+        columns (dict[str, str]): имя списка -> колонка frame, числовые
+            колонки приводятся к int
+
+    Returns:
+        dict[int, dict[str, list]]: группа -> {имя списка: значения}
+    """
+    codes, starts = np.unique(frame[group].to_numpy(), return_index=True)
+    bounds = [*starts.tolist(), len(frame)]
+    values = {
+        name: (
+            frame[column].astype("int64")
+            if pd.api.types.is_numeric_dtype(frame[column])
+            else frame[column]
+        ).tolist()
+        for name, column in columns.items()
+    }
+    return {
+        int(code): {
+            name: data[bounds[i] : bounds[i + 1]] for name, data in values.items()
+        }
+        for i, code in enumerate(codes.tolist())
+    }
+
+
+# endregion helpers
+
+
 # region Ivan
-def shops_manufacturer(dict1: dict, dict2: dict) -> dict:
+def shops_manufacturer(dict1: dict, dict2: dict, decode: Decode) -> dict:
     """Торговые точки по регионам, которые чаще всего выводят товары из оборота
     для 1 производителя"""
-    COMPUTED_METHODS["shops_manufacturer"] = True
 
     dop_data = pd.DataFrame(dict1)
     shops = pd.DataFrame(dict2)
@@ -221,31 +302,23 @@ def shops_manufacturer(dict1: dict, dict2: dict) -> dict:
     dop_data_merged["dt"] = pd.to_datetime(dop_data_merged["dt"])
     dop_data_merged.sort_values(by=["dt"], inplace=True)
     dop_data_merged = dop_data_merged[dop_data_merged["dt"] >= "2022-01-01"]
-    tab = dop_data_merged[
-        dop_data_merged["type_operation"] == "Прочий тип вывода из оборота"
-    ]
+    tab = dop_data_merged[dop_data_merged["type_operation"] == OperationType.OTHER]
     groups = tab.groupby(["region_code", "id_sp_"]).count().reset_index()
-    shop_id = groups.sort_values(by=["dt"], ascending=False)[
-        ["region_code", "id_sp_", "dt"]
-    ]
+    shop_id = top_k_by_group(groups, "region_code", "dt", "id_sp_", 5)
 
-    global REGION_CODES
+    regions = region_codes()
 
-    for i in map(int, shop_id["region_code"].unique()):
-        data = shop_id[shop_id["region_code"] == i][:5][["id_sp_", "dt"]]
-        id = list(map(str, data["id_sp_"].values))
-        dt = list(map(int, data["dt"].values))
-        REGION_CODES[i]["shops_manufacturer"] = {
-            "id": id,  # id магазина (object)
-            "count": dt,
-        }
-        log.info("+1")
+    names = decode(shop_id["id_sp_"].unique())
+    shop_id = shop_id.assign(id=shop_id["id_sp_"].map(names))  # id магазина (object)
+    for i, data in group_lists(
+        shop_id, "region_code", {"id": "id", "count": "dt"}
+    ).items():
+        regions[i]["shops_manufacturer"] = data
 
-    return REGION_CODES
+    return regions
 
 
 def volumes_manufacturer_region(dict1, dict2):
-    COMPUTED_METHODS["volumes_manufacturer_region"] = True
     """от 0 до 1 для heatmap"""
 
     dop_data = pd.DataFrame(dict1)
@@ -262,26 +335,34 @@ def volumes_manufacturer_region(dict1, dict2):
     dop_data_region = dop_data_new.groupby(["dt", "region_code"]).sum().reset_index()
     dop_data_region["Месяц"] = dop_data_region["dt"].dt.month
     data_month_region = (
-        dop_data_region.groupby(["region_code", "Месяц"])
-        .sum()[["cnt", "sum_price"]]
+        dop_data_region.groupby(["region_code", "Месяц"])[["cnt", "sum_price"]]
+        .sum()
         .reset_index()
     )
-    data_month = (
-        dop_data_region.groupby(["Месяц"]).sum()[["cnt", "sum_price"]].reset_index()
-    )
-    sum_price1 = sum(list(map(int, data_month["sum_price"].values)))
-    cnt1 = sum(list(map(int, data_month["cnt"].values)))
-    global REGION_CODES
-    for i in map(int, data_month_region["region_code"].unique()):
-        data = data_month_region[data_month_region["region_code"] == i]
-        sum_price = list(map(int, data["sum_price"].values))
-        cnt = list(map(int, data["cnt"].values))
-        REGION_CODES[i]["cnt"] = sum(cnt)
-        REGION_CODES[i]["sum"] = sum(sum_price)
-        REGION_CODES[i]["norm_sum"] = round(sum(sum_price) / sum_price1, 7)
-        REGION_CODES[i]["cnt_norm"] = round(sum(cnt) / cnt1, 7)
-
-    df = pd.DataFrame(REGION_CODES)
+    return set_region_volumes(data_month_region)
+
+
+def set_region_volumes(volumes: pd.DataFrame) -> dict:
+    """Объемы продаж по регионам в region_codes() и их нормировка от 0 до 1 для heatmap
+
+    Args:
+        volumes (pd.DataFrame): region_code, cnt, sum_price по месяцам или
+            за весь период
+    """
+    volumes = volumes.astype({"cnt": "int64", "sum_price": "int64"})
+    sum_price1 = int(volumes["sum_price"].sum())
+    cnt1 = int(volumes["cnt"].sum())
+    totals = volumes.groupby("region_code")[["cnt", "sum_price"]].sum()
+    regions = region_codes()
+    for i, cnt, sum_price in zip(
+        map(int, totals.index), totals["cnt"].tolist(), totals["sum_price"].tolist()
+    ):
+        regions[i]["cnt"] = cnt
+        regions[i]["sum"] = sum_price
+        regions[i]["norm_sum"] = round(sum_price / sum_price1, 7)
+        regions[i]["cnt_norm"] = round(cnt / cnt1, 7)
+
+    df = pd.DataFrame(regions)
 
     df.loc["norm_sum"] = (df.loc["norm_sum"] - min(df.loc["norm_sum"])) / (
         max(df.loc["norm_sum"]) - min(df.loc["norm_sum"])
@@ -292,7 +373,6 @@ def volumes_manufacturer_region(dict1, dict2):
     df.loc["norm_sum"] = df.loc["norm_sum"].apply(lambda x: round(x, 7))
     df.loc["cnt_norm"] = df.loc["cnt_norm"].apply(lambda x: round(x, 7))
 
-    REGION_CODES = df.to_dict()
     return df.to_dict()
 
 
@@ -315,7 +395,7 @@ def volumes_manufacturer(dict1: dict, dict2: dict) -> dict:  # не нужно
     dop_data_region = dop_data_new.groupby(["dt", "region_code"]).sum().reset_index()
     dop_data_region["Месяц"] = dop_data_region["dt"].dt.month
     data_month = (
-        dop_data_region.groupby(["Месяц"]).sum()[["cnt", "sum_price"]].reset_index()
+        dop_data_region.groupby(["Месяц"])[["cnt", "sum_price"]].sum().reset_index()
     )
 
     data = data_month.copy()
@@ -332,12 +412,13 @@ def volumes_manufacturer(dict1: dict, dict2: dict) -> dict:  # не нужно
     return info
 
 
-def popular_offline_gtin_manufacturer_region(dict1: dict, dict2: dict) -> dict:
+def popular_offline_gtin_manufacturer_region(
+    dict1: dict, dict2: dict, decode: Decode
+) -> dict:
     """Самые популярные товары среди оффлайн покупателей
     для 1 производителя по регионам
     +
     """
-    COMPUTED_METHODS["popular_offline_gtin_manufacturer_region"] = True
     dop_data = pd.DataFrame(dict1)
     shops = pd.DataFrame(dict2)
     shops = shops[["id_sp_", "region_code"]]
@@ -349,29 +430,29 @@ def popular_offline_gtin_manufacturer_region(dict1: dict, dict2: dict) -> dict:
     dop_data_merged = dop_data_merged[dop_data_merged["dt"] >= "2022-01-01"]
     dop_data_merged["sum_price"] = dop_data_merged["price"] * dop_data_merged["cnt"]
     tab = dop_data_merged[
-        dop_data_merged["type_operation"]
-        == "Продажа конечному потребителю в точке продаж"
+        dop_data_merged["type_operation"] == OperationType.OFFLINE_SALE
     ]
     tab.drop(columns=["price"], inplace=True)
-    groups = tab.groupby(["region_code", "gtin"]).sum().reset_index()
-    popular = groups.sort_values(by=["cnt"], ascending=False)[
-        ["region_code", "gtin", "cnt"]
-    ]
-    global REGION_CODES
+    groups = (
+        tab.groupby(["region_code", "gtin"])[["cnt", "sum_price"]].sum().reset_index()
+    )
+    popular = top_k_by_group(groups, "region_code", "cnt", "gtin", 5)
+    regions = region_codes()
 
-    for i in map(int, popular["region_code"].unique()):
-        data = popular[popular["region_code"] == i][:5][["gtin", "cnt"]]
-        gtin = list(map(str, data["gtin"].values))
-        cnt = list(map(int, data["cnt"].values))
-        REGION_CODES[i]["popular_offline_gtin_manufacturer_region"] = {
-            "gtin": gtin,  # gtin товара
-            "count": cnt,
-        }  # кол-во товара проданного оффлайн
+    names = decode(popular["gtin"].unique())
+    popular = popular.assign(name=popular["gtin"].map(names))  # gtin товара
+    for i, data in group_lists(
+        popular, "region_code", {"gtin": "name", "count": "cnt"}
+    ).items():
+        # кол-во товара проданного оффлайн
+        regions[i]["popular_offline_gtin_manufacturer_region"] = data
 
-    return REGION_CODES
+    return regions
 
 
-def popular_offline_gtin_manufacturer(dict1: dict, dict2: dict) -> dict:
+def popular_offline_gtin_manufacturer(
+    dict1: dict, dict2: dict, decode: Decode
+) -> dict:
     """Самые популярные товары среди оффлайн покупателей
     для 1 производителя в целом
         +
@@ -389,15 +470,16 @@ def popular_offline_gtin_manufacturer(dict1: dict, dict2: dict) -> dict:
     dop_data_merged = dop_data_merged[dop_data_merged["dt"] >= "2022-01-01"]
     dop_data_merged["sum_price"] = dop_data_merged["price"] * dop_data_merged["cnt"]
     tab = dop_data_merged[
-        dop_data_merged["type_operation"]
-        == "Продажа конечному потребителю в точке продаж"
+        dop_data_merged["type_operation"] == OperationType.OFFLINE_SALE
     ]
     tab.drop(columns=["price"], inplace=True)
-    groups = tab.groupby(["gtin"]).sum().reset_index()
-    popular = groups.sort_values(by=["cnt"], ascending=False)[["gtin", "cnt"]]
+    groups = tab.groupby(["gtin"])["cnt"].sum().reset_index()
+    # при равных cnt - по возрастанию ключа gtin, как в app.core.sql_metrics
+    popular = groups.sort_values(by=["cnt", "gtin"], ascending=[False, True])
 
     data = popular[:5][["gtin", "cnt"]]
-    gtin = list(map(str, data["gtin"].values))
+    names = decode(data["gtin"].values)
+    gtin = [names[j] for j in data["gtin"].values]
     cnt = list(map(int, data["cnt"].values))
     info_popular = {
         "gtin": gtin,  # gtin товара
@@ -407,7 +489,7 @@ def popular_offline_gtin_manufacturer(dict1: dict, dict2: dict) -> dict:
     return info_popular
 
 
-def popular_online_gtin_manufacturer(dict1: dict) -> dict:
+def popular_online_gtin_manufacturer(dict1: dict, decode: Decode) -> dict:
     """Самые популярные товары среди онлайн покупателей
     для 1 производителя
     +
@@ -419,14 +501,15 @@ def popular_online_gtin_manufacturer(dict1: dict) -> dict:
     dop_data_merged.sort_values(by=["dt"], inplace=True)
     dop_data_merged = dop_data_merged[dop_data_merged["dt"] >= "2022-01-01"]
     tab = dop_data_merged[
-        dop_data_merged["type_operation"]
-        == "Дистанционная продажа конечному потребителю"
+        dop_data_merged["type_operation"] == OperationType.ONLINE_SALE
     ]
-    groups = tab.groupby(["gtin"]).sum().reset_index()
-    popular = groups.sort_values(by=["cnt"], ascending=False)[["gtin", "cnt"]]
+    groups = tab.groupby(["gtin"])["cnt"].sum().reset_index()
+    # при равных cnt - по возрастанию ключа gtin, как в app.core.sql_metrics
+    popular = groups.sort_values(by=["cnt", "gtin"], ascending=[False, True])
 
     data = popular.iloc[:10][["gtin", "cnt"]]
-    gtin = list(map(str, data["gtin"].values))
+    names = decode(data["gtin"].values)
+    gtin = [names[j] for j in data["gtin"].values]
     cnt = list(map(int, data["cnt"].values))
     info_popular = {
         "gtin": gtin,  # gtin товара
@@ -438,7 +521,6 @@ def popular_online_gtin_manufacturer(dict1: dict) -> dict:
 
 def shops_manufacturer_count_region(dict1: dict, dict2: dict) -> dict:
     """Количество торговых точек по регионам для 1 производителя"""
-    COMPUTED_METHODS["shops_manufacturer_count_region"] = True
     dop_data = pd.DataFrame(dict1)
     shops = pd.DataFrame(dict2)
     shops = shops[["id_sp_", "region_code"]]
@@ -456,20 +538,16 @@ def shops_manufacturer_count_region(dict1: dict, dict2: dict) -> dict:
     )
     count_shops = groups.groupby(["region_code", "Месяц"]).count()["cnt"].reset_index()
 
-    info_popular = dict()
-    global REGION_CODES
-    for i in map(int, count_shops["region_code"].unique()):
-        data = count_shops[count_shops["region_code"] == i][["Месяц", "cnt"]]
-        month = list(map(int, data["Месяц"].values))
-        cnt = list(map(int, data["cnt"].values))
-
-        REGION_CODES[i]["shops_manufacturer_count_region"] = {
+    regions = region_codes()
+    for i, data in group_lists(
+        count_shops, "region_code", {"month": "Месяц", "count": "cnt"}
+    ).items():
+        regions[i]["shops_manufacturer_count_region"] = {
             "region_code": i,
-            "month": month,
-            "count": cnt,
+            **data,
         }  # месяц  # кол-во магазинов
 
-    return REGION_CODES
+    return regions
 
 
 def shops_manufacturer_count(dict1: dict, dict2: dict) -> dict:
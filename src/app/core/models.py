@@ -1,10 +1,11 @@
 from typing import Optional, Any
-from datetime import datetime
-from sqlalchemy.types import String, Integer, DateTime, BigInteger
+from datetime import date, datetime
+from sqlalchemy.types import String, Integer, Date, DateTime, BigInteger
 from sqlalchemy.dialects.postgresql import BIGINT
 from sqlalchemy.dialects.postgresql import TEXT
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import ForeignKey
+from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy import ForeignKey, Index, event, text
 import numpy as np
 
 from app.core.database import Base
@@ -16,7 +17,7 @@ class User(Base):
     __tablename__ = "user"
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    username: Mapped[str] = mapped_column(String(64))
+    username: Mapped[str] = mapped_column(String(64), unique=True, index=True)
     password: Mapped[str] = mapped_column(String())
     email: Mapped[str] = mapped_column(String())
     fullname: Mapped[Optional[str]]
@@ -44,10 +45,23 @@ class Item(Base):
 
 class UserFile(Base):
     __tablename__ = "user_files"
+    # один файл с тем же содержимым на пользователя, см. app.endpoints.item.upload
+    __table_args__ = (
+        Index("ix_user_files_user_id_sha256", "user_id", "sha256", unique=True),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     filename: Mapped[str] = mapped_column(String(1024))
     path: Mapped[str] = mapped_column(String(1024))
+    sha256: Mapped[Optional[str]] = mapped_column(String(64))
+    # формат выгрузки и диапазон дат загруженных строк, см. app.utils.formats
+    format: Mapped[Optional[str]] = mapped_column(String(32))
+    dt_min: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    dt_max: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    loaded_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    # контрольная точка загрузки: смещение и строки последнего сохраненного блока
+    bytes_loaded: Mapped[int] = mapped_column(BigInteger, default=0)
+    rows_loaded: Mapped[int] = mapped_column(BigInteger, default=0)
 
     user_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
     user: Mapped["User"] = relationship("User", back_populates="files")
@@ -56,7 +70,119 @@ class UserFile(Base):
         return f"UserFile(id={self.id}, filename={self.filename}, path={self.path})"
 
 
+class JobStatus:
+    """Состояния задачи загрузки файла"""
+
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+
+class IngestionJob(Base):
+    """Задача загрузки файла пользователя в базу данных"""
+
+    __tablename__ = "ingestion_jobs"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    status: Mapped[str] = mapped_column(String(16), default=JobStatus.queued)
+    priority: Mapped[int] = mapped_column(Integer, default=0)
+    rows_done: Mapped[int] = mapped_column(BigInteger, default=0)
+    bytes_done: Mapped[int] = mapped_column(BigInteger, default=0)
+    bytes_total: Mapped[int] = mapped_column(BigInteger, default=0)
+    error: Mapped[Optional[str]] = mapped_column(TEXT)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    started_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+    file_id: Mapped[int] = mapped_column(ForeignKey("user_files.id"))
+    file: Mapped["UserFile"] = relationship("UserFile")
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
+
+    def __repr__(self) -> str:
+        return f"IngestionJob(id={self.id}, file_id={self.file_id}, status={self.status})"
+
+
 # endregion service data
+# region dimensions
+# повторяющиеся строковые значения хранятся один раз, в таблицах с данными -
+# целочисленные ключи. Исходные атрибуты (gtin, id_sp_, ...) доступны через
+# association_proxy
+
+
+class Gtin(Base):
+    """Справочник gtin товаров"""
+
+    __tablename__ = "dim_gtin"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    value: Mapped[str] = mapped_column(String(64), unique=True)
+
+
+class Prid(Base):
+    """Справочник prid"""
+
+    __tablename__ = "dim_prid"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    value: Mapped[str] = mapped_column(String(64), unique=True)
+
+
+class Inn(Base):
+    """Справочник инн участников оборота"""
+
+    __tablename__ = "dim_inn"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    value: Mapped[str] = mapped_column(String(64), unique=True)
+
+
+class SalePoint(Base):
+    """Справочник идентификаторов торговых точек"""
+
+    __tablename__ = "dim_sale_point"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    value: Mapped[str] = mapped_column(String(256), unique=True)
+
+
+class OperationType(Base):
+    """Справочник типов операций ввода и вывода из оборота
+
+    Типы, с которыми работает app.core.ml, создаются вместе с таблицей
+    с постоянными ключами.
+    """
+
+    __tablename__ = "dim_operation_type"
+
+    OTHER = 1
+    OFFLINE_SALE = 2
+    ONLINE_SALE = 3
+    KNOWN = {
+        OTHER: "Прочий тип вывода из оборота",
+        OFFLINE_SALE: "Продажа конечному потребителю в точке продаж",
+        ONLINE_SALE: "Дистанционная продажа конечному потребителю",
+    }
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    value: Mapped[str] = mapped_column(String(256), unique=True)
+
+
+@event.listens_for(OperationType.__table__, "after_create")
+def _seed_operation_types(target, connection, **kw):
+    connection.execute(
+        target.insert(),
+        [{"id": id, "value": value} for id, value in OperationType.KNOWN.items()],
+    )
+    connection.execute(
+        text(
+            "SELECT setval(pg_get_serial_sequence('dim_operation_type', 'id'), "
+            "(SELECT max(id) FROM dim_operation_type))"
+        )
+    )
+
+
+# endregion dimensions
 # region anonymised data
 
 
@@ -64,36 +190,70 @@ class ProducedGoods(Base):
     """Данные о вводе товаров в оборот с 2021-11-22 по 2022-11-21 один производитель"""
 
     __tablename__ = "produced_goods"
+    # секции по месяцам dt, см. app.core.partitions
+    __table_args__ = (
+        Index("ix_produced_goods_user_id_dt", "user_id", "dt"),
+        Index("ix_produced_goods_user_id_gtin_id", "user_id", "gtin_id"),
+        {"postgresql_partition_by": "RANGE (dt)"},
+    )
     # "dt","inn","gtin","prid","operation_type","cnt"
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    dt: Mapped[datetime] = mapped_column(DateTime)
-    inn: Mapped[str] = mapped_column(String(64))
-    gtin: Mapped[str] = mapped_column(String(64))
-    prid: Mapped[str] = mapped_column(String(64))
-    operation_type: Mapped[str] = mapped_column(String(64))
+    dt: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    inn_id: Mapped[int] = mapped_column(ForeignKey("dim_inn.id"))
+    gtin_id: Mapped[int] = mapped_column(ForeignKey("dim_gtin.id"))
+    prid_id: Mapped[int] = mapped_column(ForeignKey("dim_prid.id"))
+    operation_type_id: Mapped[int] = mapped_column(ForeignKey("dim_operation_type.id"))
     cnt: Mapped[int] = mapped_column(Integer())
     user_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
     user: Mapped["User"] = relationship("User", back_populates="produced_goods")
+    file_id: Mapped[Optional[int]] = mapped_column(ForeignKey("user_files.id"))
+
+    inn_dim: Mapped["Inn"] = relationship(lazy="joined")
+    gtin_dim: Mapped["Gtin"] = relationship(lazy="joined")
+    prid_dim: Mapped["Prid"] = relationship(lazy="joined")
+    operation_type_dim: Mapped["OperationType"] = relationship(lazy="joined")
+    inn = association_proxy("inn_dim", "value")
+    gtin = association_proxy("gtin_dim", "value")
+    prid = association_proxy("prid_dim", "value")
+    operation_type = association_proxy("operation_type_dim", "value")
 
 
 class SoldGoods(Base):
     """Данные о выводе товаров из оборота с 2021-11-22 по 2022-11-21 один производитель"""
 
     __tablename__ = "sold_goods"
+    # секции по месяцам dt, см. app.core.partitions
+    __table_args__ = (
+        Index("ix_sold_goods_user_id_dt", "user_id", "dt"),
+        Index("ix_sold_goods_user_id_gtin_id", "user_id", "gtin_id"),
+        {"postgresql_partition_by": "RANGE (dt)"},
+    )
 
     # "dt","gtin","prid","inn","id_sp_","type_operation","price","cnt"
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    dt: Mapped[datetime] = mapped_column(DateTime)
-    gtin: Mapped[str] = mapped_column(String(64))
-    prid: Mapped[str] = mapped_column(String(64))
-    inn: Mapped[str] = mapped_column(String(64))
-    id_sp_: Mapped[str] = mapped_column(String(256))
-    type_operation: Mapped[str] = mapped_column(String(64))
+    dt: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    gtin_id: Mapped[int] = mapped_column(ForeignKey("dim_gtin.id"))
+    prid_id: Mapped[int] = mapped_column(ForeignKey("dim_prid.id"))
+    inn_id: Mapped[int] = mapped_column(ForeignKey("dim_inn.id"))
+    sale_point_id: Mapped[int] = mapped_column(ForeignKey("dim_sale_point.id"))
+    type_operation_id: Mapped[int] = mapped_column(ForeignKey("dim_operation_type.id"))
     price: Mapped[int] = mapped_column(Integer())
     cnt: Mapped[int] = mapped_column(Integer())
 
     user_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
     user: Mapped["User"] = relationship("User", back_populates="sold_goods")
+    file_id: Mapped[Optional[int]] = mapped_column(ForeignKey("user_files.id"))
+
+    gtin_dim: Mapped["Gtin"] = relationship(lazy="joined")
+    prid_dim: Mapped["Prid"] = relationship(lazy="joined")
+    inn_dim: Mapped["Inn"] = relationship(lazy="joined")
+    sale_point_dim: Mapped["SalePoint"] = relationship(lazy="joined")
+    type_operation_dim: Mapped["OperationType"] = relationship(lazy="joined")
+    gtin = association_proxy("gtin_dim", "value")
+    prid = association_proxy("prid_dim", "value")
+    inn = association_proxy("inn_dim", "value")
+    id_sp_ = association_proxy("sale_point_dim", "value")
+    type_operation = association_proxy("type_operation_dim", "value")
 
     def encode(self) -> list[Any]:
         # точки сбыта
@@ -113,18 +273,33 @@ class TransportedGoods(Base):
     """Данные о перемещениях товаров между участниками с 2021-11-22 по 2022-11-21 один производитель"""
 
     __tablename__ = "transported_goods"
+    __table_args__ = (Index("ix_transported_goods_user_id_dt", "user_id", "dt"),)
 
     # "dt","gtin","prid","sender_inn","receiver_inn","cnt_moved"
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     dt: Mapped[datetime] = mapped_column(DateTime)
-    gtin: Mapped[str] = mapped_column(String(64))
-    prid: Mapped[str] = mapped_column(String(64))
-    sender_inn: Mapped[str] = mapped_column(String(64))
-    receiver_inn: Mapped[str] = mapped_column(String(64))
+    gtin_id: Mapped[int] = mapped_column(ForeignKey("dim_gtin.id"))
+    prid_id: Mapped[int] = mapped_column(ForeignKey("dim_prid.id"))
+    sender_inn_id: Mapped[int] = mapped_column(ForeignKey("dim_inn.id"))
+    receiver_inn_id: Mapped[int] = mapped_column(ForeignKey("dim_inn.id"))
     cnt_moved: Mapped[int] = mapped_column(Integer)
 
     user_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
     user: Mapped["User"] = relationship("User", back_populates="transported_goods")
+    file_id: Mapped[Optional[int]] = mapped_column(ForeignKey("user_files.id"))
+
+    gtin_dim: Mapped["Gtin"] = relationship(lazy="joined")
+    prid_dim: Mapped["Prid"] = relationship(lazy="joined")
+    sender_inn_dim: Mapped["Inn"] = relationship(
+        foreign_keys=[sender_inn_id], lazy="joined"
+    )
+    receiver_inn_dim: Mapped["Inn"] = relationship(
+        foreign_keys=[receiver_inn_id], lazy="joined"
+    )
+    gtin = association_proxy("gtin_dim", "value")
+    prid = association_proxy("prid_dim", "value")
+    sender_inn = association_proxy("sender_inn_dim", "value")
+    receiver_inn = association_proxy("receiver_inn_dim", "value")
 
 
 # endregion anonymised data
@@ -136,6 +311,7 @@ class AgrProduction(Base):
     """Агрегированные данные о вводе товаров в оборот с 2021-11-22 по 2022-11-21."""
 
     __tablename__ = "agg_produced_goods"
+    __table_args__ = (Index("ix_agg_produced_goods_user_id_dt", "user_id", "dt"),)
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     dt: Mapped[datetime] = mapped_column(DateTime)
@@ -148,6 +324,7 @@ class AgrProduction(Base):
 
     user_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
     user: Mapped["User"] = relationship("User", back_populates="agg_produced")
+    file_id: Mapped[Optional[int]] = mapped_column(ForeignKey("user_files.id"))
 
     def encode(self) -> list[Any]:
         return [
@@ -165,6 +342,7 @@ class AgrSold(Base):
     """Агрегированные данные о выводе товаров из оборота с 2021-11-22 по 2022-11-21.csv"""
 
     __tablename__ = "agg_sold_goods"
+    __table_args__ = (Index("ix_agg_sold_goods_user_id_dt", "user_id", "dt"),)
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     dt: Mapped[datetime] = mapped_column(DateTime)
@@ -179,6 +357,7 @@ class AgrSold(Base):
 
     user_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
     user: Mapped["User"] = relationship("User", back_populates="agr_sold")
+    file_id: Mapped[Optional[int]] = mapped_column(ForeignKey("user_files.id"))
 
     def encode(self) -> list[Any]:
         return [
@@ -231,13 +410,18 @@ class AddSoldGoods(Base):
     __tablename__ = "add_sold_goods"
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    id_sp_: Mapped[str] = mapped_column(String(256))
+    sale_point_id: Mapped[int] = mapped_column(
+        ForeignKey("dim_sale_point.id"), index=True
+    )
     inn: Mapped[str] = mapped_column(String(64))
     region_code: Mapped[int] = mapped_column(Integer)
     city_with_type: Mapped[str] = mapped_column(String(256), nullable=True)
     city_fias_id: Mapped[str] = mapped_column(String(256), nullable=True)
     postal_code: Mapped[int] = mapped_column(Integer, nullable=True)
 
+    sale_point_dim: Mapped["SalePoint"] = relationship(lazy="joined")
+    id_sp_ = association_proxy("sale_point_dim", "value")
+
 
 class OrganizationRegion(Base):
     """Данные о регионах пользователей"""
@@ -245,8 +429,53 @@ class OrganizationRegion(Base):
     __tablename__ = "organization_region"
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    inn: Mapped[str] = mapped_column(String(64))
+    inn: Mapped[str] = mapped_column(String(64), index=True)
     region_code: Mapped[int] = mapped_column(Integer)
 
 
 # endregion
+
+
+# region rollups
+# суммы sold_goods по дням, пересчитываются после загрузки файлов, см.
+# app.core.rollups. region_code - регион торговой точки из add_sold_goods,
+# NULL для точек без региона
+
+
+class SoldGoodsDaily(Base):
+    """Продажи по дням, регионам, товарам и типам операций"""
+
+    __tablename__ = "rollup_sold_goods_daily"
+    __table_args__ = (Index("ix_rollup_sold_goods_daily_user_id_dt", "user_id", "dt"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
+    dt: Mapped[date] = mapped_column(Date)
+    region_code: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    gtin_id: Mapped[int] = mapped_column(ForeignKey("dim_gtin.id"))
+    type_operation_id: Mapped[int] = mapped_column(ForeignKey("dim_operation_type.id"))
+    rows: Mapped[int] = mapped_column(BigInteger)
+    cnt: Mapped[int] = mapped_column(BigInteger)
+    sum_price: Mapped[int] = mapped_column(BigInteger)  # сумма price * cnt
+    sale_points: Mapped[int] = mapped_column(Integer)  # различных торговых точек
+
+
+class SoldGoodsSalePointDaily(Base):
+    """Продажи по дням, регионам, торговым точкам и типам операций"""
+
+    __tablename__ = "rollup_sold_goods_sale_point_daily"
+    __table_args__ = (
+        Index("ix_rollup_sold_goods_sale_point_daily_user_id_dt", "user_id", "dt"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
+    dt: Mapped[date] = mapped_column(Date)
+    region_code: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    sale_point_id: Mapped[int] = mapped_column(ForeignKey("dim_sale_point.id"))
+    type_operation_id: Mapped[int] = mapped_column(ForeignKey("dim_operation_type.id"))
+    rows: Mapped[int] = mapped_column(BigInteger)
+    cnt: Mapped[int] = mapped_column(BigInteger)
+
+
+# endregion
@@ -0,0 +1,184 @@
+import time
+from datetime import date, datetime
+from threading import Lock
+from typing import Iterable, Union
+
+from psycopg2 import errorcodes
+from sqlalchemy import Connection, Engine, Table, text
+from sqlalchemy.exc import OperationalError
+
+from app.core.settings import settings
+from app.utils.logging import log
+
+
+# region partitions
+# sold_goods и produced_goods разбиты на месячные секции по dt
+# (__table_args__ с postgresql_partition_by в app.core.models), поэтому запросы
+# с условием по датам читают только нужные секции. Секции создаются перед
+# записью строк за новый месяц, см. ensure_partitions, и заранее при старте
+# приложения, см. create_upcoming_partitions
+
+
+def is_partitioned(table: Table) -> bool:
+    return bool(table.dialect_options["postgresql"].get("partition_by"))
+
+
+def months(dt_min: Union[date, datetime], dt_max: Union[date, datetime]) -> list[date]:
+    """Первые дни месяцев, в которые попадают даты от dt_min до dt_max"""
+    month = date(dt_min.year, dt_min.month, 1)
+    last = date(dt_max.year, dt_max.month, 1)
+    result = []
+    while month <= last:
+        result.append(month)
+        month = _next_month(month)
+    return result
+
+
+def _next_month(month: date) -> date:
+    if month.month == 12:
+        return date(month.year + 1, 1, 1)
+    return date(month.year, month.month + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_{month:%Y_%m}"
+
+
+def create_partitions(
+    conn: Connection,
+    table: str,
+    dt_min: Union[date, datetime],
+    dt_max: Union[date, datetime],
+) -> list[str]:
+    """Создает отсутствующие месячные секции таблицы table для дат dt_min - dt_max
+
+    Секции одной таблицы создаются под advisory блокировкой, чтобы
+    параллельные загрузки не создавали одну секцию одновременно.
+
+    Returns:
+        list[str]: имена секций
+    """
+    conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:table))"), {"table": table})
+    names = []
+    for month in months(dt_min, dt_max):
+        name = partition_name(table, month)
+        conn.execute(
+            text(
+                f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{table}" '
+                f"FOR VALUES FROM ('{month:%Y-%m-%d}') "
+                f"TO ('{_next_month(month):%Y-%m-%d}')"
+            )
+        )
+        names.append(name)
+    return names
+
+
+_known: set[tuple[str, date]] = set()
+_known_lock = Lock()
+
+
+def ensure_partitions(
+    engine: Engine,
+    table: str,
+    dt_min: Union[date, datetime],
+    dt_max: Union[date, datetime],
+):
+    """Создает секции для дат dt_min - dt_max, если их еще нет
+
+    Секции создаются в отдельной короткой транзакции: CREATE TABLE ... PARTITION OF
+    блокирует основную таблицу, и транзакция загрузки не должна держать эту
+    блокировку до конца блока. Блокировка ждется не дольше
+    settings.PARTITION_LOCK_TIMEOUT: ожидающий ACCESS EXCLUSIVE встает в очередь
+    перед всеми чтениями таблицы, поэтому за долгим запросом (выгрузкой) он
+    уступает и повторяет попытку позже. Уже созданные секции запоминаются в
+    процессе.
+
+    Соединение вызывающего кода не должно держать блокировок основной таблицы
+    и таблиц ее внешних ключей (справочников), иначе создание секции ждет
+    транзакцию, которая сама ждет секцию.
+
+    Raises:
+        OperationalError: блокировка не получена за PARTITION_LOCK_RETRIES
+            повторов
+    """
+    missing = [
+        month for month in months(dt_min, dt_max) if (table, month) not in _known
+    ]
+    if not missing:
+        return
+    for attempt in range(settings.PARTITION_LOCK_RETRIES + 1):
+        try:
+            with engine.begin() as conn:
+                conn.execute(
+                    text(f"SET LOCAL lock_timeout = {settings.PARTITION_LOCK_TIMEOUT}")
+                )
+                create_partitions(conn, table, missing[0], missing[-1])
+            break
+        except OperationalError as ex:
+            locked = getattr(ex.orig, "pgcode", None) == errorcodes.LOCK_NOT_AVAILABLE
+            if not locked or attempt == settings.PARTITION_LOCK_RETRIES:
+                raise
+            delay = min(2**attempt, 30)
+            log.warning(f"{table}: partitions are locked, retrying in {delay} seconds")
+            time.sleep(delay)
+    log.info(
+        f"{table}: partitions {partition_name(table, missing[0])} - "
+        f"{partition_name(table, missing[-1])} are ready"
+    )
+    with _known_lock:
+        _known.update((table, month) for month in missing)
+
+
+def create_upcoming_partitions(
+    engine: Engine, tables: Iterable[str], months_ahead: int
+):
+    """Создает секции tables с текущего месяца на months_ahead месяцев вперед"""
+    first = last = date.today().replace(day=1)
+    for _ in range(months_ahead):
+        last = _next_month(last)
+    for table in tables:
+        ensure_partitions(engine, table, first, last)
+
+
+def partition_table(conn: Connection, table: str):
+    """Переносит строки обычной таблицы table в секционированную по месяцам dt
+
+    Таблица пересоздается с первичным ключом (id, dt), внешние ключи и
+    последовательность id переносятся, строки копируются в секции одним
+    INSERT ... SELECT. Индексы создаются после переноса.
+    """
+    old = f"{table}_unpartitioned"
+    conn.execute(text(f'ALTER TABLE "{table}" RENAME TO "{old}"'))
+    conn.execute(
+        text(f'ALTER TABLE "{old}" RENAME CONSTRAINT "{table}_pkey" TO "{old}_pkey"')
+    )
+    conn.execute(
+        text(
+            f'CREATE TABLE "{table}" (LIKE "{old}" INCLUDING DEFAULTS, '
+            "PRIMARY KEY (id, dt)) PARTITION BY RANGE (dt)"
+        )
+    )
+    foreign_keys = conn.execute(
+        text(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = CAST(:table AS regclass) AND contype = 'f'"
+        ),
+        {"table": old},
+    ).all()
+    for name, definition in foreign_keys:
+        conn.execute(text(f'ALTER TABLE "{table}" ADD CONSTRAINT "{name}" {definition}'))
+    sequence = conn.execute(
+        text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": old}
+    ).scalar_one()
+    if sequence:
+        conn.execute(text(f'ALTER SEQUENCE {sequence} OWNED BY "{table}".id'))
+
+    dt_min, dt_max = conn.execute(text(f'SELECT min(dt), max(dt) FROM "{old}"')).one()
+    if dt_min is not None:
+        create_partitions(conn, table, dt_min, dt_max)
+    moved = conn.execute(text(f'INSERT INTO "{table}" SELECT * FROM "{old}"')).rowcount
+    conn.execute(text(f'DROP TABLE "{old}"'))
+    log.info(f"{table}: moved {moved} rows into monthly partitions")
+
+
+# endregion partitions
@@ -0,0 +1,90 @@
+from threading import Lock
+from time import perf_counter
+from typing import Any
+
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from app.utils.logging import log
+
+# получение соединения дольше этого времени считается ожиданием свободного соединения
+SLOW_CHECKOUT_SECONDS = 0.1
+
+
+class PoolStats:
+    """Счетчики получения соединений из пула"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.checkouts = 0
+        self.slow_checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait: float):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            if wait >= SLOW_CHECKOUT_SECONDS:
+                self.slow_checkouts += 1
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+
+class _InstrumentedPool:
+    """Считает время получения соединения и ошибки QueuePool limit"""
+
+    stats: PoolStats
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def connect(self):
+        start = perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            self.stats.record_timeout()
+            log.warning(f"connection pool exhausted: {self.status()}")
+            raise
+        self.stats.record(perf_counter() - start)
+        return connection
+
+
+class InstrumentedQueuePool(_InstrumentedPool, QueuePool):
+    pass
+
+
+class InstrumentedAsyncPool(_InstrumentedPool, AsyncAdaptedQueuePool):
+    pass
+
+
+def pool_metrics(pool: Any) -> dict[str, Any]:
+    """Текущее состояние пула и накопленные счетчики
+
+    Returns:
+        dict[str, Any]: size - постоянные соединения, checked_out - выданные
+            соединения, overflow - соединения сверх size, wait_* - время
+            получения соединения в секундах
+    """
+    metrics: dict[str, Any] = {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+    }
+    stats = getattr(pool, "stats", None)
+    if stats is not None:
+        metrics.update(
+            checkouts=stats.checkouts,
+            slow_checkouts=stats.slow_checkouts,
+            timeouts=stats.timeouts,
+            wait_avg=stats.wait_total / stats.checkouts if stats.checkouts else 0.0,
+            wait_max=stats.wait_max,
+        )
+    return metrics
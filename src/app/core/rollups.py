@@ -0,0 +1,205 @@
+"""Витрины продаж по дням для метрик app.core.sql_metrics
+
+SoldGoodsDaily хранит суммы по (пользователь, день, регион, gtin, тип
+операции), SoldGoodsSalePointDaily - по (пользователь, день, регион,
+торговая точка, тип операции). Метрики читают тысячи строк витрин вместо
+миллионов строк sold_goods.
+
+После загрузки продаж витрины пользователя пересчитываются за дни файла
+(refresh), после загрузки торговых точек меняются регионы, и витрины
+пересчитываются полностью (rebuild).
+
+Пересчет удаляет строки витрин и заново добавляет суммы, поэтому параллельные
+пересчеты одного пользователя выполняются по очереди под advisory
+блокировками, см. _lock.
+"""
+from datetime import date, datetime, time, timedelta
+from time import perf_counter
+from typing import Any, Optional, Union
+
+from sqlalchemy import (
+    BigInteger,
+    Connection,
+    Date,
+    Select,
+    cast,
+    delete,
+    distinct,
+    func,
+    insert,
+    select,
+    text,
+)
+from sqlalchemy.orm import Session
+
+from app.core.models import (
+    AddSoldGoods,
+    SoldGoods,
+    SoldGoodsDaily,
+    SoldGoodsSalePointDaily,
+)
+from app.utils.logging import log
+
+_day = cast(SoldGoods.dt, Date)
+
+# первый ключ advisory блокировок витрин, второй - id пользователя или 0 для
+# всех пользователей
+_LOCK_KEY = "rollups"
+
+
+def _lock(db: Union[Session, Connection], user_id: Optional[int]):
+    """Блокировка витрин пользователя user_id или всех пользователей до конца транзакции
+
+    Пересчет одного пользователя держит разделяемую блокировку всех
+    пользователей, поэтому ждет полного пересчета и не мешает пересчетам
+    других пользователей.
+    """
+    if user_id is None:
+        db.execute(
+            text("SELECT pg_advisory_xact_lock(hashtext(:key), 0)"), {"key": _LOCK_KEY}
+        )
+        return
+    db.execute(
+        text("SELECT pg_advisory_xact_lock_shared(hashtext(:key), 0)"),
+        {"key": _LOCK_KEY},
+    )
+    db.execute(
+        text("SELECT pg_advisory_xact_lock(hashtext(:key), :user_id)"),
+        {"key": _LOCK_KEY, "user_id": user_id},
+    )
+
+
+def _sold_goods(columns: list[Any], conditions: tuple[Any, ...]) -> Select:
+    """Выборка columns из строк sold_goods с регионом торговой точки"""
+    return (
+        select(*columns)
+        .select_from(SoldGoods)
+        .outerjoin(AddSoldGoods, AddSoldGoods.sale_point_id == SoldGoods.sale_point_id)
+        .where(*conditions)
+    )
+
+
+def _fill(db: Union[Session, Connection], *conditions: Any) -> tuple[int, int]:
+    """Добавляет в витрины суммы по строкам sold_goods, подходящим под conditions
+
+    Returns:
+        tuple[int, int]: количество строк SoldGoodsDaily и
+            SoldGoodsSalePointDaily
+    """
+    daily = db.execute(
+        insert(SoldGoodsDaily).from_select(
+            [
+                "user_id",
+                "dt",
+                "region_code",
+                "gtin_id",
+                "type_operation_id",
+                "rows",
+                "cnt",
+                "sum_price",
+                "sale_points",
+            ],
+            _sold_goods(
+                [
+                    SoldGoods.user_id,
+                    _day,
+                    AddSoldGoods.region_code,
+                    SoldGoods.gtin_id,
+                    SoldGoods.type_operation_id,
+                    func.count(),
+                    func.sum(SoldGoods.cnt),
+                    func.sum(cast(SoldGoods.price, BigInteger) * SoldGoods.cnt),
+                    func.count(distinct(SoldGoods.sale_point_id)),
+                ],
+                conditions,
+            ).group_by(
+                SoldGoods.user_id,
+                _day,
+                AddSoldGoods.region_code,
+                SoldGoods.gtin_id,
+                SoldGoods.type_operation_id,
+            ),
+        )
+    ).rowcount
+    sale_points = db.execute(
+        insert(SoldGoodsSalePointDaily).from_select(
+            [
+                "user_id",
+                "dt",
+                "region_code",
+                "sale_point_id",
+                "type_operation_id",
+                "rows",
+                "cnt",
+            ],
+            _sold_goods(
+                [
+                    SoldGoods.user_id,
+                    _day,
+                    AddSoldGoods.region_code,
+                    SoldGoods.sale_point_id,
+                    SoldGoods.type_operation_id,
+                    func.count(),
+                    func.sum(SoldGoods.cnt),
+                ],
+                conditions,
+            ).group_by(
+                SoldGoods.user_id,
+                _day,
+                AddSoldGoods.region_code,
+                SoldGoods.sale_point_id,
+                SoldGoods.type_operation_id,
+            ),
+        )
+    ).rowcount
+    return daily, sale_points
+
+
+def refresh(
+    db: Union[Session, Connection],
+    user_id: int,
+    dt_min: Union[date, datetime],
+    dt_max: Union[date, datetime],
+):
+    """Пересчитывает витрины пользователя user_id за дни от dt_min до dt_max
+
+    Выполняется в транзакции db вместе с загрузкой, поэтому витрины
+    меняются одновременно со строками sold_goods.
+    """
+    start = perf_counter()
+    _lock(db, user_id)
+    day_min = date(dt_min.year, dt_min.month, dt_min.day)
+    day_max = date(dt_max.year, dt_max.month, dt_max.day)
+    for model in (SoldGoodsDaily, SoldGoodsSalePointDaily):
+        db.execute(
+            delete(model).where(
+                model.user_id == user_id, model.dt.between(day_min, day_max)
+            )
+        )
+    daily, sale_points = _fill(
+        db,
+        SoldGoods.user_id == user_id,
+        SoldGoods.dt >= datetime.combine(day_min, time()),
+        SoldGoods.dt < datetime.combine(day_max + timedelta(days=1), time()),
+    )
+    log.info(
+        f"user {user_id}: refreshed rollups from {day_min} to {day_max} "
+        f"({daily} + {sale_points} rows) in {perf_counter() - start:.2f} seconds"
+    )
+
+
+def rebuild(db: Union[Session, Connection], user_id: Optional[int] = None):
+    """Пересчитывает витрины пользователя user_id или всех пользователей"""
+    start = perf_counter()
+    _lock(db, user_id)
+    conditions = [] if user_id is None else [SoldGoods.user_id == user_id]
+    for model in (SoldGoodsDaily, SoldGoodsSalePointDaily):
+        statement = delete(model)
+        if user_id is not None:
+            statement = statement.where(model.user_id == user_id)
+        db.execute(statement)
+    daily, sale_points = _fill(db, *conditions)
+    log.info(
+        f"rebuilt rollups ({daily} + {sale_points} rows) "
+        f"in {perf_counter() - start:.2f} seconds"
+    )
@@ -1,9 +1,16 @@
-from typing import Union
+from typing import Optional, Union
 from datetime import datetime
 
 from pydantic import BaseModel, PrivateAttr, Field
 
-from app.core.models import User, Item, ProducedGoods, SoldGoods, TransportedGoods
+from app.core.models import (
+    User,
+    Item,
+    ProducedGoods,
+    SoldGoods,
+    TransportedGoods,
+    IngestionJob,
+)
 
 # region User
 class UserSchema(BaseModel):
@@ -47,6 +54,8 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     username: Union[str, None] = None
+    # время истечения токена, unix time
+    exp: Union[int, None] = None
 
 
 # endregion Token
@@ -68,6 +77,8 @@ class ProducedGoodsSchema(BaseModel):
 
 class ListProducedGoodsSchema(BaseModel):
     items: list[ProducedGoodsSchema]
+    # курсор следующей страницы, None на последней странице
+    next_cursor: Optional[str] = None
 
 
 class SoldGoodsSchema(BaseModel):
@@ -87,6 +98,8 @@ class SoldGoodsSchema(BaseModel):
 
 class ListSoldGoodsSchema(BaseModel):
     items: list[SoldGoodsSchema]
+    # курсор следующей страницы, None на последней странице
+    next_cursor: Optional[str] = None
 
 
 class TransportedGoodsSchema(BaseModel):
@@ -114,6 +127,74 @@ class AgrProducedGoodsSchema(BaseModel):
 # endregion Goods
 
 
+# region ingestion jobs
+
+
+class IngestionJobSchema(BaseModel):
+    id: int = Field(...)
+    file_id: int = Field(...)
+    status: str = Field(...)
+    priority: int = Field(...)
+    rows_done: int = Field(...)
+    bytes_done: int = Field(...)
+    bytes_total: int = Field(...)
+    rows_per_second: Optional[float] = None
+    eta_seconds: Optional[float] = None
+    error: Optional[str] = None
+    created_at: datetime = Field(...)
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
+
+    @classmethod
+    def from_job(cls, job: IngestionJob) -> "IngestionJobSchema":
+        """Состояние задачи со скоростью загрузки и оценкой оставшегося времени"""
+        schema = cls.from_orm(job)
+        if job.started_at is None:
+            return schema
+        finished_at = job.finished_at or datetime.utcnow()
+        elapsed = (finished_at - job.started_at).total_seconds()
+        if elapsed > 0 and job.rows_done:
+            schema.rows_per_second = round(job.rows_done / elapsed, 1)
+        if job.finished_at is None and job.bytes_done and job.bytes_total:
+            bytes_per_second = job.bytes_done / elapsed
+            schema.eta_seconds = round(
+                (job.bytes_total - job.bytes_done) / bytes_per_second, 1
+            )
+        return schema
+
+
+# endregion ingestion jobs
+
+
+# region metrics
+
+
+class PoolMetricsSchema(BaseModel):
+    size: int = Field(...)
+    checked_out: int = Field(...)
+    checked_in: int = Field(...)
+    overflow: int = Field(...)
+    checkouts: int = 0
+    slow_checkouts: int = 0
+    timeouts: int = 0
+    wait_avg: float = 0.0
+    wait_max: float = 0.0
+
+
+class CacheMetricsSchema(BaseModel):
+    size: int = Field(...)
+    bytes: int = Field(...)
+    hits: int = Field(...)
+    misses: int = Field(...)
+    evictions: int = Field(...)
+
+
+# endregion metrics
+
+
 # region mapPoint
 
 
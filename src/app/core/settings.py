@@ -51,9 +51,98 @@ class Settings(BaseSettings):
         return v
 
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
+    # проверенные токены запоминаются в процессе на AUTH_CACHE_TTL секунд,
+    # но не дольше срока действия токена. 0 - не кэшировать
+    AUTH_CACHE_TTL: float = 60
+    AUTH_CACHE_SIZE: int = 10000
     STATIC_FILE_URL: str = "static/{username}_{filename}"
     PIPELINE_PATH: str = r"app/pipeline/pipe.zip"
 
+    # region database pool
+    # настройки применяются к синхронному (загрузка файлов) и асинхронному
+    # (эндпоинты) движкам, состояние пулов - GET /metrics/pool
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30
+    DB_POOL_RECYCLE: int = 1800
+    # statement_timeout в миллисекундах для запросов эндпоинтов, 0 - без ограничения.
+    # Загрузка файлов и миграции выполняются без ограничения
+    DB_STATEMENT_TIMEOUT: int = 0
+    # размер кэша подготовленных на сервере запросов asyncpg, 0 - не использовать
+    # подготовленные запросы (например, за pgbouncer в режиме transaction)
+    DB_PREPARED_STATEMENT_CACHE_SIZE: int = 100
+
+    # endregion database pool
+
+    # region ingestion
+    UPLOAD_METHOD: str = "copy"
+    UPLOAD_BLOCK_SIZE: int = 16 * 1024 * 1024
+    UPLOAD_WORKERS: int = 1
+    INGEST_WORKERS: int = 2
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024
+    UPLOAD_MAX_SIZE: int = 10 * 1024 * 1024 * 1024
+    # что делать со строками, даты которых пересекаются с уже загруженными файлами
+    # того же пользователя и формата: replace - заменить, skip - пропустить,
+    # append - загрузить как есть
+    UPLOAD_OVERLAP_POLICY: str = "replace"
+    # месячные секции sold_goods и produced_goods создаются при старте на
+    # PARTITION_MONTHS_AHEAD месяцев вперед, поэтому загрузки редко выполняют DDL.
+    # CREATE TABLE ... PARTITION OF при загрузке ждет блокировку не дольше
+    # PARTITION_LOCK_TIMEOUT мс (например, пока идет выгрузка /goods/*/export)
+    # и повторяется PARTITION_LOCK_RETRIES раз
+    PARTITION_MONTHS_AHEAD: int = 3
+    PARTITION_LOCK_TIMEOUT: int = 2000
+    PARTITION_LOCK_RETRIES: int = 5
+
+    @validator("UPLOAD_METHOD")
+    def check_upload_method(cls, v: str) -> str:
+        if v not in ("copy", "staging", "orm"):
+            raise ValueError(
+                f"Unsupported upload method {v}, use one of: copy, staging, orm"
+            )
+        return v
+
+    @validator("UPLOAD_OVERLAP_POLICY")
+    def check_overlap_policy(cls, v: str) -> str:
+        if v not in ("replace", "skip", "append"):
+            raise ValueError(
+                f"Unsupported overlap policy {v}, use one of: replace, skip, append"
+            )
+        return v
+
+    # endregion ingestion
+
+    # region goods
+    # размер страницы /goods/produced и /goods/sold по умолчанию и максимальный
+    GOODS_PAGE_SIZE: int = 100
+    GOODS_MAX_PAGE_SIZE: int = 10000
+    # строк в одной пачке серверного курсора выгрузки /goods/*/export
+    EXPORT_BATCH_SIZE: int = 10000
+
+    # endregion goods
+
+    # region ml
+    # где считаются метрики /ml и /map: sql - запросами к дневным витринам
+    # (app.core.sql_metrics, app.core.rollups), pandas - в приложении по всем строкам (app.core.ml)
+    ML_BACKEND: str = "sql"
+    # результаты метрик кэшируются по пользователю и версии его данных,
+    # см. app.core.metric_cache
+    METRIC_CACHE_TTL: float = 3600
+    METRIC_CACHE_SIZE: int = 1000
+    METRIC_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    # подготовленные продажи пользователей для ML_BACKEND=pandas, по ним
+    # считаются метрики за любое окно дат, см. app.core.analytics
+    ANALYTICS_CACHE_SIZE: int = 16
+    ANALYTICS_CACHE_MAX_BYTES: int = 1024 * 1024 * 1024
+
+    @validator("ML_BACKEND")
+    def check_ml_backend(cls, v: str) -> str:
+        if v not in ("sql", "pandas"):
+            raise ValueError(f"Unsupported ml backend {v}, use one of: sql, pandas")
+        return v
+
+    # endregion ml
+
     class Config:
         case_sensitive = True
         env_file = ".env"
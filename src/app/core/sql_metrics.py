@@ -0,0 +1,368 @@
+"""Метрики app.core.ml, посчитанные в базе
+
+Метрики считаются по дневным витринам app.core.rollups, группировка и выбор
+лучших записей (row_number по регионам) выполняются запросом, из базы
+приходят только строки результата, а не все продажи пользователя. Результаты
+совпадают с pandas реализациями в app.core.ml, те остаются эталоном.
+Используется при settings.ML_BACKEND == "sql".
+
+Все метрики принимают окно дат date_from - date_to (date_to не включается),
+метрики по месяцам - еще и granularity: без нее периоды - номера месяцев, как
+в app.core.ml, иначе - дни, недели, месяцы или кварталы (date_trunc).
+"""
+from datetime import date
+from typing import Any, Optional
+
+import pandas as pd
+from sqlalchemy import Date, DateTime, cast, distinct, extract, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import ml
+from app.core.models import (
+    Gtin,
+    OperationType,
+    SalePoint,
+    SoldGoodsDaily,
+    SoldGoodsSalePointDaily,
+    User,
+)
+
+# метрики считаются по продажам начиная с этих дат, как в app.core.ml
+SINCE = date(2022, 1, 1)
+REGION_VOLUMES_SINCE = date(2022, 9, 1)
+# детализация метрик по периодам, поля date_trunc
+GRANULARITIES = ("day", "week", "month", "quarter")
+
+# region helpers
+
+
+def _rollup(
+    rollup: Any,
+    user: User,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    with_region: bool = False,
+    since: date = SINCE,
+) -> list[Any]:
+    """Условия на строки витрины rollup за окно date_from - date_to (по умолчанию
+    с since), with_region - только точки с регионом"""
+    conditions = [rollup.user_id == user.id, rollup.dt >= (date_from or since)]
+    if date_to is not None:
+        conditions.append(rollup.dt < date_to)
+    if with_region:
+        conditions.append(rollup.region_code.is_not(None))
+    return conditions
+
+
+def _period(rollup: Any, granularity: Optional[str]) -> Any:
+    """Период строки витрины: номер месяца без granularity, иначе дата начала
+    периода granularity"""
+    if granularity is None:
+        return extract("month", rollup.dt)
+    return cast(func.date_trunc(granularity, cast(rollup.dt, DateTime)), Date)
+
+
+def _period_name(granularity: Optional[str]) -> str:
+    """Ключ периодов в ответе: month - номера месяцев, period - даты ISO"""
+    return "month" if granularity is None else "period"
+
+
+def _period_value(value: Any, granularity: Optional[str]) -> Any:
+    return int(value) if granularity is None else value.isoformat()
+
+
+async def _top_by_region(
+    db: AsyncSession,
+    user: User,
+    rollup: Any,
+    key: Any,
+    dim: Any,
+    value: Any,
+    type_operation: int,
+    limit: int,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+) -> dict[int, tuple[list[str], list[int]]]:
+    """Первые limit ключей key витрины rollup по убыванию value в каждом регионе
+
+    Returns:
+        dict[int, tuple[list[str], list[int]]]: регион -> (значения справочника
+            dim, значения value)
+    """
+    groups = (
+        select(
+            rollup.region_code,
+            key.label("key"),
+            value.label("value"),
+            func.row_number()
+            .over(partition_by=rollup.region_code, order_by=(value.desc(), key))
+            .label("rank"),
+        )
+        .where(
+            *_rollup(rollup, user, date_from, date_to, with_region=True),
+            rollup.type_operation_id == type_operation,
+        )
+        .group_by(rollup.region_code, key)
+        .subquery()
+    )
+    rows = await db.execute(
+        select(groups.c.region_code, dim.value, groups.c.value)
+        .join(dim, dim.id == groups.c.key)
+        .where(groups.c.rank <= limit)
+        .order_by(groups.c.region_code, groups.c.rank)
+    )
+    result: dict[int, tuple[list[str], list[int]]] = {}
+    for region_code, name, total in rows:
+        names, totals = result.setdefault(int(region_code), ([], []))
+        names.append(name)
+        totals.append(int(total))
+    return result
+
+
+async def _top_gtin(
+    db: AsyncSession,
+    user: User,
+    type_operation: int,
+    limit: int,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+) -> dict:
+    groups = (
+        select(
+            SoldGoodsDaily.gtin_id.label("key"),
+            func.sum(SoldGoodsDaily.cnt).label("value"),
+        )
+        .where(
+            *_rollup(SoldGoodsDaily, user, date_from, date_to),
+            SoldGoodsDaily.type_operation_id == type_operation,
+        )
+        .group_by(SoldGoodsDaily.gtin_id)
+        .order_by(func.sum(SoldGoodsDaily.cnt).desc(), SoldGoodsDaily.gtin_id)
+        .limit(limit)
+        .subquery()
+    )
+    rows = (
+        await db.execute(
+            select(Gtin.value, groups.c.value)
+            .join(Gtin, Gtin.id == groups.c.key)
+            .order_by(groups.c.value.desc(), groups.c.key)
+        )
+    ).all()
+    return {
+        "gtin": [name for name, _ in rows],  # gtin товара
+        "count": [int(total) for _, total in rows],
+    }
+
+
+# endregion helpers
+
+
+async def shops_manufacturer(
+    db: AsyncSession,
+    user: User,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    granularity: Optional[str] = None,
+) -> dict:
+    """Торговые точки по регионам, которые чаще всего выводят товары из оборота
+    для 1 производителя, см. ml.shops_manufacturer"""
+    top = await _top_by_region(
+        db,
+        user,
+        SoldGoodsSalePointDaily,
+        SoldGoodsSalePointDaily.sale_point_id,
+        SalePoint,
+        func.sum(SoldGoodsSalePointDaily.rows),
+        OperationType.OTHER,
+        5,
+        date_from,
+        date_to,
+    )
+    regions = ml.region_codes()
+    for region_code, (names, counts) in top.items():
+        regions[region_code]["shops_manufacturer"] = {
+            "id": names,  # id магазина (object)
+            "count": counts,
+        }
+    return regions
+
+
+async def volumes_manufacturer_region(
+    db: AsyncSession,
+    user: User,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    granularity: Optional[str] = None,
+) -> dict:
+    """Объемы продаж по регионам, см. ml.volumes_manufacturer_region"""
+    rows = (
+        await db.execute(
+            select(
+                SoldGoodsDaily.region_code,
+                func.sum(SoldGoodsDaily.cnt),
+                func.sum(SoldGoodsDaily.sum_price),
+            )
+            .where(
+                *_rollup(
+                    SoldGoodsDaily,
+                    user,
+                    date_from,
+                    date_to,
+                    with_region=True,
+                    since=REGION_VOLUMES_SINCE,
+                )
+            )
+            .group_by(SoldGoodsDaily.region_code)
+        )
+    ).all()
+    return ml.set_region_volumes(
+        pd.DataFrame(rows, columns=["region_code", "cnt", "sum_price"])
+    )
+
+
+async def volumes_manufacturer(
+    db: AsyncSession,
+    user: User,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    granularity: Optional[str] = None,
+) -> dict:
+    """Количество единиц товара и стоимость всего проданного товара для 1
+    производителя по месяцам, см. ml.volumes_manufacturer"""
+    period = _period(SoldGoodsDaily, granularity)
+    rows = (
+        await db.execute(
+            select(
+                period, func.sum(SoldGoodsDaily.cnt), func.sum(SoldGoodsDaily.sum_price)
+            )
+            .where(*_rollup(SoldGoodsDaily, user, date_from, date_to, with_region=True))
+            .group_by(period)
+            .order_by(period)
+        )
+    ).all()
+    return {
+        _period_name(granularity): [
+            _period_value(period, granularity) for period, _, _ in rows
+        ],  # месяц или начало периода
+        "count": [int(cnt) for _, cnt, _ in rows],  # кол-во выведенного из оборота товара
+        "sum_price": [int(sum_price) for _, _, sum_price in rows],
+    }  # суммарная цена товаров
+
+
+async def popular_offline_gtin_manufacturer_region(
+    db: AsyncSession,
+    user: User,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    granularity: Optional[str] = None,
+) -> dict:
+    """Самые популярные товары среди оффлайн покупателей для 1 производителя
+    по регионам, см. ml.popular_offline_gtin_manufacturer_region"""
+    top = await _top_by_region(
+        db,
+        user,
+        SoldGoodsDaily,
+        SoldGoodsDaily.gtin_id,
+        Gtin,
+        func.sum(SoldGoodsDaily.cnt),
+        OperationType.OFFLINE_SALE,
+        5,
+        date_from,
+        date_to,
+    )
+    regions = ml.region_codes()
+    for region_code, (names, counts) in top.items():
+        regions[region_code]["popular_offline_gtin_manufacturer_region"] = {
+            "gtin": names,  # gtin товара
+            "count": counts,
+        }  # кол-во товара проданного оффлайн
+    return regions
+
+
+async def popular_offline_gtin_manufacturer(
+    db: AsyncSession,
+    user: User,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    granularity: Optional[str] = None,
+) -> dict:
+    """Самые популярные товары среди оффлайн покупателей для 1 производителя
+    в целом, см. ml.popular_offline_gtin_manufacturer"""
+    return await _top_gtin(db, user, OperationType.OFFLINE_SALE, 5, date_from, date_to)
+
+
+async def popular_online_gtin_manufacturer(
+    db: AsyncSession,
+    user: User,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    granularity: Optional[str] = None,
+) -> dict:
+    """Самые популярные товары среди онлайн покупателей для 1 производителя,
+    см. ml.popular_online_gtin_manufacturer"""
+    return await _top_gtin(db, user, OperationType.ONLINE_SALE, 10, date_from, date_to)
+
+
+async def shops_manufacturer_count_region(
+    db: AsyncSession,
+    user: User,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    granularity: Optional[str] = None,
+) -> dict:
+    """Количество торговых точек по регионам и месяцам для 1 производителя,
+    см. ml.shops_manufacturer_count_region"""
+    period = _period(SoldGoodsSalePointDaily, granularity)
+    name = _period_name(granularity)
+    rows = await db.execute(
+        select(
+            SoldGoodsSalePointDaily.region_code,
+            period,
+            func.count(distinct(SoldGoodsSalePointDaily.sale_point_id)),
+        )
+        .where(
+            *_rollup(
+                SoldGoodsSalePointDaily, user, date_from, date_to, with_region=True
+            )
+        )
+        .group_by(SoldGoodsSalePointDaily.region_code, period)
+        .order_by(SoldGoodsSalePointDaily.region_code, period)
+    )
+    counts: dict[int, dict] = {}
+    for region_code, period, count in rows:
+        region = counts.setdefault(
+            int(region_code),
+            {"region_code": int(region_code), name: [], "count": []},
+        )
+        region[name].append(_period_value(period, granularity))  # месяц или период
+        region["count"].append(int(count))  # кол-во магазинов
+    regions = ml.region_codes()
+    for region_code, region in counts.items():
+        regions[region_code]["shops_manufacturer_count_region"] = region
+    return regions
+
+
+async def shops_manufacturer_count(
+    db: AsyncSession,
+    user: User,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    granularity: Optional[str] = None,
+) -> dict:
+    """Количество торговых точек в целом по месяцам для 1 производителя,
+    см. ml.shops_manufacturer_count"""
+    period = _period(SoldGoodsSalePointDaily, granularity)
+    rows = (
+        await db.execute(
+            select(period, func.count(distinct(SoldGoodsSalePointDaily.sale_point_id)))
+            .where(*_rollup(SoldGoodsSalePointDaily, user, date_from, date_to))
+            .group_by(period)
+            .order_by(period)
+        )
+    ).all()
+    return {
+        _period_name(granularity): [
+            _period_value(period, granularity) for period, _ in rows
+        ],  # месяц или начало периода
+        "count": [int(count) for _, count in rows],  # кол-во магазинов
+    }
@@ -4,6 +4,7 @@ from app.endpoints.user import router as user_router
 from app.endpoints.item import router as item_router
 from app.endpoints.ml import router as ml_router
 from app.endpoints.data import router as data_router
+from app.endpoints.metrics import router as metrics_router
 
 router = APIRouter(
     responses={404: {"description": "Not found"}},
@@ -15,3 +16,4 @@ router.include_router(user_router)
 router.include_router(item_router)
 router.include_router(ml_router)
 router.include_router(data_router)
+router.include_router(metrics_router)
@@ -3,11 +3,11 @@ from datetime import timedelta
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.schemas import Token
-from app.core.auth import authenticate_user, create_access_token
-from app.core.dependencies import get_db
+from app.core.auth import authenticate_user_async, create_access_token
+from app.core.dependencies import get_async_db
 from app.core.settings import settings
 from app.utils.logging import log
 
@@ -21,9 +21,9 @@ router = APIRouter(
 @router.post("/token", response_model=Token)
 async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user_async(db, form_data.username, form_data.password)
     if not user:
 
         raise HTTPException(
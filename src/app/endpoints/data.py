@@ -1,5 +1,5 @@
+from functools import partial
 from typing import Annotated
-from time import perf_counter
 
 from fastapi import (
     APIRouter,
@@ -10,20 +10,17 @@ from fastapi import (
     Path,
     UploadFile,
     File,
-    BackgroundTasks,
 )
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.core.dependencies import get_db
-from app.core.auth import get_password_hash, oauth2_scheme, get_current_user
-from app.core.crud import get_produced_goods, get_sold_goods, save_file
+from app.core.dependencies import get_async_db, metric_window
+from app.core.auth import oauth2_scheme, get_current_user_async
 from app.core.schemas import *
 from app.core.models import ProducedGoods, SoldGoods, TransportedGoods
 from app.core.settings import settings
 from app.utils.logging import log
-from app.utils.uploader import upload_from_csv
-from app.core import crud
-from app.core.ml import volumes_manufacturer_region, REGION_CODES, COMPUTED_METHODS
+from app.core.analytics import compute_metrics
+from app.core.metric_cache import cached_metrics
 
 
 router = APIRouter(prefix="/data", tags=["data"])
@@ -33,34 +30,19 @@ router = APIRouter(prefix="/map", tags=["map"])
 
 
 @router.get("/get")
-async def get_map(token=Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    user = get_current_user(db, token)
-    start = perf_counter()
-    log.info(COMPUTED_METHODS)
-    if "volumes_manufacturer_region" in COMPUTED_METHODS:
-        log.info("computation took %s seconds", perf_counter() - start)
-        return list(REGION_CODES.values())
-    log.info("computing...")
-
-    a = crud.get_sold_goods_volume_metrics_by_region(db, user)
-    dt, id_sp_, cnt, price = zip(*a)
-    sold_data = {
-        "dt": dt,
-        "id_sp_": id_sp_,
-        "price": cnt,
-        "cnt": price,
-    }
-    a = crud.get_points_for_computation(db)
-    id_sp_, region_code, city_with_type, _ = zip(*a)
-    additional_data = {
-        "id_sp_": id_sp_,
-        "region_code": region_code,
-        "city_with_type": city_with_type,
-    }
-    log.info("preparing data took %s seconds", perf_counter() - start)
-    start = perf_counter()
-
-    result = volumes_manufacturer_region(sold_data, additional_data)
-    log.info("computation took %s seconds", perf_counter() - start)
-
-    return list(result.values())
+async def get_map(
+    window: dict = Depends(metric_window),
+    token=Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Объемы продаж по регионам за окно date_from - date_to, см.
+    app.core.dependencies.metric_window"""
+    user = await get_current_user_async(db, token)
+    metrics = await cached_metrics(
+        db,
+        user,
+        ["volumes_manufacturer_region"],
+        partial(compute_metrics, db, user, **window),
+        **window,
+    )
+    return metrics["volumes_manufacturer_region"]
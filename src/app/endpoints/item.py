@@ -1,4 +1,7 @@
-from typing import Annotated
+import os
+from datetime import datetime
+from uuid import uuid4
+from typing import Annotated, Literal, Optional
 
 from fastapi import (
     APIRouter,
@@ -10,17 +13,42 @@ from fastapi import (
     UploadFile,
     File,
     BackgroundTasks,
+    Header,
 )
+from fastapi.responses import StreamingResponse
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.core.dependencies import get_db
-from app.core.auth import get_password_hash, oauth2_scheme, get_current_user
-from app.core.crud import get_produced_goods, get_sold_goods, save_file
+from app.core.dependencies import get_db, get_async_db
+from app.core.auth import (
+    get_password_hash,
+    oauth2_scheme,
+    get_current_user,
+    get_current_user_async,
+)
+from app.core import async_crud
+from app.core.crud import (
+    save_file,
+    create_job,
+    get_job,
+    get_file_by_hash,
+    get_file_job,
+)
 from app.core.schemas import *
-from app.core.models import ProducedGoods, SoldGoods, TransportedGoods
+from app.core.models import (
+    ProducedGoods,
+    SoldGoods,
+    TransportedGoods,
+    JobStatus,
+    UserFile,
+)
 from app.core.settings import settings
 from app.utils.logging import log
-from app.utils.uploader import upload_from_csv
+from app.utils.files import save_upload, UploadTooLarge
+from app.utils.pagination import InvalidCursor
+from app.utils.export import MEDIA_TYPES, export_goods, negotiate_encoding
+from app.utils.jobs import ingestion_queue
 
 
 router = APIRouter(prefix="/goods", tags=["goods"])
@@ -28,36 +56,44 @@ router = APIRouter(prefix="/goods", tags=["goods"])
 # region produced goods
 @router.get("/produced", response_model=ListProducedGoodsSchema)
 async def get(
-    offset: Annotated[
-        int,
-        Query(ge=0),
-    ],
     count: Annotated[
         int,
         Query(
-            title="смещение, необходимое для выборки определенного подмножества товаров. положительное число. по умолчанию 0.",
+            title="количество товаров, которое необходимо получить",
             ge=1,
-            le=100,
+            le=settings.GOODS_MAX_PAGE_SIZE,
         ),
-    ],
+    ] = settings.GOODS_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    offset: Annotated[Optional[int], Query(ge=0, deprecated=True)] = None,
+    dt_from: Optional[datetime] = None,
+    dt_to: Optional[datetime] = None,
+    gtin: Optional[str] = None,
     token=Depends(oauth2_scheme),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    """Возвращает список произведенных товаров
-    | Параметр     | Описание                                                                                                   |
-    |--------------|------------------------------------------------------------------------------------------------------------|
-    | offset (int) | смещение, необходимое для выборки определенного подмножества товаров. положительное число. по умолчанию 0. |
-    | count (int)  | количество  товаров, которое необходимо получить. Максимальное значение: 100                               |
-    | filter (str) | Определяет, какие типы товаров необходимо получить Возможные значения:
+    """Возвращает страницу произведенных товаров пользователя, упорядоченных по дате
+    | Параметр       | Описание                                                                                  |
+    |----------------|-------------------------------------------------------------------------------------------|
+    | count (int)    | количество товаров, которое необходимо получить. Максимальное значение: GOODS_MAX_PAGE_SIZE |
+    | cursor (str)   | next_cursor предыдущей страницы, без него возвращается первая страница                    |
+    | offset (int)   | устарело, смещение от начала вместо cursor                                                |
+    | dt_from (datetime) | товары с датой не раньше dt_from                                                      |
+    | dt_to (datetime)   | товары с датой раньше dt_to                                                           |
+    | gtin (str)     | товары с этим gtin                                                                        |
     """
-    user = get_current_user(db, token)
+    user = await get_current_user_async(db, token)
 
     if user:
+        try:
+            goods, next_cursor = await async_crud.get_produced_goods(
+                db, user, count, cursor, offset, dt_from, dt_to, gtin
+            )
+        except InvalidCursor as ex:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(ex))
         return ListProducedGoodsSchema(
-            items=[
-                ProducedGoodsSchema.from_orm(good)
-                for good in get_produced_goods(db, offset, count)
-            ]
+            items=[ProducedGoodsSchema.from_orm(good) for good in goods],
+            next_cursor=next_cursor,
         )
     else:
         return HTTPException(
@@ -65,6 +101,41 @@ async def get(
         )
 
 
+@router.get("/produced/export")
+async def export_produced(
+    format: Literal["ndjson", "csv", "arrow"] = "ndjson",
+    accept_encoding: Annotated[Optional[str], Header()] = None,
+    token=Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Выгружает все произведенные товары пользователя одним потоком
+
+    | Параметр       | Описание                                                     |
+    |----------------|--------------------------------------------------------------|
+    | format (str)   | ndjson (по умолчанию), csv или arrow (Arrow IPC stream)      |
+
+    Ответ сжимается gzip или zstd по заголовку Accept-Encoding.
+    """
+    user = await get_current_user_async(db, token)
+    return _export(ProducedGoods, user.id, format, accept_encoding)
+
+
+def _export(
+    model, user_id: int, format: str, accept_encoding: Optional[str]
+) -> StreamingResponse:
+    encoding = negotiate_encoding(accept_encoding)
+    try:
+        body = export_goods(model, user_id, format, encoding)
+    except ValueError as ex:
+        raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail=str(ex))
+    headers = {
+        "Content-Disposition": f'attachment; filename="{model.__tablename__}.{format}"'
+    }
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return StreamingResponse(body, media_type=MEDIA_TYPES[format], headers=headers)
+
+
 # @router.post("/")
 
 
@@ -76,29 +147,33 @@ async def get(
     "/sold", response_model=ListSoldGoodsSchema
 )  # , response_model=list[SoldGoods])
 async def get_sold(
-    offset: Annotated[
-        int,
-        Query(
-            ge=0,
-        ),
-    ],
     count: Annotated[
         int,
         Query(
             ge=1,
-            le=100,
+            le=settings.GOODS_MAX_PAGE_SIZE,
         ),
-    ],
+    ] = settings.GOODS_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    offset: Annotated[Optional[int], Query(ge=0, deprecated=True)] = None,
+    dt_from: Optional[datetime] = None,
+    dt_to: Optional[datetime] = None,
+    gtin: Optional[str] = None,
     token=Depends(oauth2_scheme),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    user = get_current_user(db, token)
+    """Возвращает страницу проданных товаров пользователя, параметры как у /goods/produced"""
+    user = await get_current_user_async(db, token)
     if user:
+        try:
+            goods, next_cursor = await async_crud.get_sold_goods(
+                db, user, count, cursor, offset, dt_from, dt_to, gtin
+            )
+        except InvalidCursor as ex:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(ex))
         return ListSoldGoodsSchema(
-            items=[
-                SoldGoodsSchema.from_orm(good)
-                for good in get_sold_goods(db, offset, count)
-            ]
+            items=[SoldGoodsSchema.from_orm(good) for good in goods],
+            next_cursor=next_cursor,
         )
     else:
         return HTTPException(
@@ -106,40 +181,150 @@ async def get_sold(
         )
 
 
+@router.get("/sold/export")
+async def export_sold(
+    format: Literal["ndjson", "csv", "arrow"] = "ndjson",
+    accept_encoding: Annotated[Optional[str], Header()] = None,
+    token=Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Выгружает все проданные товары пользователя одним потоком, параметры как у
+    /goods/produced/export"""
+    user = await get_current_user_async(db, token)
+    return _export(SoldGoods, user.id, format, accept_encoding)
+
+
 # endregion sold goods
 
 
 # region files
+# загрузка файла и возобновление - обычные (не async) функции: FastAPI выполняет
+# их в пуле потоков, поэтому запись файла на диск не блокирует event loop
+
+
+def _already_uploaded(db: Session, file: UserFile, filename: str, size: int) -> dict:
+    job = get_file_job(db, file)
+    return {
+        "message": f"{filename} is already uploaded",
+        "size": size,
+        "sha256": file.sha256,
+        "job_id": job.id if job else None,
+    }
 
 
 @router.post("/upload")
 def upload(
-    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
+    priority: Annotated[int, Query(ge=-10, le=10)] = 0,
     token=Depends(oauth2_scheme),
     db: Session = Depends(get_db),
 ):
+    """Загружает csv файл и ставит его в очередь на загрузку в базу данных
+
+    | Параметр       | Описание                                                          |
+    |----------------|-------------------------------------------------------------------|
+    | priority (int) | приоритет загрузки от -10 до 10, больший загружается раньше       |
+
+    Состояние загрузки: GET /goods/upload/{job_id}
+    """
     user = get_current_user(db, token)
+    # файл сохраняется под уникальным временным именем и переносится под имя с
+    # sha256 только если такого файла еще нет: путь существующего UserFile
+    # никогда не перезаписывается чужим содержимым и не удаляется, иначе
+    # возобновление его загрузки читало бы чужие строки. Временный файл
+    # удаляется в finally
+    tmp_path = settings.STATIC_FILE_URL.format(
+        username=user.id, filename=f"{uuid4().hex}.upload"
+    )
     try:
-        contents = file.file.read()
+        file_name = file.filename
+        size, sha256 = save_upload(
+            file.file,
+            tmp_path,
+            max_size=settings.UPLOAD_MAX_SIZE,
+            chunk_size=settings.UPLOAD_CHUNK_SIZE,
+        )
+        duplicate = get_file_by_hash(db, user, sha256)
+        if duplicate is not None:
+            # тот же файл уже загружен, повторно строки не добавляются
+            return _already_uploaded(db, duplicate, file_name, size)
         file_path = settings.STATIC_FILE_URL.format(
-            username=user.id, filename=file.filename
+            username=user.id, filename=f"{sha256}_{file.filename}"
+        )
+        os.replace(tmp_path, file_path)
+        try:
+            db_file = save_file(db, user, file_name, file_path, sha256)  # type: ignore
+        except IntegrityError:
+            # параллельная загрузка того же файла сохранила его раньше, уникальный
+            # индекс (user_id, sha256) не дает добавить второй UserFile. Файл
+            # с тем же путем - то же содержимое, его путь остается за первой
+            # загрузкой
+            db.rollback()
+            duplicate = get_file_by_hash(db, user, sha256)
+            if duplicate.path != file_path:
+                os.remove(file_path)
+            return _already_uploaded(db, duplicate, file_name, size)
+        job = create_job(db, db_file, priority=priority, bytes_total=size)
+        ingestion_queue.submit(job)
+    except UploadTooLarge as ex:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(ex)
         )
-        file_name = file.filename
-        with open(
-            file_path,
-            "wb",
-        ) as f:
-            f.write(contents)
-        db_file = save_file(db, user, file_name, file_path) # type: ignore
-        background_tasks.add_task(upload_from_csv, db, db_file)
     except Exception as ex:
         log.exception(f"Error uploading file {ex}")
         return {"message": "There was an error uploading the file"}
     finally:
         file.file.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return {
+        "message": f"Successfully uploaded {file.filename}",
+        "size": size,
+        "sha256": sha256,
+        "job_id": job.id,
+    }
+
 
-    return {"message": f"Successfully uploaded {file.filename}"}
+@router.get("/upload/{job_id}", response_model=IngestionJobSchema)
+async def upload_status(
+    job_id: Annotated[int, Path(ge=1)],
+    token=Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Состояние загрузки файла: загружено строк, строк в секунду, оставшееся время"""
+    user = await get_current_user_async(db, token)
+    job = await async_crud.get_job(db, user, job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Job not found"
+        )
+    return IngestionJobSchema.from_job(job)
+
+
+@router.post("/upload/{job_id}/resume", response_model=IngestionJobSchema)
+def resume_upload(
+    job_id: Annotated[int, Path(ge=1)],
+    token=Depends(oauth2_scheme),
+    db: Session = Depends(get_db),
+):
+    """Повторно ставит в очередь упавшую загрузку, она продолжится с последнего
+    сохраненного блока"""
+    user = get_current_user(db, token)
+    job = get_job(db, user, job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Job not found"
+        )
+    if job.status != JobStatus.failed:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail=f"Job is {job.status}"
+        )
+    job.status = JobStatus.queued
+    job.finished_at = None
+    db.commit()
+    ingestion_queue.submit(job)
+    return IngestionJobSchema.from_job(job)
 
 
 # endregion files
@@ -0,0 +1,49 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import auth, database
+from app.core.analytics import analytics_cache
+from app.core.dependencies import get_async_db
+from app.core.metric_cache import metric_cache
+from app.core.pool import pool_metrics
+from app.core.schemas import CacheMetricsSchema, PoolMetricsSchema
+
+router = APIRouter(prefix="/metrics", tags=["metrics"])
+
+
+@router.get("/pool", response_model=dict[str, PoolMetricsSchema])
+async def get_pool_metrics(
+    token=Depends(auth.oauth2_scheme), db: AsyncSession = Depends(get_async_db)
+):
+    """Состояние пулов соединений для подбора DB_POOL_SIZE и DB_MAX_OVERFLOW
+
+    | Пул   | Используется                      |
+    |-------|-----------------------------------|
+    | sync  | загрузка файлов, очередь загрузок |
+    | async | async эндпоинты                   |
+    """
+    await auth.get_current_user_async(db, token)
+    return {
+        "sync": pool_metrics(database.engine.pool),
+        "async": pool_metrics(database.async_engine.pool),
+    }
+
+
+@router.get("/cache", response_model=dict[str, CacheMetricsSchema])
+async def get_cache_metrics(
+    token=Depends(auth.oauth2_scheme), db: AsyncSession = Depends(get_async_db)
+):
+    """Счетчики кэшей процесса
+
+    | Кэш       | Содержит                                          |
+    |-----------|---------------------------------------------------|
+    | metrics   | результаты /ml и /map, app.core.metric_cache      |
+    | analytics | подготовленные продажи, app.core.analytics        |
+    | auth      | проверенные токены, app.core.auth                 |
+    """
+    await auth.get_current_user_async(db, token)
+    return {
+        "metrics": metric_cache.stats(),
+        "analytics": analytics_cache.stats(),
+        "auth": auth.user_cache.stats(),
+    }
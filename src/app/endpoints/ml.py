@@ -1,30 +1,17 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from functools import partial
+from typing import Any
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy.ext.asyncio import AsyncSession
 import json
 
-from app.core.dependencies import get_db
-from app.core.auth import oauth2_scheme, get_current_user
-from app.core import crud
+from app.core.dependencies import get_async_db, metric_window
+from app.core.auth import oauth2_scheme, get_current_user_async
 from app.core import models
-from app.core.ml import (
-    # Model,
-    shops_manufacturer,
-    volumes_manufacturer_region,
-    volumes_manufacturer,
-    popular_offline_gtin_manufacturer_region,
-    popular_offline_gtin_manufacturer,
-    popular_online_gtin_manufacturer,
-    shops_manufacturer_count_region,
-    shops_manufacturer_count,
-    REGION_CODES,
-    COMPUTED_METHODS,
-)
-
-from app.utils.logging import log
+from app.core.analytics import METRICS, compute_metrics
+from app.core.metric_cache import cached_metrics
 
 
-from time import perf_counter
-
 router = APIRouter(
     prefix="/ml",
     tags=["ml"],
@@ -36,8 +23,10 @@ router = APIRouter(
 
 
 @router.get("/volume_agg_predict")
-async def predict_volume(token=Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    user = get_current_user(db, token)
+async def predict_volume(
+    token=Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)
+):
+    user = await get_current_user_async(db, token)
 
     # model = Model()
 
@@ -55,7 +44,9 @@ async def predict_volume(token=Depends(oauth2_scheme), db: Session = Depends(get
 
 
 @router.get("/count_agg_predict")
-async def predict_count(token=Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def predict_count(
+    token=Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)
+):
     # user = get_current_user(db, token)
     # model = Model()
     # a = crud.get_agg_sold(db, user)
@@ -76,7 +67,7 @@ async def predict_count(token=Depends(oauth2_scheme), db: Session = Depends(get_
 
 @router.get("/volume_manufacturer_predict")
 async def predict_manufacturer_volume(
-    token=Depends(oauth2_scheme), db: Session = Depends(get_db)
+    token=Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)
 ):
     # user = get_current_user(db, token)
     # model = Model()
@@ -105,7 +96,7 @@ async def predict_manufacturer_volume(
 
 @router.get("/count_manufacturer_predict")
 async def predict_manufacturer_count(
-    token=Depends(oauth2_scheme), db: Session = Depends(get_db)
+    token=Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)
 ):
     # user = get_current_user(db, token)
     # model = Model()
@@ -138,223 +129,120 @@ async def predict_manufacturer_count(
 
 # # endregion Yarik ml
 
+# region helpers
+# результаты кэшируются по пользователю и версии его данных (app.core.metric_cache),
+# метрики, которых нет в кэше, считаются вместе за одну выборку продаж
+# (app.core.analytics.compute_metrics); window - окно дат и детализация,
+# см. app.core.dependencies.metric_window
+
+
+async def _metrics(
+    db: AsyncSession, user: models.User, metrics: list[str], window: dict
+) -> dict:
+    return await cached_metrics(
+        db, user, metrics, partial(compute_metrics, db, user, **window), **window
+    )
+
+
+async def _metric(
+    db: AsyncSession, user: models.User, metric: str, window: dict
+) -> Any:
+    return (await _metrics(db, user, [metric], window))[metric]
+
+
+# endregion helpers
+
+
+@router.get("/dashboard")
+async def get_dashboard(
+    metrics: list[str] = Query(list(METRICS)),
+    window: dict = Depends(metric_window),
+    token=Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Несколько метрик производителя одним запросом, по умолчанию все
+
+    Ответ - результаты эндпоинтов /ml/<метрика> по имени метрики. Все метрики
+    принимают date_from, date_to (не включается) и granularity (day, week,
+    month, quarter): без granularity периоды - номера месяцев (month), иначе -
+    даты начала периодов (period).
+    """
+    unknown = [metric for metric in metrics if metric not in METRICS]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown metrics: {', '.join(unknown)}",
+        )
+    user = await get_current_user_async(db, token)
+    return await _metrics(db, user, list(dict.fromkeys(metrics)), window)
+
 
 @router.get("/shops_manufacturer")
-async def get_mertics(token=Depends(oauth2_scheme), db: Session = Depends(get_db)):
-
-    user = get_current_user(db, token)
-    start = perf_counter()
-    log.info("computing...")
-    # check if shops_manufacturer not in REGION_CODES objects
-    if "shops_manufacturer" in COMPUTED_METHODS and any(
-        "shops_manufacturer" in i for i in REGION_CODES.values()
-    ):
-        log.info(f"calculated {len(REGION_CODES)}  in {perf_counter() - start}")
-        return list(REGION_CODES.values())
-    start = perf_counter()
-    a = crud.get_sold_goods_for_computation(db, user)
-    dt, inn, id_sp_, type_operation = zip(*a)
-    sold_data = {
-        "dt": dt,
-        "inn": inn,
-        "id_sp_": id_sp_,
-        "type_operation": type_operation,
-    }
-
-    a = crud.get_points_for_computation(db)
-    id_sp_, region_code, city_with_type, postal_code = zip(*a)
-    additional_data = {
-        "id_sp_": id_sp_,
-        "region_code": region_code,
-        "city_with_type": city_with_type,
-        "postal_code": postal_code,
-    }
-    log.info(f"prepared  data in {perf_counter() - start}")
-    result = shops_manufacturer(sold_data, additional_data)
-
-    log.info(f"calculated {len(result)}  in {perf_counter() - start}")
-    return result
+async def get_mertics(
+    window: dict = Depends(metric_window),
+    token=Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
+):
+    user = await get_current_user_async(db, token)
+    return await _metric(db, user, "shops_manufacturer", window)
 
 
 @router.get("/volumes_manufacturer")
 async def get_volume_metrics(
-    token=Depends(oauth2_scheme), db: Session = Depends(get_db)
+    window: dict = Depends(metric_window),
+    token=Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """Количество единиц товара и стоимость всего проданного товара для 1 производителя в целом"""
-    user = get_current_user(db, token)
-    start = perf_counter()
-    log.info("computing...")
-
-    a = crud.get_sold_goods_volume_metrics_by_region(db, user)
-    dt, id_sp_, cnt, price = zip(*a)
-    sold_data = {
-        "dt": dt,
-        "id_sp_": id_sp_,
-        "price": cnt,
-        "cnt": price,
-    }
-    a = crud.get_points_for_mlcomputation(db)
-    id_sp_, region_code = zip(*a)
-    additional_data = {
-        "id_sp_": id_sp_,
-        "region_code": region_code,
-    }
-
-    log.info(f"prepared data in {perf_counter() - start}")
-
-    result = volumes_manufacturer(sold_data, additional_data)
-    log.info(len(result))
-    print(result)
-    log.info(f"calculated in {perf_counter() - start}")
-    return result
+    user = await get_current_user_async(db, token)
+    return await _metric(db, user, "volumes_manufacturer", window)
 
 
 @router.get("/popular_offline_gtin_manufacturer_region")
 async def get_popular_offline_metrics_by_region(
-    token=Depends(oauth2_scheme), db: Session = Depends(get_db)
+    window: dict = Depends(metric_window),
+    token=Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    # rewrite sql query
-    start = perf_counter()
-    if "popular_offline_gtin_manufacturer_region" in COMPUTED_METHODS:
-        log.info(f"calculated in {perf_counter() - start}")
-        return list(REGION_CODES.values())
-    user = get_current_user(db, token)
-
-    log.info("computing...")
-    a = crud.get_sold_goods_for_offline_metrics(db, user)
-    dt, id_sp_, gtin, type_operation, price, cnt = zip(*a)
-    sold_data = {
-        "dt": dt,
-        "gtin": gtin,
-        "id_sp_": id_sp_,
-        "type_operation": type_operation,
-        "price": price,
-        "cnt": cnt,
-    }
-
-    a = crud.get_points_for_mlcomputation(db)
-    id_sp_, region_code = zip(*a)
-    additional_data = {
-        "id_sp_": id_sp_,
-        "region_code": region_code,
-    }
-
-    log.info(f"prepared data in {perf_counter() - start}")
-    #
-    log.info("prepared data")
-
-    result = popular_offline_gtin_manufacturer_region(sold_data, additional_data)
-    log.info(len(result))
-
-    log.info(f"calculated in {perf_counter() - start}")
-    return list(result.values())
+    user = await get_current_user_async(db, token)
+    return await _metric(db, user, "popular_offline_gtin_manufacturer_region", window)
 
 
 @router.get("/popular_offline_gtin_manufacturer")
 async def get_popular_offline_metrics(
-    token=Depends(oauth2_scheme), db: Session = Depends(get_db)
+    window: dict = Depends(metric_window),
+    token=Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    # rewrite sql query
-    user = get_current_user(db, token)
-    start = perf_counter()
-
-    log.info("computing...")
-
-    a = crud.get_sold_goods_for_offline_metrics(db, user)
-    dt, id_sp_, gtin, type_operation, price, cnt = zip(*a)
-    sold_data = {
-        "dt": dt,
-        "gtin": gtin,
-        "id_sp_": id_sp_,
-        "type_operation": type_operation,
-        "price": price,
-        "cnt": cnt,
-    }
-
-    a = crud.get_points_for_mlcomputation(db)
-    id_sp_, region_code = zip(*a)
-    additional_data = {"id_sp_": id_sp_, "region_code": region_code}
-    #
-    log.info("prepared data")
-
-    result = popular_offline_gtin_manufacturer(sold_data, additional_data)
-    log.info(len(result))
-    print(result)
-    log.info(f"calculated in {perf_counter() - start}")
-    return result
+    user = await get_current_user_async(db, token)
+    return await _metric(db, user, "popular_offline_gtin_manufacturer", window)
 
 
 @router.get("/popular_online_gtin_manufacturer")
 async def get_popular_online_gtin_manufacturer(
-    token=Depends(oauth2_scheme), db: Session = Depends(get_db)
+    window: dict = Depends(metric_window),
+    token=Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    # rewrite sql query
-    user = get_current_user(db, token)
-    start = perf_counter()
-    log.info("computing...")
-    a = crud.get_sold_goods_for_online_metrics(db, user)
-    dt, gtin, type_operation, cnt = zip(*a)
-    sold_data = {
-        "dt": dt,
-        "gtin": gtin,
-        "type_operation": type_operation,
-        "cnt": cnt,
-    }
-
-    log.info(f"prepared data in {perf_counter() - start}")
-    start = perf_counter()
-    result = popular_online_gtin_manufacturer(sold_data)
-
-    log.info(f"calculated in {perf_counter() - start}")
-    return result
+    user = await get_current_user_async(db, token)
+    return await _metric(db, user, "popular_online_gtin_manufacturer", window)
 
 
 @router.get("/shops_manufacturer_count_region")
 async def get_shops_manufacturer_count_region(
-    token=Depends(oauth2_scheme), db: Session = Depends(get_db)
+    window: dict = Depends(metric_window),
+    token=Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    if "shops_manufacturer_count_region" in COMPUTED_METHODS:
-        return list(REGION_CODES.values())
-    user = get_current_user(db, token)
-    start = perf_counter()
-    a = crud.get_sold_goods_for_manufacturer_count_by_region(db, user)
-    dt, id_sp_, cnt = zip(*a)
-    sold_data = {
-        "dt": dt,
-        "id_sp_": id_sp_,
-        "cnt": cnt,
-    }
-
-    a = crud.get_points_for_mlcomputation(db)
-    id_sp_, region_code = zip(*a)
-    additional_data = {"id_sp_": id_sp_, "region_code": region_code}
-    log.info(f"prepared data in {perf_counter() - start}")
-    start = perf_counter()
-    result = shops_manufacturer_count_region(sold_data, additional_data)
-
-    log.info(f"calculated in {perf_counter() - start}")
-    return list(result.values())
+    user = await get_current_user_async(db, token)
+    return await _metric(db, user, "shops_manufacturer_count_region", window)
 
 
 @router.get("/shops_manufacturer_count")
 async def get_shops_manufacturer_count(
-    token=Depends(oauth2_scheme), db: Session = Depends(get_db)
+    window: dict = Depends(metric_window),
+    token=Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
 ):
-
-    user = get_current_user(db, token)
-    start = perf_counter()
-    a = crud.get_sold_goods_for_manufacturer_count_by_region(db, user)
-    dt, id_sp_, cnt = zip(*a)
-    sold_data = {
-        "dt": dt,
-        "id_sp_": id_sp_,
-        "cnt": cnt,
-    }
-
-    a = crud.get_points_for_mlcomputation(db)
-    id_sp_, region_code = zip(*a)
-    additional_data = {"id_sp_": id_sp_, "region_code": region_code}
-    log.info(f"prepared data in {perf_counter() - start}")
-    result = shops_manufacturer_count_region(sold_data, additional_data)
-    log.info(f"calculated in {perf_counter() - start}")
-    return result
+    user = await get_current_user_async(db, token)
+    return await _metric(db, user, "shops_manufacturer_count", window)
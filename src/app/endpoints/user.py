@@ -1,11 +1,13 @@
 from typing import Union
 
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.core.dependencies import get_db
-from app.core.auth import get_password_hash, oauth2_scheme, get_current_user
-from app.core.crud import save_user, get_user_by_username
+from app.core.dependencies import get_async_db
+from app.core.auth import get_password_hash, oauth2_scheme, get_current_user_async
+from app.core.async_crud import save_user, get_user_by_username
 from app.core.schemas import UserSchema, UserCreateSchema
 
 router = APIRouter(
@@ -17,19 +19,26 @@ router = APIRouter(
 
 @router.post("/create_user", response_model=UserSchema)
 async def create_user(
-    user: UserCreateSchema, db: Session = Depends(get_db)
+    user: UserCreateSchema, db: AsyncSession = Depends(get_async_db)
 ) -> Union[UserSchema, None]:
-    db_user = get_user_by_username(db, user.username)
+    db_user = await get_user_by_username(db, user.username)
     if db_user:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User exists")
-    user.password = get_password_hash(user.password)
-    user = save_user(db, user.username, user.password, user.email)
+    user.password = await run_in_threadpool(get_password_hash, user.password)
+    try:
+        user = await save_user(db, user.username, user.password, user.email)
+    except IntegrityError:
+        # пользователь с тем же именем создан параллельным запросом
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User exists")
     return UserSchema.from_orm(user)
 
 
 @router.get("/me", response_model=UserSchema)
 async def profile(
-    token=Depends(oauth2_scheme), db: Session = Depends(get_db)
+    token=Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)
 ) -> UserSchema:
-    user = get_current_user(db, token)
+    user = await get_current_user_async(db, token)
+    # пользователь из кэша токенов содержит только auth.CACHED_COLUMNS
+    await db.refresh(user)
     return UserSchema.from_orm(user)
@@ -0,0 +1,108 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Hashable, Optional
+
+
+class TTLCache:
+    """Ограниченный по размеру кэш с временем жизни записей
+
+    При переполнении вытесняется запись, которая дольше всех не читалась.
+    Потокобезопасен, хранится в памяти процесса.
+
+    Args:
+        maxsize (int): максимальное количество записей
+        ttl (float): время жизни записи в секундах
+        maxbytes (int | None, optional): ограничение суммарного размера записей,
+            размер записи считает sizeof
+        sizeof (Callable[[Any], int] | None, optional): размер значения в байтах
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        maxbytes: Optional[int] = None,
+        sizeof: Optional[Callable[[Any], int]] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self._lock = Lock()
+        self._items: OrderedDict[Hashable, tuple[float, int, Any]] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] <= monotonic():
+                if item is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[2]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Сохраняет value на ttl секунд (по умолчанию self.ttl), ttl <= 0 - не сохраняет"""
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        size = self.sizeof(value)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (monotonic() + ttl, size, value)
+            self.bytes += size
+            while len(self._items) > self.maxsize or (
+                self.maxbytes is not None and self.bytes > self.maxbytes
+            ):
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self._items.pop(key)
+        self.bytes -= size
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+
+    def pop_where(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        """Удаляет записи, для которых predicate(key, value) истинно
+
+        Returns:
+            int: количество удаленных записей
+        """
+        with self._lock:
+            keys = [
+                key for key, (_, _, value) in self._items.items() if predicate(key, value)
+            ]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._items),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __len__(self) -> int:
+        return len(self._items)
@@ -0,0 +1,78 @@
+from typing import Any, Iterable
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from app.utils.logging import log
+
+# сколько новых значений справочника добавляется одним запросом
+INSERT_CHUNK_SIZE = 1000
+
+
+class DimensionCache:
+    """Ключи значений справочников в рамках одной загрузки
+
+    Значения, которых еще нет в справочнике, добавляются через
+    INSERT ... ON CONFLICT DO NOTHING в транзакции загружаемого блока, поэтому
+    параллельные загрузки с одинаковыми значениями не создают дубликатов.
+    Значения добавляются в отсортированном порядке, чтобы параллельные
+    загрузки блокировали строки справочника в одном порядке.
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+        self._keys: dict[Any, dict[str, int]] = {}
+
+    def keys(self, model: Any, values: Iterable[str]) -> dict[str, int]:
+        """Ключи значений values в справочнике model, недостающие добавляются
+
+        Returns:
+            dict[str, int]: все известные значения справочника -> ключ
+        """
+        known = self._keys.setdefault(model, {})
+        missing = sorted(set(values) - known.keys())
+        for i in range(0, len(missing), INSERT_CHUNK_SIZE):
+            chunk = missing[i : i + INSERT_CHUNK_SIZE]
+            self.db.execute(
+                insert(model)
+                .values([{"value": value} for value in chunk])
+                .on_conflict_do_nothing(index_elements=["value"])
+            )
+            known.update(
+                self.db.execute(
+                    select(model.value, model.id).where(model.value.in_(chunk))
+                ).all()
+            )
+        if missing:
+            log.info(f"{model.__tablename__}: resolved {len(missing)} values")
+        return known
+
+    def encode(
+        self, frame: pd.DataFrame, dimensions: dict[str, tuple[Any, str]]
+    ) -> pd.DataFrame:
+        """Заменяет значения колонок справочников их ключами
+
+        Колонка csv файла переименовывается в колонку таблицы с ключом, порядок
+        колонок сохраняется. Ключи ищутся только для уникальных значений блока.
+        """
+        for name, (model, key) in dimensions.items():
+            column = frame[name]
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                # после фильтрации блока часть категорий может не встречаться
+                column = column.cat.remove_unused_categories()
+            else:
+                column = column.astype("category")
+            categories = column.cat.categories
+            keys = self.keys(model, categories)
+            codes = np.fromiter(
+                (keys[value] for value in categories),
+                dtype=np.int64,
+                count=len(categories),
+            )
+            frame[name] = codes[column.cat.codes.to_numpy()]
+        return frame.rename(
+            columns={name: key for name, (_, key) in dimensions.items()}
+        )
@@ -0,0 +1,302 @@
+"""Потоковая выгрузка товаров пользователя в NDJSON, CSV или Arrow IPC
+
+Строки читаются серверным курсором пачками по settings.EXPORT_BATCH_SIZE,
+каждая пачка кодируется и сразу отправляется клиенту, поэтому память не
+зависит от размера выгрузки. Кодирование и сжатие пачек выполняются в пуле
+потоков, чтобы не останавливать event loop. Ответ сжимается gzip или zstd,
+если клиент поддерживает их (Accept-Encoding).
+"""
+import csv
+import io
+import json
+import zlib
+from abc import ABC, abstractmethod
+from datetime import datetime
+from time import perf_counter
+from typing import Any, AsyncIterator, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import ColumnElement, DateTime, Integer, Select, select, text
+from sqlalchemy.orm import aliased
+
+from app.core import database
+from app.core.models import (
+    Gtin,
+    Inn,
+    OperationType,
+    Prid,
+    ProducedGoods,
+    SalePoint,
+    SoldGoods,
+)
+from app.core.settings import settings
+from app.utils.logging import log
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import pyarrow
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+# region queries
+
+
+def goods_export_query(model: Any, user_id: int) -> Select:
+    """Строки model пользователя с исходными значениями справочников, колонки
+    называются как поля SoldGoodsSchema и ProducedGoodsSchema"""
+    gtin, prid = aliased(Gtin), aliased(Prid)
+    if model is SoldGoods:
+        inn, sale_point, type_operation = (
+            aliased(Inn),
+            aliased(SalePoint),
+            aliased(OperationType),
+        )
+        statement = (
+            select(
+                SoldGoods.dt,
+                gtin.value.label("gtin"),
+                prid.value.label("prid"),
+                inn.value.label("inn"),
+                sale_point.value.label("id_sp_"),
+                type_operation.value.label("type_operation"),
+                SoldGoods.price,
+                SoldGoods.cnt,
+            )
+            .join(inn, inn.id == SoldGoods.inn_id)
+            .join(sale_point, sale_point.id == SoldGoods.sale_point_id)
+            .join(type_operation, type_operation.id == SoldGoods.type_operation_id)
+        )
+    elif model is ProducedGoods:
+        operation_type = aliased(OperationType)
+        statement = select(
+            ProducedGoods.dt,
+            gtin.value.label("gtin"),
+            prid.value.label("prid"),
+            operation_type.value.label("operation_type"),
+            ProducedGoods.cnt,
+        ).join(operation_type, operation_type.id == ProducedGoods.operation_type_id)
+    else:
+        raise ValueError(f"Export of {model.__tablename__} is not supported")
+    return (
+        statement.join(gtin, gtin.id == model.gtin_id)
+        .join(prid, prid.id == model.prid_id)
+        .where(model.user_id == user_id)
+        .order_by(model.dt, model.id)
+    )
+
+
+async def iter_batches(statement: Select) -> AsyncIterator[list[Any]]:
+    """Строки запроса пачками через серверный курсор asyncpg
+
+    Используется отдельная сессия: выгрузка продолжается после выхода из
+    эндпоинта, когда сессия зависимости get_async_db может быть уже закрыта.
+    """
+    async with database.AsyncSessionLocal() as db:
+        # выгрузка всех строк дольше обычных запросов эндпоинтов
+        await db.execute(text("SET LOCAL statement_timeout = 0"))
+        result = await db.stream(
+            statement.execution_options(yield_per=settings.EXPORT_BATCH_SIZE)
+        )
+        async for batch in result.partitions():
+            yield batch
+
+
+# endregion queries
+
+# region encoders
+
+
+def _value(value: Any) -> Any:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+class Encoder(ABC):
+    """Кодирует пачки строк выгрузки, finish возвращает конец потока"""
+
+    def __init__(self, columns: list[ColumnElement]):
+        self.names = [column.name for column in columns]
+
+    @abstractmethod
+    def encode(self, batch: list[Any]) -> bytes:
+        ...
+
+    def finish(self) -> bytes:
+        return b""
+
+
+class NdjsonEncoder(Encoder):
+    """Строка json на каждую строку выгрузки"""
+
+    def encode(self, batch: list[Any]) -> bytes:
+        return "".join(
+            json.dumps(dict(zip(self.names, map(_value, row))), ensure_ascii=False)
+            + "\n"
+            for row in batch
+        ).encode()
+
+
+class CsvEncoder(Encoder):
+    """csv с заголовком, даты в ISO 8601"""
+
+    def __init__(self, columns: list[ColumnElement]):
+        super().__init__(columns)
+        self.header = True
+
+    def encode(self, batch: list[Any]) -> bytes:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if self.header:
+            writer.writerow(self.names)
+            self.header = False
+        writer.writerows([list(map(_value, row)) for row in batch])
+        return buffer.getvalue().encode()
+
+    def finish(self) -> bytes:
+        return self.encode([]) if self.header else b""
+
+
+class ArrowEncoder(Encoder):
+    """Поток Arrow IPC, пачка строк выгрузки - одна пачка Arrow"""
+
+    def __init__(self, columns: list[ColumnElement]):
+        if pyarrow is None:
+            raise ValueError("pyarrow package is required for arrow export")
+        super().__init__(columns)
+        self.schema = pyarrow.schema(
+            [(column.name, self._type(column.type)) for column in columns]
+        )
+        self.sink = io.BytesIO()
+        self.writer = pyarrow.ipc.new_stream(self.sink, self.schema)
+
+    @staticmethod
+    def _type(column_type: Any) -> Any:
+        if isinstance(column_type, DateTime):
+            return pyarrow.timestamp("us")
+        if isinstance(column_type, Integer):
+            return pyarrow.int64()
+        return pyarrow.string()
+
+    def _flush(self) -> bytes:
+        data = self.sink.getvalue()
+        self.sink.seek(0)
+        self.sink.truncate()
+        return data
+
+    def encode(self, batch: list[Any]) -> bytes:
+        self.writer.write_batch(
+            pyarrow.RecordBatch.from_arrays(
+                [
+                    pyarrow.array([row[i] for row in batch], type=field.type)
+                    for i, field in enumerate(self.schema)
+                ],
+                schema=self.schema,
+            )
+        )
+        return self._flush()
+
+    def finish(self) -> bytes:
+        self.writer.close()
+        return self._flush()
+
+
+ENCODERS = {
+    "ndjson": NdjsonEncoder,
+    "csv": CsvEncoder,
+    "arrow": ArrowEncoder,
+}
+
+# endregion encoders
+
+# region compression
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Сжатие ответа по заголовку Accept-Encoding: "zstd", "gzip" или None"""
+    accepted = set()
+    for item in (accept_encoding or "").split(","):
+        name, *params = item.split(";")
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(name.strip().lower())
+    if "zstd" in accepted and zstandard is not None:
+        return "zstd"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+def _compressor(encoding: Optional[str]) -> Any:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    if encoding == "gzip":
+        return zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    return None
+
+
+def _encode(encoder: Encoder, compressor: Any, batch: Optional[list[Any]]) -> bytes:
+    """Кодирует и сжимает пачку строк, None - конец выгрузки"""
+    if batch is None:
+        data = encoder.finish()
+        if compressor is not None:
+            data = compressor.compress(data) + compressor.flush()
+    else:
+        data = encoder.encode(batch)
+        if compressor is not None:
+            data = compressor.compress(data)
+    return data
+
+
+# endregion compression
+
+
+def export_goods(
+    model: Any, user_id: int, format: str, encoding: Optional[str] = None
+) -> AsyncIterator[bytes]:
+    """Тело ответа выгрузки строк model пользователя user_id
+
+    Args:
+        format (str): "ndjson", "csv" или "arrow"
+        encoding (str | None, optional): сжатие, см. negotiate_encoding
+
+    Raises:
+        ValueError: формат недоступен, проверяется до начала выгрузки
+    """
+    statement = goods_export_query(model, user_id)
+    encoder = ENCODERS[format](list(statement.selected_columns))
+
+    async def body() -> AsyncIterator[bytes]:
+        start = perf_counter()
+        compressor = _compressor(encoding)
+        rows = 0
+        async for batch in iter_batches(statement):
+            rows += len(batch)
+            data = await run_in_threadpool(_encode, encoder, compressor, batch)
+            if data:
+                yield data
+        data = await run_in_threadpool(_encode, encoder, compressor, None)
+        if data:
+            yield data
+        log.info(
+            f"exported {rows} rows of {model.__tablename__} as {format} "
+            f"in {perf_counter() - start:.2f} seconds"
+        )
+
+    return body()
@@ -0,0 +1,121 @@
+import io
+import os
+import gzip
+import hashlib
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class UploadTooLarge(Exception):
+    """Размер загружаемого файла превышает допустимый"""
+
+    def __init__(self, limit: int):
+        super().__init__(f"file is larger than {limit} bytes")
+        self.limit = limit
+
+
+def save_upload(
+    source: BinaryIO, path: str, max_size: int, chunk_size: int = 1024 * 1024
+) -> tuple[int, str]:
+    """Потоковое сохранение загруженного файла на диск
+
+    Файл копируется блоками по chunk_size байт, поэтому потребление памяти
+    не зависит от размера файла. Запись идет во временный файл, который
+    переименовывается только после успешной загрузки.
+
+    Args:
+        source (BinaryIO): поток с содержимым файла
+        path (str): путь для сохранения
+        max_size (int): максимальный размер файла в байтах
+        chunk_size (int, optional): размер блока в байтах
+
+    Raises:
+        UploadTooLarge: файл больше max_size
+
+    Returns:
+        tuple[int, str]: размер файла в байтах и sha256 содержимого
+    """
+    digest = hashlib.sha256()
+    size = 0
+    tmp_path = f"{path}.part"
+    try:
+        with open(tmp_path, "wb") as f:
+            while chunk := source.read(chunk_size):
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLarge(max_size)
+                digest.update(chunk)
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return size, digest.hexdigest()
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def detect_compression(head: bytes) -> Optional[str]:
+    """Определяет сжатие файла по первым байтам: "gzip", "zstd" или None"""
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+    if head.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+
+@contextmanager
+def open_upload(path: str) -> Iterator[tuple[BinaryIO, BinaryIO]]:
+    """Открывает сохраненный файл, сжатые gzip и zstd файлы распаковываются потоком
+
+    Смещения у распакованного потока считаются в распакованных байтах,
+    перемещение по нему - через seek_forward.
+
+    Yields:
+        tuple[BinaryIO, BinaryIO]: распакованный поток и исходный файл, позиция
+            которого показывает, сколько байт файла на диске прочитано
+    """
+    with open(path, "rb") as raw:
+        compression = detect_compression(raw.read(4))
+        raw.seek(0)
+        if compression == "gzip":
+            stream = gzip.GzipFile(fileobj=raw, mode="rb")
+        elif compression == "zstd":
+            if zstandard is None:
+                raise ValueError("zstandard package is required to read .zst files")
+            stream = io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(raw, closefd=False)
+            )
+        else:
+            stream = raw
+        try:
+            yield stream, raw
+        finally:
+            if stream is not raw:
+                stream.close()
+
+
+def seek_forward(stream: BinaryIO, offset: int, chunk_size: int = 1024 * 1024):
+    """Перемещает поток на offset, для несжатых файлов через seek,
+    для распаковываемых потоков - чтением до нужной позиции"""
+    if stream.seekable():
+        stream.seek(offset)
+        return
+    while (left := offset - stream.tell()) > 0:
+        if not stream.read(min(left, chunk_size)):
+            raise ValueError(f"stream ended before offset {offset}")
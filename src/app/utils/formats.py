@@ -0,0 +1,337 @@
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+import pandas as pd
+from sqlalchemy import Table
+
+from app.core.partitions import is_partitioned
+from app.core.models import (
+    ProducedGoods,
+    SoldGoods,
+    TransportedGoods,
+    AgrProduction,
+    AgrSold,
+    AgrTransported,
+    AddSoldGoods,
+    Gtin,
+    Prid,
+    Inn,
+    SalePoint,
+    OperationType,
+)
+
+
+# region converters
+# конвертеры работают с колонкой целиком, а не с отдельными значениями
+
+
+def to_date(column: pd.Series) -> pd.Series:
+    return pd.to_datetime(column, format="%Y-%m-%d")
+
+
+def to_int(column: pd.Series) -> pd.Series:
+    return pd.to_numeric(column).astype("int64")
+
+
+def to_nullable_int(column: pd.Series) -> pd.Series:
+    return pd.to_numeric(column.where(column != "")).astype("Int64")
+
+
+def to_str(column: pd.Series) -> pd.Series:
+    return column
+
+
+def to_nullable_str(column: pd.Series) -> pd.Series:
+    return column.where(column != "")
+
+
+def to_category(column: pd.Series) -> pd.Series:
+    # колонки справочников: каждое значение разбирается и кодируется один раз
+    return column.astype("category")
+
+
+# endregion converters
+
+
+@dataclass(frozen=True)
+class CsvFormat:
+    """Описание формата выгрузки
+
+    Attributes:
+        name (str): имя формата
+        model (type): модель, в таблицу которой загружаются строки
+        header (tuple[str, ...]): заголовок csv файла
+        converters (dict[str, Callable]): колонка таблицы -> конвертер,
+            в порядке колонок csv файла
+        dimensions (dict[str, tuple[type, str]]): колонка csv файла ->
+            модель справочника и колонка таблицы с ключом значения,
+            см. app.utils.dimensions
+        load_order (int): при загрузке нескольких файлов форматы с меньшим
+            значением загружаются раньше, например торговые точки до продаж
+    """
+
+    name: str
+    model: Any
+    header: tuple[str, ...]
+    converters: dict[str, Callable[[pd.Series], pd.Series]]
+    dimensions: dict[str, tuple[Any, str]] = field(default_factory=dict)
+    load_order: int = 1
+    _steps: tuple = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # список шагов собирается один раз на формат, а не на каждый блок
+        object.__setattr__(self, "_steps", tuple(self.converters.items()))
+
+    @property
+    def table(self) -> Table:
+        return self.model.__table__
+
+    @property
+    def columns(self) -> list[str]:
+        return list(self.converters.keys())
+
+    @property
+    def owned(self) -> bool:
+        """Строки таблицы принадлежат пользователю и файлу, из которого загружены"""
+        return "user_id" in self.table.c
+
+    @property
+    def load_columns(self) -> list[str]:
+        """Колонки таблицы, заполняемые при загрузке"""
+        columns = [
+            self.dimensions[name][1] if name in self.dimensions else name
+            for name in self.columns
+        ]
+        if self.owned:
+            return columns + ["user_id", "file_id"]
+        return columns
+
+    @property
+    def dated(self) -> bool:
+        return "dt" in self.converters
+
+    @property
+    def partitioned(self) -> bool:
+        """Таблица разбита на месячные секции, см. app.core.partitions"""
+        return is_partitioned(self.table)
+
+    @property
+    def not_null(self) -> list[str]:
+        """Строковые колонки, в которых пустое значение - пустая строка, а не NULL"""
+        return [name for name, converter in self._steps if converter is to_str]
+
+    def convert(self, frame: pd.DataFrame) -> pd.DataFrame:
+        for name, converter in self._steps:
+            frame[name] = converter(frame[name])
+        return frame
+
+    def records(self, frame: pd.DataFrame) -> list[dict[str, Any]]:
+        """Строки блока в виде словарей для ORM моделей"""
+        return frame.astype(object).where(frame.notna(), None).to_dict("records")
+
+
+FORMATS: dict[str, CsvFormat] = {}
+_BY_HEADER: dict[tuple[str, ...], CsvFormat] = {}
+
+
+def register(fmt: CsvFormat) -> CsvFormat:
+    if fmt.header in _BY_HEADER:
+        used_by = _BY_HEADER[fmt.header].name
+        raise ValueError(f"header of {fmt.name} is already used by {used_by}")
+    FORMATS[fmt.name] = fmt
+    _BY_HEADER[fmt.header] = fmt
+    return fmt
+
+
+def detect_format(header: list[str]) -> Optional[CsvFormat]:
+    """Определяет формат выгрузки по заголовку csv файла"""
+    return _BY_HEADER.get(tuple(column.strip() for column in header))
+
+
+# region registry
+
+register(
+    CsvFormat(
+        name="produced",
+        model=ProducedGoods,
+        header=("dt", "inn", "gtin", "prid", "operation_type", "cnt"),
+        converters={
+            "dt": to_date,
+            "inn": to_category,
+            "gtin": to_category,
+            "prid": to_category,
+            "operation_type": to_category,
+            "cnt": to_int,
+        },
+        dimensions={
+            "inn": (Inn, "inn_id"),
+            "gtin": (Gtin, "gtin_id"),
+            "prid": (Prid, "prid_id"),
+            "operation_type": (OperationType, "operation_type_id"),
+        },
+    )
+)
+
+register(
+    CsvFormat(
+        name="sold",
+        model=SoldGoods,
+        header=(
+            "dt",
+            "gtin",
+            "prid",
+            "inn",
+            "id_sp_",
+            "type_operation",
+            "price",
+            "cnt",
+        ),
+        converters={
+            "dt": to_date,
+            "gtin": to_category,
+            "prid": to_category,
+            "inn": to_category,
+            "id_sp_": to_category,
+            "type_operation": to_category,
+            "price": to_int,
+            "cnt": to_int,
+        },
+        dimensions={
+            "gtin": (Gtin, "gtin_id"),
+            "prid": (Prid, "prid_id"),
+            "inn": (Inn, "inn_id"),
+            "id_sp_": (SalePoint, "sale_point_id"),
+            "type_operation": (OperationType, "type_operation_id"),
+        },
+    )
+)
+
+register(
+    CsvFormat(
+        name="transported",
+        model=TransportedGoods,
+        header=("dt", "gtin", "prid", "sender_inn", "receiver_inn", "cnt_moved"),
+        converters={
+            "dt": to_date,
+            "gtin": to_category,
+            "prid": to_category,
+            "sender_inn": to_category,
+            "receiver_inn": to_category,
+            "cnt_moved": to_int,
+        },
+        dimensions={
+            "gtin": (Gtin, "gtin_id"),
+            "prid": (Prid, "prid_id"),
+            "sender_inn": (Inn, "sender_inn_id"),
+            "receiver_inn": (Inn, "receiver_inn_id"),
+        },
+    )
+)
+
+register(
+    CsvFormat(
+        name="agg_produced",
+        model=AgrProduction,
+        header=(
+            "dt",
+            "region_code",
+            "operation_type",
+            "org_count",
+            "assortment",
+            "count_brand",
+            "cnt",
+        ),
+        converters={
+            "dt": to_date,
+            "region_code": to_int,
+            "operation_type": to_str,
+            "org_count": to_int,
+            "assortment": to_int,
+            "count_brand": to_int,
+            "cnt": to_int,
+        },
+    )
+)
+
+register(
+    CsvFormat(
+        name="agg_sold",
+        model=AgrSold,
+        header=(
+            "dt",
+            "region_code",
+            "type_operation",
+            "count_active_point",
+            "org_count",
+            "assortment",
+            "count_brand",
+            "cnt",
+            "sum_price",
+        ),
+        converters={
+            "dt": to_date,
+            "region_code": to_int,
+            "type_operation": to_str,
+            "count_active_point": to_int,
+            "org_count": to_int,
+            "assortment": to_int,
+            "count_brand": to_int,
+            "cnt": to_int,
+            "sum_price": to_int,
+        },
+    )
+)
+
+register(
+    CsvFormat(
+        name="agg_transported",
+        model=AgrTransported,
+        header=(
+            "t1.dt",
+            "sender_region_code",
+            "receiver_region_code",
+            "sender_org_count",
+            "receiver_org_count",
+            "assortment",
+            "count_brand",
+            "cnt_moved",
+        ),
+        converters={
+            "dt": to_date,
+            "sender_region_code": to_int,
+            "receiver_region_code": to_int,
+            "sender_org_count": to_int,
+            "receiver_org_count": to_int,
+            "assortment": to_int,
+            "count_brand": to_int,
+            "cnt": to_int,
+        },
+    )
+)
+
+register(
+    CsvFormat(
+        name="sale_points",
+        model=AddSoldGoods,
+        header=(
+            "id_sp_",
+            "inn",
+            "region_code",
+            "city_with_type",
+            "city_fias_id",
+            "postal_code",
+        ),
+        converters={
+            "id_sp_": to_category,
+            "inn": to_str,
+            "region_code": to_int,
+            "city_with_type": to_nullable_str,
+            "city_fias_id": to_nullable_str,
+            "postal_code": to_nullable_int,
+        },
+        dimensions={"id_sp_": (SalePoint, "sale_point_id")},
+        load_order=0,
+    )
+)
+
+# endregion registry
@@ -0,0 +1,118 @@
+import queue
+import threading
+from datetime import datetime
+from typing import Optional
+
+from app.core import crud
+from app.core import database
+from app.core.analytics import invalidate_analytics
+from app.core.metric_cache import invalidate_user
+from app.core.models import IngestionJob, JobStatus
+from app.core.settings import settings
+from app.utils.logging import log
+from app.utils.uploader import upload_from_csv
+
+
+class IngestionQueue:
+    """Очередь задач загрузки файлов с ограниченным числом обработчиков
+
+    Задачи хранятся в таблице ingestion_jobs, в памяти только их id.
+    Каждый обработчик работает в своем потоке со своими сессиями, поэтому
+    загрузки не занимают потоки, обрабатывающие запросы к API.
+    Задачи с большим priority выполняются раньше.
+    """
+
+    # меньше любого приоритета, чтобы обработчики останавливались сразу,
+    # оставшиеся задачи будут восстановлены из базы при следующем запуске
+    _STOP = (float("-inf"), -1)
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._queue: queue.PriorityQueue[tuple[float, int]] = queue.PriorityQueue()
+        self._threads: list[threading.Thread] = []
+
+    def start(self):
+        if self._threads:
+            return
+        self._recover()
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name=f"ingestion-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        log.info(f"started {self.workers} ingestion workers")
+
+    def stop(self, timeout: Optional[float] = None):
+        for _ in self._threads:
+            self._queue.put(self._STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, job: IngestionJob):
+        self._queue.put((-job.priority, job.id))
+
+    def _recover(self):
+        """Ставит в очередь задачи, не завершенные до перезапуска"""
+        db = database.SessionLocal()
+        try:
+            for job in crud.get_unfinished_jobs(db):
+                log.info(f"recovering {job}")
+                self.submit(job)
+        finally:
+            db.close()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item == self._STOP:
+                    return
+                self._run(item[1])
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job_id: int):
+        db = database.SessionLocal()
+        progress_db = database.SessionLocal()
+        try:
+            job = db.get(IngestionJob, job_id)
+            if job is None or job.status in (JobStatus.done, JobStatus.failed):
+                return
+            job.status = JobStatus.running
+            job.started_at = datetime.utcnow()
+            job.error = None
+            db.commit()
+            log.info(f"running {job}")
+
+            def progress(rows_done: int, bytes_done: int):
+                crud.update_job_progress(progress_db, job_id, rows_done, bytes_done)
+
+            rows = upload_from_csv(db, job.file, progress=progress)
+
+            job.status = JobStatus.done
+            job.rows_done = rows
+            job.bytes_done = job.bytes_total
+            job.finished_at = datetime.utcnow()
+            db.commit()
+            log.info(f"finished {job}")
+            # торговые точки входят в метрики всех пользователей
+            user_id = None if job.file.format == "sale_points" else job.user_id
+            invalidate_user(user_id)
+            invalidate_analytics(user_id)
+        except Exception as ex:
+            log.exception(f"ingestion job {job_id} failed: {ex}")
+            db.rollback()
+            job = db.get(IngestionJob, job_id)
+            if job is not None:
+                job.status = JobStatus.failed
+                job.error = str(ex)
+                job.finished_at = datetime.utcnow()
+                db.commit()
+        finally:
+            progress_db.close()
+            db.close()
+
+
+ingestion_queue = IngestionQueue(settings.INGEST_WORKERS)
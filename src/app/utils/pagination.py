@@ -0,0 +1,81 @@
+"""Постраничная выборка товаров пользователя по курсору
+
+Страница начинается после ключа (dt, id) последней строки предыдущей страницы,
+поэтому время выборки страницы не зависит от ее номера, в отличие от OFFSET.
+Курсор - закодированный ключ последней строки, клиент передает его как есть.
+"""
+import base64
+from datetime import datetime
+from typing import Any, Optional
+
+from sqlalchemy import Select, select, tuple_
+
+from app.core.models import Gtin
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(dt: datetime, id: int) -> str:
+    return base64.urlsafe_b64encode(f"{dt.isoformat()}|{id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """Ключ (dt, id) из курсора encode_cursor
+
+    Raises:
+        InvalidCursor: курсор поврежден
+    """
+    try:
+        dt, id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(dt), int(id)
+    except ValueError as ex:
+        raise InvalidCursor(f"Invalid cursor {cursor}") from ex
+
+
+def goods_page_query(
+    model: Any,
+    user_id: int,
+    count: int,
+    cursor: Optional[str] = None,
+    offset: Optional[int] = None,
+    dt_from: Optional[datetime] = None,
+    dt_to: Optional[datetime] = None,
+    gtin: Optional[str] = None,
+) -> Select:
+    """Запрос страницы строк model пользователя user_id, упорядоченных по (dt, id)
+
+    Выбирается count + 1 строка, лишняя строка означает, что есть следующая
+    страница, см. goods_page.
+
+    Args:
+        cursor (str | None, optional): курсор последней строки предыдущей страницы
+        offset (int | None, optional): смещение вместо курсора, оставлено для
+            совместимости
+        dt_from (datetime | None, optional): строки с dt не раньше dt_from
+        dt_to (datetime | None, optional): строки с dt раньше dt_to
+        gtin (str | None, optional): строки товара gtin
+    """
+    statement = select(model).where(model.user_id == user_id)
+    if dt_from is not None:
+        statement = statement.where(model.dt >= dt_from)
+    if dt_to is not None:
+        statement = statement.where(model.dt < dt_to)
+    if gtin is not None:
+        statement = statement.where(
+            model.gtin_id == select(Gtin.id).where(Gtin.value == gtin).scalar_subquery()
+        )
+    if cursor is not None:
+        statement = statement.where(tuple_(model.dt, model.id) > decode_cursor(cursor))
+    elif offset:
+        statement = statement.offset(offset)
+    return statement.order_by(model.dt, model.id).limit(count + 1)
+
+
+def goods_page(rows: list[Any], count: int) -> tuple[list[Any], Optional[str]]:
+    """Строки страницы и курсор следующей страницы (None на последней странице)"""
+    if len(rows) <= count:
+        return rows, None
+    rows = rows[:count]
+    return rows, encode_cursor(rows[-1].dt, rows[-1].id)
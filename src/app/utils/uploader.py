@@ -1,555 +1,443 @@
+import io
 import os
 import csv
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from datetime import datetime
 from time import perf_counter
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 import multiprocessing as mp
 
-from app.core.models import (
-    User,
-    ProducedGoods,
-    SoldGoods,
-    TransportedGoods,
-    UserFile,
-    AgrProduction,
-    AgrSold,
-    AgrTransported,
-    AddSoldGoods,
-)
+from app.core import crud, partitions, rollups
+from app.core.models import AddSoldGoods, SoldGoods, UserFile
+from app.core.settings import settings
+from app.utils.dimensions import DimensionCache
+from app.utils.files import open_upload, seek_forward
+from app.utils.formats import CsvFormat, FORMATS, detect_format
 from app.utils.logging import log
 
+Progress = Callable[[int, int], None]
+
+
+def upload_from_csv(
+    db: Session,
+    file: UserFile,
+    method: Optional[str] = None,
+    workers: Optional[int] = None,
+    progress: Optional[Progress] = None,
+) -> int:
+    """Загрузка csv файла пользователя в базу данных
+
+    Формат файла определяется один раз по заголовку, см. app.utils.formats.
+
+    Args:
+        db (Session): сессия sqlalchemy.orm
+        file (UserFile): загруженный файл
+        method (str | None, optional): "copy" - потоковая загрузка через COPY FROM STDIN,
+            "staging" - загрузка через промежуточную таблицу, строки появляются
+            в основной таблице одной транзакцией,
+            "orm" - загрузка через ORM объекты. По умолчанию settings.UPLOAD_METHOD.
+        workers (int | None, optional): количество процессов для разбора файла.
+            По умолчанию settings.UPLOAD_WORKERS.
+        progress (Progress | None, optional): вызывается после каждого блока
+            с количеством загруженных строк и прочитанных байт.
 
-def upload_from_csv(db: Session, file: UserFile):
+    Raises:
+        ValueError: неизвестный формат файла
+
+    Returns:
+        int: количество загруженных строк
+    """
     log.info(file)
-    with open(file.path, "r") as csvfile:
+    if file.loaded_at is not None:
+        log.info(f"{file.filename}: already loaded")
+        return file.rows_loaded
+    header = read_header(file.path)
+    fmt = detect_format(header)
+    if fmt is None:
+        raise ValueError(f"Unknown file format {header}")
+    log.info(f"{file.filename}: format={fmt.name}")
+    file.format = fmt.name
+
+    method = method or settings.UPLOAD_METHOD
+    staging = None
+    if method == "orm":
+        upload_from_csv_orm(db, file, fmt, progress)
+    elif method == "staging":
+        staging = upload_from_csv_staging(db, file, fmt, workers, progress)
+    else:
+        upload_from_csv_copy(db, file, fmt, workers, progress)
+    finish_upload(db, file, fmt, staging)
+    return file.rows_loaded
+
+
+def finish_upload(
+    db: Session, file: UserFile, fmt: CsvFormat, staging: Optional[str] = None
+):
+    """Отмечает файл загруженным
+
+    Все изменения выполняются одной транзакцией: при UPLOAD_OVERLAP_POLICY=replace
+    удаляются строки других файлов пользователя того же формата в диапазоне дат
+    файла, при загрузке через промежуточную таблицу staging ее строки без
+    дубликатов переносятся в основную таблицу одним INSERT ... SELECT,
+    витрины app.core.rollups пересчитываются за дни файла.
+    """
+    if (
+        settings.UPLOAD_OVERLAP_POLICY == "replace"
+        and fmt.owned
+        and fmt.dated
+        and file.dt_min is not None
+    ):
+        deleted = crud.delete_overlapping_rows(db, fmt.model, file)
+        log.info(
+            f"{file.filename}: replaced {deleted} rows "
+            f"from {file.dt_min:%Y-%m-%d} to {file.dt_max:%Y-%m-%d}"
+        )
+    if staging:
+        columns = ", ".join(f'"{column}"' for column in fmt.load_columns)
         start = perf_counter()
-        csv_reader = csv.reader(csvfile, delimiter=",")
-        goods = []
-        fields = []
-
-        model_type = None
-        for i, row in enumerate(csv_reader):
-            if i % 100 == 0:
-                log.info(i)
-            if not i:
-                log.info(row)
-                if (
-                    row
-                    == "['dt', 'region_code', 'operation_type', 'org_count', 'assortment', 'count_brand', 'cnt']"
-                ):
-                    model_type = 4
-                elif row == [
-                    "dt",
-                    "region_code",
-                    "type_operation",
-                    "count_active_point",
-                    "org_count",
-                    "assortment",
-                    "count_brand",
-                    "cnt",
-                    "sum_price",
-                ]:
-                    model_type = 5
-                elif row == [
-                    "t1.dt",
-                    "sender_region_code",
-                    "receiver_region_code",
-                    "sender_org_count",
-                    "receiver_org_count",
-                    "assortment",
-                    "count_brand",
-                    "cnt_moved",
-                ]:
-                    model_type = 6
-                elif row == ["dt", "inn", "gtin", "prid", "operation_type", "cnt"]:
-                    model_type = 1
-                elif row == [
-                    "dt",
-                    "gtin",
-                    "prid",
-                    "inn",
-                    "id_sp_",
-                    "type_operation",
-                    "price",
-                    "cnt",
-                ]:
-                    model_type = 2
-                elif row == [
-                    "dt",
-                    "gtin",
-                    "prid",
-                    "sender_inn",
-                    "receiver_inn",
-                    "cnt_moved",
-                ]:
-                    model_type = 3
-                elif row == [
-                    "id_sp_",
-                    "inn",
-                    "region_code",
-                    "city_with_type",
-                    "city_fias_id",
-                    "postal_code",
-                ]:
-                    model_type = 7
-                log.info(model_type)
-                log.info(row)
-                log.info(
-                    row
-                    == [
-                        "dt",
-                        "gtin",
-                        "prid",
-                        "inn",
-                        "id_sp_",
-                        "type_operation",
-                        "price",
-                        "cnt",
-                    ]
-                )
-                continue
-            if model_type == 5:
-                goods.append(
-                    AgrSold(
-                        dt=datetime.strptime(row[0], "%Y-%m-%d"),
-                        region_code=str(row[1]),
-                        type_operation=str(row[2]),
-                        count_active_point=int(row[3]),
-                        org_count=int(row[4]),
-                        assortment=int(row[5]),
-                        count_brand=int(row[6]),
-                        cnt=int(row[7]),
-                        sum_price=int(row[8]),
-                        user=file.user,
-                        user_id=file.user.id,
-                    )
-                )
-            elif model_type == 4:
-                goods.append(
-                    AgrProduction(
-                        dt=datetime.strptime(row[0], "%Y-%m-%d"),
-                        sender_region_code=int(row[1]),
-                        receiver_region_code=int(row[2]),
-                        assortment=int(row[3]),
-                        count_brand=int(row[4]),
-                        cnt=int(row[5]),
-                        user=file.user,
-                        user_id=file.user.id,
-                    )
-                )
-            elif model_type == 6:
-                goods.append(
-                    AgrTransported(
-                        dt=datetime.strptime(row[0], "%Y-%m-%d"),
-                        sender_region_code=int(row[1]),
-                        receiver_region_code=int(row[2]),
-                        sender_org_count=int(row[3]),
-                        receiver_org_count=int(row[4]),
-                        assortment=int(row[5]),
-                        count_brand=int(row[6]),
-                        cnt_moved=int(row[7]),
-                        user=file.user,
-                        user_id=file.user.id,
-                    )
-                )
-            elif model_type == 1:
-                goods.append(
-                    ProducedGoods(
-                        dt=datetime.strptime(row[0], "%Y-%m-%d"),
-                        inn=str(row[1]),
-                        gtin=str(row[2]),
-                        prid=str(row[3]),
-                        operation_type=str(row[4]),
-                        cnt=int(row[5]),
-                        user_id=file.user.id,
-                        user=file.user,
-                    )
-                )
-            elif model_type == 2:
-                goods.append(
-                    SoldGoods(
-                        dt=datetime.strptime(row[0], "%Y-%m-%d"),
-                        gtin=str(row[1]),
-                        prid=str(row[2]),
-                        inn=str(row[3]),
-                        id_sp_=str(row[4]),
-                        type_operation=str(row[5]),
-                        price=int(row[6]),
-                        cnt=int(row[7]),
-                        user_id=file.user.id,
-                        user=file.user,
-                    )
-                )
+        inserted = db.execute(
+            text(
+                f'INSERT INTO "{fmt.table.name}" ({columns}) '
+                f'SELECT DISTINCT {columns} FROM "{staging}"'
+            )
+        ).rowcount
+        db.execute(text(f'DROP TABLE "{staging}"'))
+        log.info(
+            f"{file.filename}: moved {inserted} of {file.rows_loaded} staged rows "
+            f"into {fmt.table.name} in {perf_counter() - start:.2f} seconds"
+        )
+        file.rows_loaded = inserted
+    if fmt.model is SoldGoods and file.dt_min is not None:
+        rollups.refresh(db, file.user_id, file.dt_min, file.dt_max)
+    elif fmt.model is AddSoldGoods:
+        # регионы торговых точек входят в витрины всех пользователей
+        rollups.rebuild(db)
+    file.loaded_at = datetime.utcnow()
+    db.commit()
 
-            elif model_type == 3:
-                goods.append(
-                    TransportedGoods(
-                        dt=datetime.strptime(row[0], "%Y-%m-%d"),
-                        gtin=str(row[1]),
-                        prid=str(row[2]),
-                        sender_inn=str(row[3]),
-                        receiver_inn=str(row[4]),
-                        cnt_moved=int(row[5]),
-                        user_id=file.user.id,
-                        user=file.user,
-                    )
-                )
-            elif model_type == 7:
-                city_with_type, city_fias_id, posttal_code = row[3], row[4], row[5]
-                if not city_with_type:
-                    city_with_type = None
-                if not city_fias_id:
-                    city_fias_id = None
-                if not posttal_code:
-                    posttal_code = None
-                goods.append(
-                    AddSoldGoods(
-                        id_sp_=str(row[0]),
-                        inn=str(row[1]),
-                        region_code=int(row[2]),
-                        city_with_type=city_with_type,
-                        city_fias_id=city_fias_id,
-                        postal_code=posttal_code,
-                    )
+
+def read_header(path: str) -> list[str]:
+    with open_upload(path) as (stream, _):
+        line = stream.readline().decode("utf-8-sig")
+    return next(csv.reader([line], delimiter=","), [])
+
+
+# region parsing
+
+
+def iter_blocks(stream: BinaryIO, block_size: int) -> Iterator[tuple[int, bytes]]:
+    """Разбивает поток на блоки примерно по block_size байт по границам строк
+
+    Предполагается, что в выгрузках нет переводов строк внутри значений.
+
+    Yields:
+        tuple[int, bytes]: смещение конца блока в потоке и сам блок
+    """
+    offset = stream.tell()
+    tail = b""
+    while chunk := stream.read(block_size):
+        chunk = tail + chunk
+        cut = chunk.rfind(b"\n") + 1
+        if not cut:
+            tail = chunk
+            continue
+        tail = chunk[cut:]
+        offset += cut
+        yield offset, chunk[:cut]
+    if tail.strip():
+        offset += len(tail)
+        yield offset, tail
+
+
+def parse_block(block: bytes, format_name: str) -> pd.DataFrame:
+    """Разбор блока csv строк и приведение типов колонок
+
+    Выполняется в процессах пула, поэтому формат передается по имени.
+    """
+    fmt = FORMATS[format_name]
+    frame = pd.read_csv(
+        io.BytesIO(block),
+        header=None,
+        names=fmt.columns,
+        dtype=str,
+        keep_default_na=False,
+    )
+    return fmt.convert(frame)
+
+
+def parse_blocks(
+    blocks: Iterable[tuple[int, bytes]], format_name: str, workers: int
+) -> Iterator[tuple[int, pd.DataFrame]]:
+    """Разбирает блоки в пуле процессов, сохраняя порядок блоков
+
+    Одновременно в работе не больше 2 * workers блоков, поэтому память
+    не зависит от размера файла.
+    """
+    if workers <= 1:
+        for offset, block in blocks:
+            yield offset, parse_block(block, format_name)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=mp.get_context("spawn")
+    ) as pool:
+        pending: deque[tuple[int, Future]] = deque()
+        for offset, block in blocks:
+            pending.append((offset, pool.submit(parse_block, block, format_name)))
+            if len(pending) >= 2 * workers:
+                offset, future = pending.popleft()
+                yield offset, future.result()
+        while pending:
+            offset, future = pending.popleft()
+            yield offset, future.result()
+
+
+def _drop_loaded_dates(
+    frame: pd.DataFrame, ranges: list[tuple[datetime, datetime]]
+) -> pd.DataFrame:
+    loaded = np.zeros(len(frame), dtype=bool)
+    for dt_min, dt_max in ranges:
+        loaded |= frame["dt"].between(dt_min, dt_max).to_numpy()
+    return frame[~loaded].copy()
+
+
+def iter_frames(
+    db: Session,
+    file: UserFile,
+    fmt: CsvFormat,
+    workers: int,
+    progress: Optional[Progress] = None,
+) -> Iterator[tuple[int, pd.DataFrame]]:
+    """Блоки файла в виде DataFrame, начиная с последней контрольной точки
+
+    После того как вызывающий код записал блок, транзакция фиксируется вместе
+    с новой контрольной точкой файла (bytes_loaded, rows_loaded) и диапазоном
+    дат загруженных строк. Если загрузка прервалась, повторный вызов продолжит
+    со следующего после сохраненного блока. Сжатые файлы читаются потоком,
+    см. app.utils.files.open_upload.
+
+    При UPLOAD_OVERLAP_POLICY=skip строки с датами из диапазонов уже загруженных
+    файлов того же формата пропускаются. Значения колонок справочников
+    заменяются ключами, см. app.utils.dimensions. Для секционированных таблиц
+    секции за месяцы блока создаются до начала его транзакции.
+
+    Yields:
+        tuple[int, pd.DataFrame]: количество строк с учетом блока и сам блок
+    """
+    size = os.path.getsize(file.path)
+    resumed = total = file.rows_loaded
+    skip = []
+    if settings.UPLOAD_OVERLAP_POLICY == "skip" and fmt.owned and fmt.dated:
+        skip = crud.get_loaded_ranges(db, file)
+    dimensions = DimensionCache(db)
+    start = perf_counter()
+    with open_upload(file.path) as (stream, raw):
+        if file.bytes_loaded:
+            log.info(f"{file.filename}: resuming from {file.bytes_loaded} bytes")
+            seek_forward(stream, file.bytes_loaded)
+        else:
+            stream.readline()
+        blocks = iter_blocks(stream, settings.UPLOAD_BLOCK_SIZE)
+        for offset, frame in parse_blocks(blocks, fmt.name, workers):
+            if skip:
+                frame = _drop_loaded_dates(frame, skip)
+            if fmt.partitioned and len(frame):
+                # CREATE TABLE ... PARTITION OF ждет SHARE ROW EXCLUSIVE на
+                # справочниках внешних ключей, поэтому секции создаются до того,
+                # как транзакция блока добавит значения справочников и изменит файл
+                db.commit()
+                partitions.ensure_partitions(
+                    db.get_bind(),
+                    fmt.table.name,
+                    frame["dt"].min().to_pydatetime(),
+                    frame["dt"].max().to_pydatetime(),
                 )
-        db.bulk_save_objects(goods)
-        db.commit()
-        log.info(f"Uploaded {len(goods)} goods in {perf_counter() - start} seconds")
-
-
-# # process file function
-# def processfile(filename, start=0, stop=0):
-#     if start == 0 and stop == 0:
-#         ... process entire file...
-#     else:
-#         with open(file, 'r') as fh:
-#             fh.seek(start)
-#             lines = fh.readlines(stop - start)
-#             for i, row in lines:
-#                 if i % 100 == 0:
-#                     log.info(i)
-#                 if i  == 0:
-#                     log.info(row)
-#                     if (
-#                         row
-#                         == "['dt', 'region_code', 'operation_type', 'org_count', 'assortment', 'count_brand', 'cnt']"
-#                     ):
-#                         model_type = 4
-#                     elif row == [
-#                         "dt",
-#                         "region_code",
-#                         "type_operation",
-#                         "count_active_point",
-#                         "org_count",
-#                         "assortment",
-#                         "count_brand",
-#                         "cnt",
-#                         "sum_price",
-#                     ]:
-#                         model_type = 5
-#                     elif row == [
-#                         "t1.dt",
-#                         "sender_region_code",
-#                         "receiver_region_code",
-#                         "sender_org_count",
-#                         "receiver_org_count",
-#                         "assortment",
-#                         "count_brand",
-#                         "cnt_moved",
-#                     ]:
-#                         model_type = 6
-#                     elif row == ["dt", "inn", "gtin", "prid", "operation_type", "cnt"]:
-#                         model_type = 1
-#                     elif row == [
-#                         "dt",
-#                         "gtin",
-#                         "prid",
-#                         "inn",
-#                         "id_sp_",
-#                         "type_operation",
-#                         "price",
-#                         "cnt",
-#                     ]:
-#                         model_type = 2
-#                     elif row == [
-#                         "dt",
-#                         "gtin",
-#                         "prid",
-#                         "sender_inn",
-#                         "receiver_inn",
-#                         "cnt_moved",
-#                     ]:
-#                         model_type = 3
-#                     elif row == [
-#                         "id_sp_",
-#                         "inn",
-#                         "region_code",
-#                         "city_with_type",
-#                         "city_fias_id",
-#                         "postal_code",
-#                     ]:
-#                         model_type = 7
-#                     log.info(model_type)
-#                     log.info(row)
-#                     log.info(
-#                         row
-#                         == [
-#                             "dt",
-#                             "gtin",
-#                             "prid",
-#                             "inn",
-#                             "id_sp_",
-#                             "type_operation",
-#                             "price",
-#                             "cnt",
-#                         ]
-#                     )
-#                     continue
-#                 elif model_type == 5:
-#                     goods.append(
-#                         AgrSold(
-#                             dt=datetime.strptime(row[0], "%Y-%m-%d"),
-#                             region_code=str(row[1]),
-#                             type_operation=str(row[2]),
-#                             count_active_point=int(row[3]),
-#                             org_count=int(row[4]),
-#                             assortment=int(row[5]),
-#                             count_brand=int(row[6]),
-#                             cnt=int(row[7]),
-#                             sum_price=int(row[8]),
-#                             user=file.user,
-#                             user_id=file.user.id,
-#                         )
-#                     )
-#                 elif model_type == 4:
-#                     goods.append(
-#                         AgrProduction(
-#                             dt=datetime.strptime(row[0], "%Y-%m-%d"),
-#                             sender_region_code=int(row[1]),
-#                             receiver_region_code=int(row[2]),
-#                             assortment=int(row[3]),
-#                             count_brand=int(row[4]),
-#                             cnt=int(row[5]),
-#                             user=file.user,
-#                             user_id=file.user.id,
-#                         )
-#                     )
-#                 elif model_type == 6:
-#                     goods.append(
-#                         AgrTransported(
-#                             dt=datetime.strptime(row[0], "%Y-%m-%d"),
-#                             sender_region_code=int(row[1]),
-#                             receiver_region_code=int(row[2]),
-#                             sender_org_count=int(row[3]),
-#                             receiver_org_count=int(row[4]),
-#                             assortment=int(row[5]),
-#                             count_brand=int(row[6]),
-#                             cnt_moved=int(row[7]),
-#                             user=file.user,
-#                             user_id=file.user.id,
-#                         )
-#                     )
-#                 elif model_type == 1:
-#                     goods.append(
-#                         ProducedGoods(
-#                             dt=datetime.strptime(row[0], "%Y-%m-%d"),
-#                             inn=str(row[1]),
-#                             gtin=str(row[2]),
-#                             prid=str(row[3]),
-#                             operation_type=str(row[4]),
-#                             cnt=int(row[5]),
-#                             user_id=file.user.id,
-#                             user=file.user,
-#                         )
-#                     )
-#                 elif model_type == 2:
-#                     goods.append(
-#                         SoldGoods(
-#                             dt=datetime.strptime(row[0], "%Y-%m-%d"),
-#                             gtin=str(row[1]),
-#                             prid=str(row[2]),
-#                             inn=str(row[3]),
-#                             id_sp_=str(row[4]),
-#                             type_operation=str(row[5]),
-#                             price=int(row[6]),
-#                             cnt=int(row[7]),
-#                             user_id=file.user.id,
-#                             user=file.user,
-#                         )
-#                     )
-
-#                 elif model_type == 3:
-#                     goods.append(
-#                         TransportedGoods(
-#                             dt=datetime.strptime(row[0], "%Y-%m-%d"),
-#                             gtin=str(row[1]),
-#                             prid=str(row[2]),
-#                             sender_inn=str(row[3]),
-#                             receiver_inn=str(row[4]),
-#                             cnt_moved=int(row[5]),
-#                             user_id=file.user.id,
-#                             user=file.user,
-#                         )
-#                     )
-#                 elif model_type == 7:
-#                     city_with_type, city_fias_id, posttal_code = row[3], row[4], row[5]
-#                     if not city_with_type:
-#                         city_with_type = None
-#                     if not city_fias_id:
-#                         city_fias_id = None
-#                     if not posttal_code:
-#                         posttal_code = None
-#                     goods.append(
-#                         AddSoldGoods(
-#                             id_sp_=str(row[0]),
-#                             inn=str(row[1]),
-#                             region_code=int(row[2]),
-#                             city_with_type=city_with_type,
-#                             city_fias_id=city_fias_id,
-#                             postal_code=posttal_code,
-#                         )
-#                     )
-#             db.bulk_save_objects(goods)
-#             db.commit()
-#             log.info(f"Uploaded {len(goods)} goods in {perf_counter() - start} seconds")
-
-
-#     return results
-
-
-# def parce(db: Session, file: UserFile):
-#         # get file size and set chuck size
-#     filesize = os.path.getsize(file.path)
-#     split_size = 100*1024*1024
-
-#     # determine if it needs to be split
-#     if filesize > split_size:
-
-#         # create pool, initialize chunk start location (cursor)
-#         pool = mp.Pool(4)
-#         cursor = 0
-#         results = []
-#         with open(file, 'r') as fh:
-
-#             # for every chunk in the file...
-#             for chunk in range(filesize // split_size):
-
-#                 # determine where the chunk ends, is it the last one?
-#                 if cursor + split_size > filesize:
-#                     end = filesize
-#                 else:
-#                     end = cursor + split_size
-
-#                 # seek to end of chunk and read next line to ensure you
-#                 # pass entire lines to the processfile function
-#                 fh.seek(end)
-#                 fh.readline()
-
-#                 # get current file location
-#                 end = fh.tell()
-
-#                 # add chunk to process pool, save reference to get results
-#                 proc = pool.apply_async(processfile, args=[file.path, cursor, end])
-#                 results.append(proc)
-
-#                 # setup next chunk
-#                 cursor = end
-
-#         # close and wait for pool to finish
-#         pool.close()
-#         pool.join()
-
-#         # iterate through results
-#         for proc in results:
-#             processfile_result = proc.get()
-
-
-# # fields = csvfile.readline()
-# # log.info(fields)
-# # # "dt","inn","gtin","prid","operation_type","cnt"
-# # goods = []
-# # start = perf_counter()
-# # if (
-# #     fields
-# #     == '"dt","region_code","type_operation","count_active_point","org_count","assortment","count_brand","cnt","sum_price"\n'
-# # ):
-# #     for l in csvfile.readlines():
-# #         goods.append(
-# #             AgrSold(
-# #                 dt=datetime.strptime(l.split(",")[0], "%Y-%m-%d"),
-# #                 region_code=str(l.split(",")[1]).replace('"', ""),
-# #                 type_operation=str(l.split(",")[2]).replace('"', ""),
-# #                 count_active_point=int(l.split(",")[3].replace('"', "")),
-# #                 org_count=int(l.split(",")[4].replace('"', "")),
-# #                 assortment=int(l.split(",")[5].replace('"', "")),
-# #                 count_brand=int(l.split(",")[6].replace('"', "")),
-# #                 cnt=int(l.split(",")[7].replace('"', "")),
-# #                 sum_price=int(l.split(",")[8].replace('"', "")),
-# #                 user=file.user,
-# #             )
-# #         )
-# # elif (
-# #     fields
-# #     == '"dt","region_code","operation_type","org_count","assortment","count_brand","cnt"'
-# # ):
-# #     for l in csvfile.readlines():
-# #         goods.append(
-# #             AgrProduction(
-# #                 dt=datetime.strptime(l.split(",")[0], "%Y-%m-%d"),
-# #                 region_code=str(l.split(",")[1]).replace('"', ""),
-# #                 operation_type=str(l.split(",")[2]).replace('"', ""),
-# #                 org_count=int(l.split(",")[3].replace('"', "")),
-# #                 assortment=int(l.split(",")[4].replace('"', "")),
-# #                 count_brand=int(l.split(",")[5].replace('"', "")),
-# #                 cnt=int(l.split(",")[6].replace('"', "")),
-# #                 user=file.user,
-# #             )
-# #         )
-
-# # elif fields == '"dt","inn","gtin","prid","operation_type","cnt"\n':
-
-# #     for l in csvfile.readlines():
-# #         goods.append(
-# #             ProducedGoods(
-# #                 dt=datetime.strptime(l.split(",")[0], "%Y-%m-%d"),
-# #                 inn=str(l.split(",")[1]).replace('"', ""),
-# #                 gtin=str(l.split(",")[2]).replace('"', ""),
-# #                 prid=str(l.split(",")[3]).replace('"', ""),
-# #                 operation_type=str(l.split(",")[4]).replace('"', ""),
-# #                 cnt=int(l.split(",")[5]),
-# #                 user=file.user,
-# #             )
-# #         )
-
-# # elif (
-# #     fields
-# #     == '"dt","gtin","prid","inn","id_sp_","type_operation","price","cnt"\n'
-# # ):
-# #     # "dt","gtin","prid","inn","id_sp_","type_operation","price","cnt"
-# #     for l in csvfile.readlines():
-# #         goods.append(
-# #             SoldGoods(
-# #                 dt=datetime.strptime(l.split(",")[0], "%Y-%m-%d"),
-# #                 gtin=str(l.split(",")[1]).replace('"', ""),
-# #                 prid=str(l.split(",")[2]).replace('"', ""),
-# #                 inn=str(l.split(",")[3]).replace('"', ""),
-# #                 id_sp_=str(l.split(",")[4]).replace('"', ""),
-# #                 type_operation=str(l.split(",")[5]).replace('"', ""),
-# #                 price=int(l.split(",")[6]),
-# #                 cnt=int(l.split(",")[7]),
-# #                 user=file.user,
-# #             )
-# #         )
-# # elif fields == '"dt","gtin","prid","sender_inn","receiver_inn","cnt_moved"\n':
-# #     for l in csvfile.readlines():
-# #         goods.append(
-# #             TransportedGoods(
-# #                 dt=datetime.strptime(l.split(",")[0], "%Y-%m-%d"),
-# #                 gtin=str(l.split(",")[1]).replace('"', ""),
-# #                 prid=str(l.split(",")[2]).replace('"', ""),
-# #                 sender_inn=str(l.split(",")[3]).replace('"', ""),
-# #                 receiver_inn=str(l.split(",")[4]).replace('"', ""),
-# #                 cnt_moved=int(l.split(",")[5]),
-# #                 user=file.user,
-# #             )
-# #         )
+            if fmt.dimensions:
+                frame = dimensions.encode(frame, fmt.dimensions)
+            if fmt.owned:
+                frame["user_id"] = file.user_id
+                frame["file_id"] = file.id
+            if fmt.dated and len(frame):
+                dt_min = frame["dt"].min().to_pydatetime()
+                dt_max = frame["dt"].max().to_pydatetime()
+                file.dt_min = min(file.dt_min or dt_min, dt_min)
+                file.dt_max = max(file.dt_max or dt_max, dt_max)
+            total += len(frame)
+            yield total, frame
+
+            file.bytes_loaded = offset
+            file.rows_loaded = total
+            db.commit()
+
+            # для сжатых файлов offset в распакованных байтах, прогресс
+            # считается по прочитанной части файла на диске
+            read = raw.tell()
+            elapsed = perf_counter() - start
+            log.info(
+                f"{file.filename}: {total} rows, {read}/{size} bytes, "
+                f"{(total - resumed) / elapsed:.0f} rows/s"
+            )
+            if progress:
+                progress(total, read)
+
+
+# endregion parsing
+
+
+# region copy upload
+
+
+def _copy_frame(
+    db: Session, fmt: CsvFormat, frame: pd.DataFrame, table: Optional[str] = None
+):
+    """Отправляет пачку строк в postgres через COPY FROM STDIN
+
+    По умолчанию в таблицу формата, table - в другую таблицу с теми же колонками.
+    """
+    buffer = io.StringIO()
+    frame.to_csv(buffer, header=False, index=False, date_format="%Y-%m-%d")
+    buffer.seek(0)
+
+    columns = ", ".join(f'"{column}"' for column in frame.columns)
+    options = "FORMAT csv"
+    if fmt.not_null:
+        # пустые строки в NOT NULL колонках загружаются как "", а не NULL
+        options += ", FORCE_NOT_NULL ({})".format(
+            ", ".join(f'"{column}"' for column in fmt.not_null)
+        )
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f'COPY "{table or fmt.table.name}" ({columns}) FROM STDIN WITH ({options})',
+            buffer,
+        )
+    finally:
+        cursor.close()
+
+
+def upload_from_csv_copy(
+    db: Session,
+    file: UserFile,
+    fmt: CsvFormat,
+    workers: Optional[int] = None,
+    progress: Optional[Progress] = None,
+) -> int:
+    """Потоковая загрузка csv файла через COPY FROM STDIN
+
+    Файл читается блоками по settings.UPLOAD_BLOCK_SIZE байт, блоки разбираются
+    в workers процессах (settings.UPLOAD_WORKERS), типы колонок приводятся для
+    всего блока сразу. Запись в базу идет из одного соединения в порядке блоков,
+    каждый блок сохраняется вместе с контрольной точкой, см. iter_frames.
+    """
+    workers = workers or settings.UPLOAD_WORKERS
+    if os.path.getsize(file.path) <= settings.UPLOAD_BLOCK_SIZE:
+        workers = 1
+
+    start = perf_counter()
+    resumed = total = file.rows_loaded
+    for total, frame in iter_frames(db, file, fmt, workers, progress):
+        _copy_frame(db, fmt, frame)
+
+    elapsed = perf_counter() - start
+    loaded = total - resumed
+    log.info(
+        f"Uploaded {loaded} rows into {fmt.table.name} in {elapsed:.2f} seconds "
+        f"({loaded / elapsed if elapsed else 0:.0f} rows/s, {workers} workers)"
+    )
+    return total
+
+
+# endregion copy upload
+
+
+# region staging upload
+
+
+def upload_from_csv_staging(
+    db: Session,
+    file: UserFile,
+    fmt: CsvFormat,
+    workers: Optional[int] = None,
+    progress: Optional[Progress] = None,
+) -> str:
+    """Загрузка csv файла через COPY в промежуточную таблицу
+
+    Промежуточная таблица - UNLOGGED и без индексов, поэтому загрузка в нее
+    не пишет WAL и не обновляет индексы. Перенос в основную таблицу выполняет
+    finish_upload.
+
+    Returns:
+        str: имя промежуточной таблицы
+    """
+    staging = f"staging_user_file_{file.id}"
+    db.execute(
+        text(
+            f'CREATE UNLOGGED TABLE IF NOT EXISTS "{staging}" '
+            f'(LIKE "{fmt.table.name}")'
+        )
+    )
+    db.execute(text(f'ALTER TABLE "{staging}" DROP COLUMN IF EXISTS id'))
+    staged = db.execute(text(f'SELECT count(*) FROM "{staging}"')).scalar_one()
+    if staged != file.rows_loaded:
+        # UNLOGGED таблица очищается после аварийной остановки postgres,
+        # в этом случае контрольная точка недействительна
+        log.warning(
+            f"{file.filename}: {staged} staged rows, expected {file.rows_loaded}, "
+            "loading from the beginning"
+        )
+        db.execute(text(f'TRUNCATE "{staging}"'))
+        file.bytes_loaded = 0
+        file.rows_loaded = 0
+        file.dt_min = None
+        file.dt_max = None
+    db.commit()
+
+    workers = workers or settings.UPLOAD_WORKERS
+    if os.path.getsize(file.path) <= settings.UPLOAD_BLOCK_SIZE:
+        workers = 1
+
+    start = perf_counter()
+    resumed = total = file.rows_loaded
+    for total, frame in iter_frames(db, file, fmt, workers, progress):
+        _copy_frame(db, fmt, frame, staging)
+
+    elapsed = perf_counter() - start
+    loaded = total - resumed
+    log.info(
+        f"Staged {loaded} rows into {staging} in {elapsed:.2f} seconds "
+        f"({loaded / elapsed if elapsed else 0:.0f} rows/s, {workers} workers)"
+    )
+    return staging
+
+
+# endregion staging upload
+
+
+# region orm upload
+
+
+def upload_from_csv_orm(
+    db: Session, file: UserFile, fmt: CsvFormat, progress: Optional[Progress] = None
+) -> int:
+    """Загрузка csv файла через ORM объекты, используется для сравнения с COPY"""
+    start = perf_counter()
+    resumed = total = file.rows_loaded
+    for total, frame in iter_frames(db, file, fmt, 1, progress):
+        db.bulk_save_objects([fmt.model(**row) for row in fmt.records(frame)])
+
+    elapsed = perf_counter() - start
+    loaded = total - resumed
+    log.info(
+        f"Uploaded {loaded} goods in {elapsed} seconds "
+        f"({loaded / elapsed if elapsed else 0:.0f} rows/s)"
+    )
+    return total
+
+
+# endregion orm upload
@@ -0,0 +1,63 @@
+"""Сравнение выбора первых k товаров по регионам: цикл по регионам с
+фильтрацией всей таблицы (как было в app.core.ml) и ml.top_k_by_group с
+ml.group_lists
+
+Запуск из src с переменными окружения приложения:
+    python -m benchmarks.region_top_k
+"""
+from timeit import timeit
+
+import numpy as np
+import pandas as pd
+
+from app.core import ml
+
+REGIONS = 85
+K = 5
+
+
+def _groups(gtins: int, seed: int = 0) -> pd.DataFrame:
+    """Суммы продаж по (регион, gtin), как groups в
+    ml.popular_offline_gtin_manufacturer_region"""
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_product(
+        [np.arange(1, REGIONS + 1), np.arange(gtins)], names=["region_code", "gtin"]
+    )
+    return pd.DataFrame(
+        {"cnt": rng.integers(1, 10_000, len(index))}, index=index
+    ).reset_index()
+
+
+def loop_by_region(groups: pd.DataFrame) -> dict:
+    popular = groups.sort_values(by=["cnt"], ascending=False)
+    result = {}
+    for i in map(int, popular["region_code"].unique()):
+        data = popular[popular["region_code"] == i][:K][["gtin", "cnt"]]
+        result[i] = {
+            "gtin": list(map(int, data["gtin"].values)),
+            "count": list(map(int, data["cnt"].values)),
+        }
+    return result
+
+
+def top_k_by_group(groups: pd.DataFrame) -> dict:
+    top = ml.top_k_by_group(groups, "region_code", "cnt", "gtin", K)
+    return ml.group_lists(top, "region_code", {"gtin": "gtin", "count": "cnt"})
+
+
+def main():
+    print(f"{REGIONS} regions, top {K}")
+    print(f"{'gtins':>8} {'rows':>10} {'loop, s':>10} {'top_k, s':>10} {'speedup':>8}")
+    for gtins in (100, 1_000, 10_000, 50_000):
+        groups = _groups(gtins)
+        number = max(1, 200_000 // len(groups))
+        loop = timeit(lambda: loop_by_region(groups), number=number) / number
+        top_k = timeit(lambda: top_k_by_group(groups), number=number) / number
+        print(
+            f"{gtins:>8} {len(groups):>10} {loop:>10.4f} {top_k:>10.4f} "
+            f"{loop / top_k:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
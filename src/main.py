@@ -1,14 +1,14 @@
 import uvicorn
-from app.app import create_app
 import os
 
-app = create_app()
-
 if __name__ == "__main__":
     if not "static" in os.listdir():
         os.mkdir("static")
+    # приложение создается фабрикой в процессе сервера: main.py импортируют и
+    # процессы разбора файлов (spawn), им не нужны подключение к базе и миграции
     uvicorn.run(
-        "main:app",
+        "app.app:create_app",
+        factory=True,
         reload=True,
         use_colors=True,
         host="0.0.0.0",
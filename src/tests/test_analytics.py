@@ -0,0 +1,68 @@
+from datetime import date
+
+import pandas as pd
+import pytest
+
+from app.core.analytics import METRICS, ManufacturerAnalytics
+from conftest import decode_gtin, decode_sale_point, reference
+
+
+@pytest.fixture(scope="module")
+def analytics(sales) -> ManufacturerAnalytics:
+    sold, points = sales
+    return ManufacturerAnalytics(sold, points, decode_gtin, decode_sale_point)
+
+
+@pytest.mark.parametrize("metric", METRICS)
+def test_matches_reference(sales, analytics, metric):
+    sold, points = sales
+    assert analytics.compute([metric])[metric] == reference(metric, sold, points)
+
+
+@pytest.mark.parametrize("metric", METRICS)
+def test_window_matches_reference_on_window_sales(sales, analytics, metric):
+    # окно в пределах одного года и после дат app.core.ml: эталон по продажам
+    # окна совпадает с метрикой за окно
+    sold, points = sales
+    date_from, date_to = date(2022, 9, 10), date(2022, 11, 20)
+    window = sold[
+        (sold["dt"] >= pd.Timestamp(date_from)) & (sold["dt"] < pd.Timestamp(date_to))
+    ]
+    result = analytics.compute([metric], date_from=date_from, date_to=date_to)
+    assert result[metric] == reference(metric, window, points)
+
+
+@pytest.mark.parametrize(
+    "granularity, freq", [("day", "D"), ("week", "W"), ("month", "M"), ("quarter", "Q")]
+)
+def test_granularity(sales, analytics, granularity, freq):
+    sold, points = sales
+    sold = sold[sold["dt"] >= pd.Timestamp("2022-01-01")]
+    merged = sold.merge(points, on="id_sp_", how="left")
+    period = merged["dt"].dt.to_period(freq).dt.start_time.dt.date.astype(str)
+    merged = merged.assign(period=period, sum_price=merged["price"] * merged["cnt"])
+
+    volumes = merged[merged["region_code"].notna()].groupby("period")
+    volumes = volumes[["cnt", "sum_price"]].sum()
+    assert analytics.volumes_manufacturer(granularity=granularity) == {
+        "period": volumes.index.tolist(),
+        "count": volumes["cnt"].tolist(),
+        "sum_price": volumes["sum_price"].tolist(),
+    }
+
+    shops = merged.groupby("period")["id_sp_"].nunique()
+    assert analytics.shops_manufacturer_count(granularity=granularity) == {
+        "period": shops.index.tolist(),
+        "count": shops.tolist(),
+    }
+
+
+def test_empty_window(analytics):
+    assert analytics.volumes_manufacturer(date_from=date(2030, 1, 1)) == {
+        "month": [],
+        "count": [],
+        "sum_price": [],
+    }
+    assert analytics.popular_online_gtin_manufacturer(
+        date_from=date(2022, 5, 1), date_to=date(2022, 5, 1)
+    ) == {"gtin": [], "count": []}
@@ -0,0 +1,87 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.core.models import SoldGoods
+from app.utils import export
+
+ROWS = [
+    (datetime(2023, 1, 1) + timedelta(days=i), f"G{i}", "P", "I", f"S{i}", "1", 100, i)
+    for i in range(25)
+]
+
+
+@pytest.fixture(autouse=True)
+def batches(monkeypatch):
+    # строки выгрузки пачками по 10, как из серверного курсора
+    async def iter_batches(statement):
+        for i in range(0, len(ROWS), 10):
+            yield ROWS[i : i + 10]
+
+    monkeypatch.setattr(export, "iter_batches", iter_batches)
+
+
+def _export(format: str, encoding=None) -> bytes:
+    async def read() -> bytes:
+        body = export.export_goods(SoldGoods, 1, format, encoding)
+        return b"".join([data async for data in body])
+
+    return asyncio.run(read())
+
+
+@pytest.mark.parametrize("encoding", [None, "gzip"])
+def test_ndjson_export(encoding):
+    data = _export("ndjson", encoding)
+    if encoding:
+        data = gzip.decompress(data)
+    rows = [json.loads(line) for line in data.decode().splitlines()]
+
+    assert len(rows) == len(ROWS)
+    assert rows[0] == {
+        "dt": "2023-01-01T00:00:00",
+        "gtin": "G0",
+        "prid": "P",
+        "inn": "I",
+        "id_sp_": "S0",
+        "type_operation": "1",
+        "price": 100,
+        "cnt": 0,
+    }
+    assert [row["cnt"] for row in rows] == list(range(len(ROWS)))
+
+
+@pytest.mark.parametrize("encoding", [None, "gzip"])
+def test_csv_export(encoding):
+    data = _export("csv", encoding)
+    if encoding:
+        data = gzip.decompress(data)
+    header, *rows = list(csv.reader(io.StringIO(data.decode())))
+
+    assert header == [
+        "dt",
+        "gtin",
+        "prid",
+        "inn",
+        "id_sp_",
+        "type_operation",
+        "price",
+        "cnt",
+    ]
+    assert len(rows) == len(ROWS)
+    assert rows[-1] == ["2023-01-25T00:00:00", "G24", "P", "I", "S24", "1", "100", "24"]
+
+
+def test_csv_export_without_rows_has_header(monkeypatch):
+    async def iter_batches(statement):
+        return
+        yield
+
+    monkeypatch.setattr(export, "iter_batches", iter_batches)
+    assert _export("csv").decode().splitlines() == [
+        "dt,gtin,prid,inn,id_sp_,type_operation,price,cnt"
+    ]
@@ -0,0 +1,61 @@
+import gzip
+import io
+
+import pytest
+
+from app.utils.files import open_upload, save_upload, seek_forward, UploadTooLarge
+
+DATA = b"dt,gtin,cnt\n" + b"".join(
+    f"2023-01-{day:02d},G{day},{day}\n".encode() for day in range(1, 29)
+)
+
+
+def _write(path, compression):
+    if compression == "gzip":
+        data = gzip.compress(DATA)
+    elif compression == "zstd":
+        zstandard = pytest.importorskip("zstandard")
+        data = zstandard.ZstdCompressor().compress(DATA)
+    else:
+        data = DATA
+    path.write_bytes(data)
+    return len(data)
+
+
+@pytest.mark.parametrize(
+    "compression, name",
+    [(None, "sold.csv"), ("gzip", "sold.csv.gz"), ("zstd", "sold.csv.zst")],
+)
+def test_open_upload_decompresses(tmp_path, compression, name):
+    path = tmp_path / name
+    size = _write(path, compression)
+    with open_upload(str(path)) as (stream, raw):
+        assert stream.readline() == b"dt,gtin,cnt\n"
+        assert stream.read() == DATA[len(b"dt,gtin,cnt\n") :]
+        # исходный файл прочитан полностью
+        assert raw.tell() == size
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", "zstd"])
+def test_seek_forward_by_uncompressed_offset(tmp_path, compression):
+    path = tmp_path / "sold"
+    _write(path, compression)
+    offset = DATA.index(b"2023-01-10")
+    with open_upload(str(path)) as (stream, _):
+        seek_forward(stream, offset)
+        assert stream.readline() == b"2023-01-10,G10,10\n"
+
+
+def test_save_upload(tmp_path):
+    path = tmp_path / "sold.csv"
+    size, sha256 = save_upload(
+        io.BytesIO(DATA), str(path), max_size=len(DATA), chunk_size=7
+    )
+    assert (size, path.read_bytes()) == (len(DATA), DATA)
+    assert len(sha256) == 64
+
+    with pytest.raises(UploadTooLarge):
+        save_upload(
+            io.BytesIO(DATA), str(tmp_path / "big.csv"), max_size=len(DATA) - 1
+        )
+    assert list(tmp_path.iterdir()) == [path]
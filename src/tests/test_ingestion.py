@@ -0,0 +1,153 @@
+"""Загрузка выгрузок app.utils.uploader в тестовую базу
+
+Нужна отдельная база PostgreSQL: TEST_DATABASE_URL, см. conftest.py
+"""
+import csv
+import gzip
+import shutil
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.orm import Session
+
+from app.core import migrations, models
+from app.core.database import Base
+from app.core.settings import settings
+from app.utils import uploader
+from app.utils.formats import FORMATS
+from app.utils.uploader import (
+    finish_upload,
+    upload_from_csv,
+    upload_from_csv_staging,
+)
+from conftest import TEST_DATABASE_URL, drop_all, requires_db
+
+pytestmark = requires_db
+
+
+@pytest.fixture(scope="module")
+def engine():
+    engine = create_engine(TEST_DATABASE_URL)
+    drop_all(engine)
+    Base.metadata.create_all(engine)
+    migrations.upgrade(engine, fresh=True)
+    yield engine
+    drop_all(engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def db(engine):
+    with Session(engine) as db:
+        yield db
+
+
+def write_sold(path, first: date, days: int):
+    """Выгрузка продаж, по строке на день начиная с first, cnt строки - ее номер"""
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(FORMATS["sold"].header)
+        for i in range(days):
+            dt = first + timedelta(days=i)
+            writer.writerow([dt, f"G{i % 5}", "P", "I", f"S{i % 3}", 1, 100, i + 1])
+
+
+def add_file(db: Session, path, username: str) -> models.UserFile:
+    user = models.User(username=username, password="", email="")
+    db.add(user)
+    db.flush()
+    file = models.UserFile(filename=path.name, path=str(path), user_id=user.id)
+    db.add(file)
+    db.commit()
+    return file
+
+
+def loaded_cnt(db: Session, file: models.UserFile) -> list[int]:
+    return db.scalars(
+        select(models.SoldGoods.cnt)
+        .where(models.SoldGoods.file_id == file.id)
+        .order_by(models.SoldGoods.cnt)
+    ).all()
+
+
+@pytest.mark.parametrize("method", ["copy", "staging", "orm"])
+def test_loads_past_months(db, tmp_path, method):
+    # секций за 2019 год нет ни заранее, ни при старте приложения, они создаются
+    # при загрузке блока
+    path = tmp_path / "sold.csv"
+    write_sold(path, date(2019, 3, 20), 30)
+    file = add_file(db, path, f"past-{method}")
+
+    assert upload_from_csv(db, file, method=method, workers=1) == 30
+    assert loaded_cnt(db, file) == list(range(1, 31))
+    assert file.dt_min.date() == date(2019, 3, 20)
+    assert file.dt_max.date() == date(2019, 4, 18)
+    names = db.scalars(
+        text(
+            "SELECT relname FROM pg_class "
+            "WHERE relkind = 'r' AND relname LIKE 'sold\\_goods\\_2019\\_%' "
+            "ORDER BY relname"
+        )
+    ).all()
+    assert names == ["sold_goods_2019_03", "sold_goods_2019_04"]
+
+
+def test_staging_moves_distinct_rows_in_one_transaction(db, tmp_path):
+    path = tmp_path / "sold.csv"
+    write_sold(path, date(2019, 8, 1), 10)
+    with open(path) as f:
+        lines = f.readlines()
+    # повторная выгрузка тех же строк в одном файле
+    with open(path, "a") as f:
+        f.writelines(lines[1:6])
+    file = add_file(db, path, "staging")
+    fmt = FORMATS["sold"]
+
+    staging = upload_from_csv_staging(db, file, fmt, workers=1)
+    assert file.rows_loaded == 15
+    assert loaded_cnt(db, file) == []
+
+    finish_upload(db, file, fmt, staging)
+    assert file.rows_loaded == 10
+    assert loaded_cnt(db, file) == list(range(1, 11))
+    assert db.scalar(text("SELECT to_regclass(:name)"), {"name": staging}) is None
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_resumes_after_interrupted_block(engine, tmp_path, monkeypatch, compressed):
+    path = tmp_path / "sold.csv"
+    write_sold(path, date(2019, 6, 1), 60)
+    if compressed:
+        with open(path, "rb") as source, gzip.open(f"{path}.gz", "wb") as target:
+            shutil.copyfileobj(source, target)
+        path = tmp_path / "sold.csv.gz"
+    monkeypatch.setattr(settings, "UPLOAD_BLOCK_SIZE", 256)
+
+    # третий блок записан, но загрузка прерывается до фиксации его транзакции
+    copy_frame = uploader._copy_frame
+    copied = []
+
+    def interrupted(db, fmt, frame, table=None):
+        copy_frame(db, fmt, frame, table)
+        copied.append(len(frame))
+        if len(copied) == 3:
+            raise RuntimeError("interrupted")
+
+    monkeypatch.setattr(uploader, "_copy_frame", interrupted)
+    with Session(engine) as db:
+        file = add_file(db, path, f"resume-{compressed}")
+        file_id = file.id
+        with pytest.raises(RuntimeError):
+            upload_from_csv(db, file, method="copy", workers=1)
+        db.rollback()
+
+    with Session(engine) as db:
+        file = db.get(models.UserFile, file_id)
+        # сохранены первые два блока вместе с контрольной точкой
+        assert file.rows_loaded == copied[0] + copied[1]
+        assert loaded_cnt(db, file) == list(range(1, file.rows_loaded + 1))
+
+        monkeypatch.setattr(uploader, "_copy_frame", copy_frame)
+        assert upload_from_csv(db, file, method="copy", workers=1) == 60
+        assert loaded_cnt(db, file) == list(range(1, 61))
@@ -0,0 +1,54 @@
+import base64
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from app.utils.pagination import (
+    InvalidCursor,
+    decode_cursor,
+    encode_cursor,
+    goods_page,
+)
+
+
+@pytest.mark.parametrize(
+    "dt, id",
+    [
+        (datetime(2023, 1, 1), 1),
+        (datetime(2023, 12, 31, 23, 59, 59, 999999), 2**40),
+    ],
+)
+def test_cursor_round_trip(dt, id):
+    cursor = encode_cursor(dt, id)
+    assert decode_cursor(cursor) == (dt, id)
+    # курсор передается в query string без экранирования
+    assert base64.urlsafe_b64decode(cursor)
+    assert not set(cursor) & set("+/")
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "",
+        "not a cursor",
+        base64.urlsafe_b64encode(b"2023-01-01").decode(),
+        base64.urlsafe_b64encode(b"2023-01-01|1|2").decode(),
+        base64.urlsafe_b64encode(b"yesterday|1").decode(),
+        base64.urlsafe_b64encode(b"2023-01-01|first").decode(),
+        base64.urlsafe_b64encode(b"\xff\xfe|1").decode(),
+    ],
+)
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor)
+
+
+def test_goods_page_cursor_points_to_last_row():
+    rows = [SimpleNamespace(dt=datetime(2023, 1, day), id=day) for day in range(1, 5)]
+
+    page, cursor = goods_page(rows, 3)
+    assert page == rows[:3]
+    assert decode_cursor(cursor) == (datetime(2023, 1, 3), 3)
+
+    assert goods_page(rows, 4) == (rows, None)
@@ -0,0 +1,107 @@
+"""Метрики app.core.sql_metrics по витринам app.core.rollups против эталона
+
+Нужна отдельная база PostgreSQL: TEST_DATABASE_URL, см. conftest.py
+"""
+import asyncio
+from datetime import date
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, insert, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session
+
+from app.core import migrations, models, partitions, rollups, sql_metrics
+from app.core.analytics import METRICS
+from app.core.database import Base
+from conftest import (
+    GTINS,
+    SALE_POINTS,
+    TEST_DATABASE_URL,
+    drop_all,
+    reference,
+    requires_db,
+)
+
+pytestmark = requires_db
+
+
+@pytest.fixture(scope="module")
+def user_id(sales) -> int:
+    """Пользователь с продажами sales в тестовой базе, витрины пересчитаны"""
+    sold, points = sales
+    engine = create_engine(TEST_DATABASE_URL)
+    drop_all(engine)
+    Base.metadata.create_all(engine)
+    migrations.upgrade(engine, fresh=True)
+    partitions.ensure_partitions(
+        engine, models.SoldGoods.__tablename__, sold["dt"].min(), sold["dt"].max()
+    )
+    with Session(engine) as db:
+        user = models.User(username="tests", password="", email="")
+        prid, inn = models.Prid(value="prid"), models.Inn(value="inn")
+        db.add_all([user, prid, inn])
+        # ключи справочников совпадают с ключами продаж sales
+        db.add_all(models.Gtin(id=i, value=f"G{i}") for i in range(1, GTINS + 1))
+        db.add_all(
+            models.SalePoint(id=i, value=f"S{i}") for i in range(1, SALE_POINTS + 1)
+        )
+        db.flush()
+        db.add_all(
+            models.AddSoldGoods(sale_point_id=int(i), inn="inn", region_code=int(code))
+            for i, code in zip(points["id_sp_"], points["region_code"])
+        )
+        db.execute(
+            insert(models.SoldGoods),
+            [
+                {
+                    "dt": row.dt.to_pydatetime(),
+                    "gtin_id": int(row.gtin),
+                    "prid_id": prid.id,
+                    "inn_id": inn.id,
+                    "sale_point_id": int(row.id_sp_),
+                    "type_operation_id": int(row.type_operation),
+                    "price": int(row.price),
+                    "cnt": int(row.cnt),
+                    "user_id": user.id,
+                }
+                for row in sold.itertuples()
+            ],
+        )
+        rollups.rebuild(db, user.id)
+        db.commit()
+        yield user.id
+    drop_all(engine)
+    engine.dispose()
+
+
+def _compute(user_id: int, metric: str, **params) -> dict:
+    async def compute():
+        engine = create_async_engine(
+            make_url(TEST_DATABASE_URL).set(drivername="postgresql+asyncpg")
+        )
+        try:
+            async with AsyncSession(engine) as db:
+                user = models.User(id=user_id)
+                return await getattr(sql_metrics, metric)(db, user, **params)
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(compute())
+
+
+@pytest.mark.parametrize("metric", METRICS)
+def test_matches_reference(sales, user_id, metric):
+    sold, points = sales
+    assert _compute(user_id, metric) == reference(metric, sold, points)
+
+
+@pytest.mark.parametrize("metric", METRICS)
+def test_window_matches_reference_on_window_sales(sales, user_id, metric):
+    sold, points = sales
+    date_from, date_to = date(2022, 9, 10), date(2022, 11, 20)
+    window = sold[
+        (sold["dt"] >= pd.Timestamp(date_from)) & (sold["dt"] < pd.Timestamp(date_to))
+    ]
+    result = _compute(user_id, metric, date_from=date_from, date_to=date_to)
+    assert result == reference(metric, window, points)
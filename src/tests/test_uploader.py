@@ -0,0 +1,55 @@
+import io
+
+import pandas as pd
+import pytest
+
+from app.utils.uploader import iter_blocks, parse_block
+
+LINES = [
+    f"2023-01-{day:02d},G{day},P,I,S{day},1,{day * 10},{day}\n" for day in range(1, 21)
+]
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 40, 41, 100, 10_000])
+def test_iter_blocks_splits_on_line_boundaries(block_size):
+    data = "".join(LINES).encode()
+    blocks = list(iter_blocks(io.BytesIO(data), block_size))
+
+    assert b"".join(block for _, block in blocks) == data
+    assert all(block.endswith(b"\n") for _, block in blocks)
+    # смещение блока - позиция в потоке сразу после его последней строки
+    assert [offset for offset, _ in blocks] == [
+        sum(len(block) for _, block in blocks[: i + 1]) for i in range(len(blocks))
+    ]
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 100, 10_000])
+def test_iter_blocks_keeps_last_line_without_newline(block_size):
+    data = "".join(LINES).encode() + b"2023-02-01,G,P,I,S,1,5,1"
+    blocks = list(iter_blocks(io.BytesIO(data), block_size))
+
+    assert b"".join(block for _, block in blocks) == data
+    assert blocks[-1][1].endswith(b"2023-02-01,G,P,I,S,1,5,1")
+    assert blocks[-1][0] == len(data)
+
+
+def test_iter_blocks_starts_at_stream_position():
+    data = b"dt,gtin\n" + "".join(LINES).encode()
+    stream = io.BytesIO(data)
+    stream.readline()
+    blocks = list(iter_blocks(stream, 64))
+
+    assert b"".join(block for _, block in blocks) == data[8:]
+    assert blocks[-1][0] == len(data)
+
+
+def test_parse_block_converts_columns():
+    frame = parse_block("".join(LINES[:3]).encode(), "sold")
+
+    assert len(frame) == 3
+    assert frame["dt"].tolist() == [
+        pd.Timestamp(f"2023-01-0{day}") for day in (1, 2, 3)
+    ]
+    assert frame["price"].dtype == "int64"
+    assert frame["gtin"].dtype == "category"
+    assert frame["cnt"].tolist() == [1, 2, 3]
@@ -1,81 +1,143 @@
-from datetime import datetime
-from time import perf_counter
+"""Загрузка выгрузок в базу данных из командной строки
 
-from app.core.database import *
-from app.core.models import *
+Пример:
+    python uploader.py --user Alandez --jobs 2 --workers 4 "data/addon/*.csv"
+"""
+import argparse
+import glob
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from time import perf_counter
 
+from app.core import crud
+from app.core.database import init_db
+from app.core.settings import settings
+from app.utils.files import file_sha256
+from app.utils.formats import CsvFormat, detect_format
+from app.utils.logging import log
+from app.utils.uploader import read_header, upload_from_csv
 
-files = {
-    "prod": "data/addon/production.csv",
-    "sold": "data/addon/sold.csv",
-    "transport": "data/addon/transport.csv",
-}
 
-SessionLocal = init_db()
-db = SessionLocal()
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Bulk load csv exports")
+    parser.add_argument("paths", nargs="+", help="files or glob patterns")
+    parser.add_argument("--user", required=True, help="owner username")
+    parser.add_argument(
+        "--jobs", type=int, default=2, help="files loaded at the same time"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=settings.UPLOAD_WORKERS,
+        help="parsing processes per file",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=settings.UPLOAD_BLOCK_SIZE,
+        help="bytes per parsed and committed block",
+    )
+    parser.add_argument(
+        "--method",
+        choices=["copy", "staging", "orm"],
+        default=settings.UPLOAD_METHOD,
+    )
+    return parser.parse_args()
 
 
-with open(files["prod"], "r") as file:
-    fields = file.readline()
-    # "dt","inn","gtin","prid","operation_type","cnt"
-    goods = []
-    start = perf_counter()
-    for l in file.readlines():
-        print(l.split(","))
-        goods.append(
-            ProducedGoods(
-                dt=datetime.strptime(l.split(",")[0], "%Y-%m-%d"),
-                inn=str(l.split(",")[1]).replace('"', ""),
-                gtin=str(l.split(",")[2]).replace('"', ""),
-                prid=str(l.split(",")[3]).replace('"', ""),
-                operation_type=str(l.split(",")[4]).replace('"', ""),
-                cnt=int(l.split(",")[5]),
-            )
-        )
-    db.add_all(goods)
-    db.commit()
-    print(perf_counter() - start)
-
-with open(files["sold"], "r") as file:
-    fields = file.readline()
-    # "dt","gtin","prid","inn","id_sp_","type_operation","price","cnt"
-    goods = []
-    start = perf_counter()
-    for l in file.readlines():
-        goods.append(
-            SoldGoods(
-                dt=datetime.strptime(l.split(",")[0], "%Y-%m-%d"),
-                gtin=str(l.split(",")[1]).replace('"', ""),
-                prid=str(l.split(",")[2]).replace('"', ""),
-                inn=str(l.split(",")[3]).replace('"', ""),
-                id_sp_=str(l.split(",")[4]).replace('"', ""),
-                type_operation=str(l.split(",")[5]).replace('"', ""),
-                price=int(l.split(",")[6]),
-                cnt=int(l.split(",")[7]),
+def expand(patterns: list[str]) -> list[str]:
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        paths.extend(path for path in matches if path not in paths)
+    return paths
+
+
+def load_file(
+    SessionLocal, username: str, path: str, fmt: CsvFormat, args
+) -> tuple[int, float]:
+    db = SessionLocal()
+    try:
+        start = perf_counter()
+        user = crud.get_user_by_username(db, username)
+        sha256 = file_sha256(path)
+        file = crud.get_file_by_hash(db, user, sha256)  # type: ignore
+        if file is not None and file.loaded_at is not None:
+            log.info(f"{path} is already loaded as {file}")
+            return 0, 0.0
+        if file is None:
+            filename = os.path.basename(path)
+            file = crud.save_file(
+                db, user, filename, os.path.abspath(path), sha256  # type: ignore
             )
-        )
-    db.add_all(goods)
-    db.commit()
-    print(perf_counter() - start)
-
-with open(files["transport"], "r") as file:
-    fields = file.readline()
-    print(fields)
-    goods = []
+        upload_from_csv(db, file, method=args.method, workers=args.workers)
+        return file.rows_loaded, perf_counter() - start
+    finally:
+        db.close()
+
+
+def main() -> int:
+    args = parse_args()
+    settings.UPLOAD_BLOCK_SIZE = args.block_size
+
+    files = []
+    for path in expand(args.paths):
+        if not os.path.isfile(path):
+            print(f"skip {path}: not a file", file=sys.stderr)
+            continue
+        fmt = detect_format(read_header(path))
+        if fmt is None:
+            print(f"skip {path}: unknown format", file=sys.stderr)
+            continue
+        files.append((path, fmt))
+    if not files:
+        print("nothing to load", file=sys.stderr)
+        return 1
+
+    SessionLocal = init_db()
+    db = SessionLocal()
+    try:
+        if crud.get_user_by_username(db, args.user) is None:
+            print(f"user {args.user} does not exist", file=sys.stderr)
+            return 1
+    finally:
+        db.close()
+
+    # форматы загружаются по load_order: торговые точки раньше продаж,
+    # файлы одного уровня загружаются параллельно
+    files.sort(key=lambda item: item[1].load_order)
+    results: dict[str, tuple[int, float]] = {}
     start = perf_counter()
-    for l in file.readlines():
-        goods.append(
-            TransportedGoods(
-                dt=datetime.strptime(l.split(",")[0], "%Y-%m-%d"),
-                gtin=str(l.split(",")[1]).replace('"', ""),
-                prid=str(l.split(",")[2]).replace('"', ""),
-                sender_inn=str(l.split(",")[3]).replace('"', ""),
-                receiver_inn=str(l.split(",")[4]).replace('"', ""),
-                cnt_moved=int(l.split(",")[5]),
-            )
-        )
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for _, group in groupby(files, key=lambda item: item[1].load_order):
+            group = list(group)
+            futures = {
+                path: pool.submit(load_file, SessionLocal, args.user, path, fmt, args)
+                for path, fmt in group
+            }
+            for path, future in futures.items():
+                try:
+                    results[path] = future.result()
+                except Exception as ex:
+                    log.exception(f"failed to load {path}: {ex}")
+                    results[path] = (-1, 0.0)
+    elapsed = perf_counter() - start
+
+    print(f"{'file':<60} {'format':<16} {'rows':>12} {'seconds':>9} {'rows/s':>10}")
+    for path, fmt in files:
+        rows, seconds = results[path]
+        rate = f"{rows / seconds:.0f}" if rows > 0 and seconds else "-"
+        status = str(rows) if rows >= 0 else "failed"
+        print(f"{path:<60} {fmt.name:<16} {status:>12} {seconds:>9.2f} {rate:>10}")
+    total = sum(rows for rows, _ in results.values() if rows > 0)
+    print(
+        f"total: {total} rows from {len(files)} files in {elapsed:.2f} seconds "
+        f"({total / elapsed if elapsed else 0:.0f} rows/s)"
+    )
+    return 0 if all(rows >= 0 for rows, _ in results.values()) else 1
+
 
-    db.add_all(goods)
-    db.commit()
-    print(perf_counter() - start)
+if __name__ == "__main__":
+    sys.exit(main())